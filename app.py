@@ -7,6 +7,7 @@ import time
 
 from channel import channel_factory
 from common import const
+from common.metrics import setup_metrics
 from config import load_config
 from plugins import *
 import threading
@@ -29,7 +30,10 @@ def start_channel(channel_name: str):
     channel = channel_factory.create_channel(channel_name)
     if channel_name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app", "wework",
                         const.FEISHU, const.DINGTALK]:
-        PluginManager().load_plugins()
+        if conf().get("plugin_lazy_load", True):
+            PluginManager().load_plugins_in_background()
+        else:
+            PluginManager().load_plugins()
 
     if conf().get("use_linkai"):
         try:
@@ -44,6 +48,7 @@ def run():
     try:
         # load config
         load_config()
+        setup_metrics(conf())
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
@@ -59,6 +64,16 @@ def run():
         if channel_name == "wxy":
             os.environ["WECHATY_LOG"] = "warn"
 
+        if conf().get("tokenizer_warmup", True):
+            # 预加载token编码器，读取BPE文件较慢，放到后台线程
+            from common import tokenizer
+            threading.Thread(target=tokenizer.warm_up, args=([conf().get("model")],), daemon=True).start()
+        if conf().get("bridge_warmup"):
+            # 提前创建bot，首条消息不用等待SDK导入和客户端初始化
+            from bridge.bridge import Bridge
+
+            Bridge().warm_up(conf().get("bridge_warmup"))
+
         start_channel(channel_name)
 
         while True:
@@ -69,4 +84,9 @@ def run():
 
 
 if __name__ == "__main__":
-    run()
+    if "--profile-startup" in sys.argv:
+        from common.startup_profile import profile_startup
+
+        profile_startup()
+    else:
+        run()
@@ -15,3 +15,10 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    def health_check(self):
+        """
+        optional backend health probe used by Bridge.probe
+        raise an exception when the backend is unavailable
+        """
+        return None
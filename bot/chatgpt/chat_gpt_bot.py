@@ -5,6 +5,7 @@ import time
 import openai
 import openai.error
 import requests
+from common import http_client, resilience
 from common import const
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -20,6 +21,8 @@ from video_task.video_task import get_tts_file_url
 
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
+    backend_name = const.CHATGPT  # 熔断器和重试预算按后端区分
+
     def __init__(self):
         super().__init__()
         # set the default api_key
@@ -77,11 +80,11 @@ class ChatGPTBot(Bot, OpenAIImage):
 
                 task = query.replace(f"#跟读任务#{group_name}#", "")
 
-                daily_contents = conf().get("daily_contents")
+                daily_contents = dict(conf().get("daily_contents") or {})
                 daily_contents[group_name] = task
                 update_config("daily_contents",daily_contents)
                 wav_url = get_tts_file_url("edu_english_root_01","azure","zh-CN-XiaoxiaoMultilingualNeural",task)
-                wav_urls = conf().get("wav_urls")
+                wav_urls = dict(conf().get("wav_urls") or {})
                 wav_urls[group_name] = wav_url
                 update_config("wav_urls", wav_urls)
                 reply = Reply(ReplyType.INFO, f"跟读任务已更新：\n"+task[:(min(200,len(task)))]+ f"\n（如果过长，后面部分省略显示，跟读任务没有省略）" +f"""
@@ -92,13 +95,13 @@ class ChatGPTBot(Bot, OpenAIImage):
             today = time.strftime("%Y-%m-%d", time.localtime())
             new_query = f"今天是{today}\n"
             if "跟读" in query or "今日" in query or "任务" in query or "今天" in query :
-                load_config()
+                # 跟读内容的修改由配置文件监听自动重载，这里直接读取当前配置
                 task = conf().get("daily_contents").get(group_name)
                 new_query = new_query + f"当用户问到今日任务、今日跟读等内容，请返回跟读内容原文，不要做任何修改，以下是跟读内容原文：\n{task}\n"
 
 
             # 插入信息合并到query中!!!!!!!!!!
-            user_info = User_manager.load_user(user_id_hex)
+            user_info = User_manager.load_user(user_id_hex, group_name if context.get("isgroup", False) else None)
             user_info["username"] = actual_user_nickname
             new_query = new_query + f"用户当前的姓名、打卡等级等个人信息：\n{user_info}\n" + f"以下是要回答的问题：\n" + query
 
@@ -161,13 +164,19 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            logger.warn("[CHATGPT] RateLimitError: rate limit exceeded")
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        backend = resilience.backend(self.backend_name)
+        if not backend.allow():
+            logger.warn("[CHATGPT] circuit open, skip request")
+            return {"completion_tokens": 0, "content": "服务暂时不可用，请稍后再问我吧"}
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            backend.record_success()
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
             return {
@@ -176,31 +185,30 @@ class ChatGPTBot(Bot, OpenAIImage):
                 "content": response.choices[0]["message"]["content"],
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            # 不在处理线程上sleep等待：失败计入熔断器，只在重试预算允许时立即重试，接口限流时不重试
+            need_retry = False
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CHATGPT] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                backend.record_failure()
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CHATGPT] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                backend.record_failure()
+                need_retry = backend.can_retry(retry_count)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                backend.record_failure()
+                need_retry = backend.can_retry(retry_count)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                backend.record_failure()
+                need_retry = backend.can_retry(retry_count)
             else:
                 logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
                 self.sessions.clear_session(session.session_id)
 
             if need_retry:
@@ -209,14 +217,34 @@ class ChatGPTBot(Bot, OpenAIImage):
             else:
                 return result
 
+    def health_check(self):
+        """
+        请求模型列表接口，确认api_base可以访问且api_key有效
+        """
+        api_base = (conf().get("open_ai_api_base") or "https://api.openai.com/v1").rstrip("/")
+        self._probe(api_base + "/models", {"Authorization": "Bearer " + (conf().get("open_ai_api_key") or "")})
+
+    @staticmethod
+    def _probe(url, headers):
+        proxy = conf().get("proxy")
+        res = http_client.get(url, headers=headers, timeout=conf().get("bot_probe_timeout", 5), proxies={"http": proxy, "https": proxy} if proxy else None)
+        if res.status_code != 200:
+            raise Exception("HTTP {} from {}".format(res.status_code, url))
+
 
 class AzureChatGPTBot(ChatGPTBot):
+    backend_name = const.CHATGPTONAZURE
+
     def __init__(self):
         super().__init__()
         openai.api_type = "azure"
         openai.api_version = conf().get("azure_api_version", "2023-06-01-preview")
         self.args["deployment_id"] = conf().get("azure_deployment_id")
 
+    def health_check(self):
+        api_base = (conf().get("open_ai_api_base") or "").rstrip("/")
+        self._probe("{}/openai/models?api-version={}".format(api_base, openai.api_version), {"api-key": conf().get("open_ai_api_key") or ""})
+
     def create_img(self, query, retry_count=0, api_key=None):
         text_to_image_model = conf().get("text_to_image")
         if text_to_image_model == "dall-e-2":
@@ -230,13 +258,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -255,7 +283,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
@@ -1,6 +1,6 @@
 from bot.session_manager import Session
 from common.log import logger
-from common import const
+from common.tokenizer import get_tokenizer
 
 """
     e.g.  [
@@ -29,9 +29,9 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -50,52 +50,39 @@ class ChatGPTSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        if get_tokenizer(self.model) is None:
+            return self.cached_tokens()
+        return self.cached_tokens() + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def count_message_tokens(self, message):
+        return num_tokens_from_message(message, self.model)
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
+    if get_tokenizer(model) is None:
         return num_tokens_by_character(messages)
-
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += num_tokens_from_message(message, model)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming."""
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        return len(message["content"])
+    num_tokens = tokenizer.tokens_per_message
+    for key, value in message.items():
+        num_tokens += tokenizer.count(value)
+        if key == "name":
+            num_tokens += tokenizer.tokens_per_name
+    return num_tokens
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
     tokens = 0
@@ -18,9 +18,9 @@ class DashscopeSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -40,7 +40,10 @@ class DashscopeSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages)
+        return self.cached_tokens()
+
+    def count_message_tokens(self, message):
+        return num_tokens_from_messages([message])
 
 
 def num_tokens_from_messages(messages):
@@ -3,7 +3,7 @@
 
 import re
 import time
-import requests
+from common import const, http_client, resilience
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -56,6 +56,10 @@ class LinkAIBot(Bot):
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.TEXT, "请再问我一次吧")
+        backend = resilience.backend(const.LINKAI)
+        if not backend.allow():
+            logger.warn("[LINKAI] circuit open, skip request")
+            return Reply(ReplyType.TEXT, "服务暂时不可用，请稍后再问我吧")
 
         try:
             # load config
@@ -123,8 +127,10 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
+            if res.status_code < 500:
+                backend.record_success()
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -160,7 +166,9 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    backend.record_failure()
+                    if not backend.can_retry(retry_count):
+                        return Reply(ReplyType.TEXT, "请再问我一次吧")
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
                     return self._chat(query, context, retry_count + 1)
 
@@ -171,8 +179,10 @@ class LinkAIBot(Bot):
 
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
+            # retry，不在处理线程上sleep，是否立即重试由熔断器和重试预算决定
+            backend.record_failure()
+            if not backend.can_retry(retry_count):
+                return Reply(ReplyType.TEXT, "请再问我一次吧")
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
 
@@ -245,6 +255,10 @@ class LinkAIBot(Bot):
                 "completion_tokens": 0,
                 "content": "请再问我一次吧"
             }
+        backend = resilience.backend(const.LINKAI)
+        if not backend.allow():
+            logger.warn("[LINKAI] circuit open, skip request")
+            return {"total_tokens": 0, "completion_tokens": 0, "content": "服务暂时不可用，请稍后再问我吧"}
 
         try:
             body = {
@@ -262,8 +276,10 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
+            if res.status_code < 500:
+                backend.record_success()
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -284,9 +300,10 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    backend.record_failure()
+                    if backend.can_retry(retry_count):
+                        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                        return self.reply_text(session, app_code, retry_count + 1)
 
                 return {
                     "total_tokens": 0,
@@ -296,8 +313,10 @@ class LinkAIBot(Bot):
 
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
+            # retry，不在处理线程上sleep，是否立即重试由熔断器和重试预算决定
+            backend.record_failure()
+            if not backend.can_retry(retry_count):
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "请再问我一次吧"}
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self.reply_text(session, app_code, retry_count + 1)
 
@@ -306,7 +325,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +346,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +449,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -455,6 +474,7 @@ class LinkAISessionManager(SessionManager):
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
 
@@ -462,14 +482,18 @@ class LinkAISession(ChatGPTSession):
     def calc_tokens(self):
         if not self.messages:
             return 0
-        return len(str(self.messages))
+        return self.cached_tokens()
+
+    def count_message_tokens(self, message):
+        # 合计等于len(str(self.messages))：每条消息的repr加上", "分隔符，首尾的"[]"抵消掉最后一个分隔符
+        return len(str(message)) + 2
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         cur_tokens = self.calc_tokens()
         if cur_tokens > max_tokens:
             for i in range(0, len(self.messages)):
                 if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
+                    self.pop_message(i)
+                    self.pop_message(i - 1)
                     return self.calc_tokens()
         return cur_tokens
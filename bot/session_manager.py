@@ -1,3 +1,4 @@
+from bot.session_store import StoredSessions, get_session_store, get_stored_sessions
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
@@ -7,6 +8,8 @@ class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.token_cache = []  # 与messages一一对应的(message, tokens)，每条消息只计数一次
+        self.token_total = 0  # token_cache中tokens的合计
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -35,16 +38,82 @@ class Session(object):
     def calc_tokens(self):
         raise NotImplementedError
 
+    def count_message_tokens(self, message):
+        """
+        计算单条消息的token数，子类实现后可通过cached_tokens增量计数
+        """
+        raise NotImplementedError
+
+    def cached_tokens(self):
+        """
+        返回messages的token合计，只对上次计数之后新加入的消息调用count_message_tokens
+        """
+        messages, cache = self.messages, self.token_cache
+        if len(cache) > len(messages) or (cache and (cache[0][0] is not messages[0] or cache[-1][0] is not messages[len(cache) - 1])):
+            # messages被重置或在外部修改过，重新计数
+            cache.clear()
+            self.token_total = 0
+        for message in messages[len(cache):]:
+            tokens = self.count_message_tokens(message)
+            cache.append((message, tokens))
+            self.token_total += tokens
+        return self.token_total
+
+    def pop_message(self, index):
+        """
+        删除指定位置的消息，并同步扣减缓存的token合计
+        """
+        message = self.messages.pop(index)
+        if index < len(self.token_cache) and self.token_cache[index][0] is message:
+            self.token_total -= self.token_cache.pop(index)[1]
+        else:
+            self.token_cache.clear()
+            self.token_total = 0
+        return message
+
+    def dump(self):
+        """
+        返回可json序列化的会话状态，用于持久化存储
+        """
+        return {"system_prompt": self.system_prompt, "messages": list(self.messages)}
+
+    def load(self, state):
+        self.system_prompt = state["system_prompt"]
+        self.messages = state["messages"]
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+        self.sessioncls = sessioncls
+        self.session_args = session_args
+        store = get_session_store()
+        if store is not None:
+            sessions = get_stored_sessions(
+                store,
+                sessioncls.__name__,
+                self._restore_session,
+                cache_seconds=conf().get("session_cache_seconds", 300),
+                cache_size=conf().get("session_cache_size", 10000),
+                flush_interval=conf().get("session_flush_interval", 1),
+                flush_batch=conf().get("session_flush_batch", 200),
+            )
+        elif conf().get("expires_in_seconds"):
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), sweep_interval=60)
         else:
             sessions = dict()
         self.sessions = sessions
-        self.sessioncls = sessioncls
-        self.session_args = session_args
+
+    def _restore_session(self, session_id, state):
+        session = self.sessioncls(session_id, state["system_prompt"], **self.session_args)
+        session.load(state)
+        return session
+
+    def save_session(self, session):
+        """
+        会话内容改动后调用，使用持久化存储时会在后台批量写入
+        """
+        if isinstance(self.sessions, StoredSessions):
+            self.sessions.save(session)
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -58,6 +127,7 @@ class SessionManager(object):
             self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            self.save_session(self.sessions[session_id])
         session = self.sessions[session_id]
         return session
 
@@ -70,6 +140,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,6 +152,7 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def clear_session(self, session_id):
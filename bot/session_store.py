@@ -0,0 +1,302 @@
+"""
+会话持久化存储
+session_store为memory时会话只保存在进程内(默认)；为sqlite或redis时会话序列化后写入存储，进程重启后可恢复上下文，
+使用redis时多个进程可以共享会话。会话的过期时间由存储负责，进程内只缓存最近活跃的会话
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    """
+    存储后端接口，保存的是会话的序列化状态，ttl为0表示不过期
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+
+    def get(self, key):
+        """返回key对应的会话状态(dict)，不存在或已过期时返回None"""
+        raise NotImplementedError
+
+    def put_many(self, items):
+        """批量写入{key: 会话状态}，同时刷新过期时间"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self, prefix):
+        """删除key以prefix开头的全部会话"""
+        raise NotImplementedError
+
+    def purge(self):
+        """清理已过期的会话，由后台写入线程定期调用"""
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    单机持久化存储，使用WAL模式，同一台机器上的多个进程可以共用一个数据库文件
+    """
+
+    def __init__(self, path, ttl=0):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, expire_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expire_at ON sessions (expire_at)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE key = ? AND (expire_at IS NULL OR expire_at > ?)", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, items):
+        expire_at = time.time() + self.ttl if self.ttl else None
+        rows = [(key, json.dumps(state, ensure_ascii=False), expire_at) for key, state in items.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO sessions (key, data, expire_at) VALUES (?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def clear(self, prefix):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def purge(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE expire_at <= ?", (time.time(),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisSessionStore(SessionStore):
+    """
+    兼容redis协议的存储，过期时间使用redis自身的TTL，多个进程可以共享
+    """
+
+    def __init__(self, url, ttl=0, key_prefix="cow:session:"):
+        super().__init__(ttl)
+        import redis
+
+        self.key_prefix = key_prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        data = self._client.get(self.key_prefix + key)
+        return json.loads(data) if data else None
+
+    def put_many(self, items):
+        pipe = self._client.pipeline(transaction=False)
+        for key, state in items.items():
+            pipe.set(self.key_prefix + key, json.dumps(state, ensure_ascii=False), ex=self.ttl or None)
+        pipe.execute()
+
+    def delete(self, key):
+        self._client.delete(self.key_prefix + key)
+
+    def clear(self, prefix):
+        batch = []
+        for key in self._client.scan_iter(match=self.key_prefix + prefix + "*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                self._client.delete(*batch)
+                batch = []
+        if batch:
+            self._client.delete(*batch)
+
+    def close(self):
+        self._client.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    按配置创建全局共享的存储后端，session_store为memory时返回None
+    """
+    global _store
+    store_type = conf().get("session_store", "memory")
+    if store_type == "memory":
+        return None
+    with _store_lock:
+        if _store is None:
+            ttl = conf().get("expires_in_seconds") or 0
+            if store_type == "sqlite":
+                path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+                _store = SqliteSessionStore(path, ttl)
+            elif store_type == "redis":
+                _store = RedisSessionStore(conf().get("session_store_url", "redis://127.0.0.1:6379/0"), ttl)
+            else:
+                raise RuntimeError("unknown session_store: {}".format(store_type))
+            logger.info("[SessionStore] using {} session store".format(store_type))
+        return _store
+
+
+_stored_sessions = {}  # namespace -> StoredSessions
+
+
+def get_stored_sessions(store, namespace, session_factory, **kwargs):
+    """
+    每个namespace只创建一个StoredSessions(和一个后台写入线程)，reset_bot重新创建SessionManager时复用，
+    旧实例上尚未写入的会话不会丢失，也不会和新实例交替写入同一批key
+    """
+    with _store_lock:
+        sessions = _stored_sessions.get(namespace)
+        if sessions is None or sessions.store is not store:
+            sessions = _stored_sessions[namespace] = StoredSessions(store, namespace, session_factory, **kwargs)
+            return sessions
+    sessions.session_factory = session_factory
+    # 缓存中的会话由旧的SessionManager创建，清掉后按新的配置从存储恢复；先写入待写的会话
+    sessions.flush()
+    if sessions.cache is not None:
+        sessions.cache.clear()
+    return sessions
+
+
+class StoredSessions(MutableMapping):
+    """
+    以存储后端为准的会话字典，用法与SessionManager.sessions原来的dict/ExpiredDict相同
+    读取时依次查找进程内缓存、待写入的会话、存储后端，未命中的会话不占内存；
+    会话改动后调用save，由后台线程每flush_interval秒或积累flush_batch个会话时批量写入
+    通过get_stored_sessions获取，同一namespace共用一个实例
+    """
+
+    PURGE_INTERVAL = 600  # 清理存储中过期会话的间隔，单位秒
+
+    def __init__(self, store, namespace, session_factory, cache_seconds=300, cache_size=10000, flush_interval=1, flush_batch=200):
+        self.store = store
+        self.prefix = namespace + ":"
+        self.session_factory = session_factory  # (session_id, state) -> Session
+        self.cache = ExpiredDict(cache_seconds, max_size=cache_size) if cache_seconds > 0 else None
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._pending = {}  # session_id -> 待写入的Session
+        self._flushing = {}  # 正在写入的Session，写入完成前读取仍以它为准
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_purge = time.monotonic()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def __getitem__(self, session_id):
+        if self.cache is not None:
+            session = self.cache.get(session_id)
+            if session is not None:
+                return session
+        with self._lock:
+            session = self._pending.get(session_id) or self._flushing.get(session_id)
+        if session is None:
+            state = self.store.get(self.prefix + session_id)
+            if state is None:
+                raise KeyError(session_id)
+            session = self.session_factory(session_id, state)
+        if self.cache is not None:
+            self.cache[session_id] = session
+        return session
+
+    def __setitem__(self, session_id, session):
+        if self.cache is not None:
+            self.cache[session_id] = session
+        self.save(session)
+
+    def __delitem__(self, session_id):
+        if self.cache is not None:
+            self.cache.pop(session_id, None)
+        # 等待正在进行的写入完成，避免删除后又被写回
+        with self._flush_lock:
+            with self._lock:
+                self._pending.pop(session_id, None)
+            self.store.delete(self.prefix + session_id)
+
+    def __contains__(self, session_id):
+        try:
+            self[session_id]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        # 只遍历进程内缓存的活跃会话
+        return iter(self.cache.keys() if self.cache is not None else [])
+
+    def __len__(self):
+        return len(self.cache) if self.cache is not None else 0
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+        with self._flush_lock:
+            with self._lock:
+                self._pending.clear()
+            self.store.clear(self.prefix)
+
+    def save(self, session):
+        with self._lock:
+            self._pending[session.session_id] = session
+            pending = len(self._pending)
+        if pending >= self.flush_batch:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = dict(pending)
+            if not pending:
+                return
+            try:
+                items = {self.prefix + session_id: session.dump() for session_id, session in pending.items()}
+                self.store.put_many(items)
+            except Exception as e:
+                logger.warning("[SessionStore] failed to save {} sessions: {}".format(len(pending), e))
+                with self._lock:
+                    # 写入失败的会话放回队列，已有更新的保留新值
+                    for session_id, session in pending.items():
+                        self._pending.setdefault(session_id, session)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() - self._last_purge > self.PURGE_INTERVAL:
+                    self._last_purge = time.monotonic()
+                    self.store.purge()
+            except Exception as e:
+                logger.warning("[SessionStore] flush error: {}".format(e))
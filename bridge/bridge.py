@@ -1,7 +1,10 @@
+import threading
+import time
+
 from bot.bot_factory import create_bot
 from bridge.context import Context
 from bridge.reply import Reply
-from common import const
+from common import const, metrics, resilience
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -12,7 +15,14 @@ from voice.factory import create_voice
 @singleton
 class Bridge(object):
     def __init__(self):
-        self.btype = {
+        self.btype = self._resolve_btype()
+        self.bots = {}
+        self.chat_bots = {}
+        self._lock = threading.Lock()  # 保护bots、chat_bots的替换和_create_locks
+        self._create_locks = {}  # 每种bot一个锁，保证同一个bot只创建一次，创建慢的bot不影响其他bot的首次使用
+
+    def _resolve_btype(self):
+        btype = {
             "chat": const.CHATGPT,
             "voice_to_text": conf().get("voice_to_text", "openai"),
             "text_to_voice": conf().get("text_to_voice", "google"),
@@ -21,83 +31,190 @@ class Bridge(object):
         # 这边取配置的模型
         bot_type = conf().get("bot_type")
         if bot_type:
-            self.btype["chat"] = bot_type
+            btype["chat"] = bot_type
         else:
             model_type = conf().get("model") or const.GPT35
             if model_type in ["text-davinci-003"]:
-                self.btype["chat"] = const.OPEN_AI
+                btype["chat"] = const.OPEN_AI
             if conf().get("use_azure_chatgpt", False):
-                self.btype["chat"] = const.CHATGPTONAZURE
+                btype["chat"] = const.CHATGPTONAZURE
             if model_type in ["wenxin", "wenxin-4"]:
-                self.btype["chat"] = const.BAIDU
+                btype["chat"] = const.BAIDU
             if model_type in ["xunfei"]:
-                self.btype["chat"] = const.XUNFEI
+                btype["chat"] = const.XUNFEI
             if model_type in [const.QWEN]:
-                self.btype["chat"] = const.QWEN
+                btype["chat"] = const.QWEN
             if model_type in [const.QWEN_TURBO, const.QWEN_PLUS, const.QWEN_MAX]:
-                self.btype["chat"] = const.QWEN_DASHSCOPE
+                btype["chat"] = const.QWEN_DASHSCOPE
             if model_type and model_type.startswith("gemini"):
-                self.btype["chat"] = const.GEMINI
+                btype["chat"] = const.GEMINI
             if model_type and model_type.startswith("glm"):
-                self.btype["chat"] = const.ZHIPU_AI
+                btype["chat"] = const.ZHIPU_AI
             if model_type and model_type.startswith("claude-3"):
-                self.btype["chat"] = const.CLAUDEAPI
+                btype["chat"] = const.CLAUDEAPI
 
             if model_type in ["claude"]:
-                self.btype["chat"] = const.CLAUDEAI
+                btype["chat"] = const.CLAUDEAI
 
             if model_type in [const.MOONSHOT, "moonshot-v1-8k", "moonshot-v1-32k", "moonshot-v1-128k"]:
-                self.btype["chat"] = const.MOONSHOT
+                btype["chat"] = const.MOONSHOT
 
             if model_type in ["abab6.5-chat"]:
-                self.btype["chat"] = const.MiniMax
+                btype["chat"] = const.MiniMax
 
             if conf().get("use_linkai") and conf().get("linkai_api_key"):
-                self.btype["chat"] = const.LINKAI
+                btype["chat"] = const.LINKAI
                 if not conf().get("voice_to_text") or conf().get("voice_to_text") in ["openai"]:
-                    self.btype["voice_to_text"] = const.LINKAI
+                    btype["voice_to_text"] = const.LINKAI
                 if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
-                    self.btype["text_to_voice"] = const.LINKAI
+                    btype["text_to_voice"] = const.LINKAI
 
-        self.bots = {}
-        self.chat_bots = {}
+        return btype
 
     # 模型对应的接口
     def get_bot(self, typename):
-        if self.bots.get(typename) is None:
-            logger.info("create bot {} for {}".format(self.btype[typename], typename))
-            if typename == "text_to_voice":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "voice_to_text":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
-            elif typename == "translate":
-                self.bots[typename] = create_translator(self.btype[typename])
-        return self.bots[typename]
+        bot = self.bots.get(typename)
+        if bot is not None:
+            return bot
+        with self._create_lock(("bot", typename)):
+            while True:
+                with self._lock:
+                    btype, bots = self.btype, self.bots
+                bot = bots.get(typename)
+                if bot is not None:
+                    return bot
+                bot = self._create_bot(typename, btype[typename])
+                with self._lock:
+                    # 创建期间reset_bot替换了配置时丢弃按旧配置创建的bot，按新配置重新创建
+                    if self.bots is bots:
+                        return bots.setdefault(typename, bot)
+
+    def _create_lock(self, key):
+        with self._lock:
+            lock = self._create_locks.get(key)
+            if lock is None:
+                lock = self._create_locks[key] = threading.Lock()
+            return lock
+
+    @staticmethod
+    def _create_bot(typename, bot_type):
+        logger.info("create bot {} for {}".format(bot_type, typename))
+        if typename in ["text_to_voice", "voice_to_text"]:
+            return create_voice(bot_type)
+        elif typename == "chat":
+            return create_bot(bot_type)
+        elif typename == "translate":
+            return create_translator(bot_type)
 
     def get_bot_type(self, typename):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        primary = self.btype["chat"]
+        fallback = conf().get("fallback_bot_type")
+        if not fallback or fallback == primary:
+            return self._timed_call("chat", lambda bot: bot.reply(query, context))
+        if resilience.backend(primary).breaker.available():
+            with resilience.track_call(primary) as outcome:
+                reply = self._timed_call("chat", lambda bot: bot.reply(query, context))
+            # 只看本次调用的结果，其他线程同时失败不影响已经拿到的回复
+            if not outcome.failed:
+                return reply
+        logger.warning("[Bridge] chat bot {} unavailable, failover to {}".format(primary, fallback))
+        resilience.FAILOVERS.inc(primary=primary, fallback=fallback)
+        return self.find_chat_bot(fallback).reply(query, context)
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
-        return self.get_bot("voice_to_text").voiceToText(voiceFile)
+        return self._timed_call("voice_to_text", lambda bot: bot.voiceToText(voiceFile))
 
     def fetch_text_to_voice(self, text) -> Reply:
-        return self.get_bot("text_to_voice").textToVoice(text)
+        return self._timed_call("text_to_voice", lambda bot: bot.textToVoice(text))
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
-        return self.get_bot("translate").translate(text, from_lang, to_lang)
+        return self._timed_call("translate", lambda bot: bot.translate(text, from_lang, to_lang))
+
+    def _timed_call(self, typename, call):
+        bot = self.get_bot(typename)
+        start = time.monotonic()
+        try:
+            return call(bot)
+        except Exception:
+            metrics.BOT_ERRORS.inc(bot=self.btype[typename], kind=typename)
+            raise
+        finally:
+            metrics.BOT_SECONDS.observe(time.monotonic() - start, bot=self.btype[typename], kind=typename)
 
     def find_chat_bot(self, bot_type: str):
-        if self.chat_bots.get(bot_type) is None:
-            self.chat_bots[bot_type] = create_bot(bot_type)
-        return self.chat_bots.get(bot_type)
+        bot = self.chat_bots.get(bot_type)
+        if bot is not None:
+            return bot
+        with self._create_lock(("chat", bot_type)):
+            while True:
+                with self._lock:
+                    chat_bots = self.chat_bots
+                bot = chat_bots.get(bot_type)
+                if bot is not None:
+                    return bot
+                bot = create_bot(bot_type)
+                with self._lock:
+                    if self.chat_bots is chat_bots:
+                        return chat_bots.setdefault(bot_type, bot)
+
+    def warm_up(self, typenames):
+        """
+        在后台线程提前创建bot，首条消息不再承担SDK导入和客户端初始化的耗时
+        """
+        typenames = [t for t in (typenames or []) if t in self.btype]
+        if not typenames:
+            return
+
+        def run():
+            for typename in typenames:
+                start = time.monotonic()
+                try:
+                    self.get_bot(typename)
+                    logger.info("[Bridge] warm up {} ({}) in {:.0f}ms".format(typename, self.btype[typename], (time.monotonic() - start) * 1000))
+                except Exception as e:
+                    logger.warning("[Bridge] warm up {} ({}) failed: {}".format(typename, self.btype[typename], e))
+
+        threading.Thread(target=run, name="bridge_warmup", daemon=True).start()
+
+    def probe(self, typenames=None):
+        """
+        检查各后端是否可用，返回{typename: (是否正常, 耗时ms, 说明)}
+        bot实现了health_check时调用它(失败时抛出异常)，否则只检查能否正常创建
+        """
+        results = {}
+        for typename in typenames or list(self.btype.keys()):
+            start = time.monotonic()
+            try:
+                bot = self.get_bot(typename)
+                health_check = getattr(bot, "health_check", None)
+                message = (health_check() if health_check else None) or "ok"
+                ok = True
+            except Exception as e:
+                ok, message = False, str(e) or type(e).__name__
+            results[typename] = (ok, round((time.monotonic() - start) * 1000), message)
+        return results
 
     def reset_bot(self):
         """
         重置bot路由
+        按当前配置重新创建已在使用的bot，全部创建完成后一次性替换，替换前的请求继续使用旧实例；
+        创建失败的bot不再保留，下次使用时重新创建
         """
-        self.__init__()
+        btype = self._resolve_btype()
+        bots = {}
+        for typename in list(self.bots.keys()):
+            try:
+                bots[typename] = self._create_bot(typename, btype[typename])
+            except Exception as e:
+                logger.warning("[Bridge] recreate bot {} ({}) failed: {}".format(typename, btype[typename], e))
+        chat_bots = {}
+        for bot_type in list(self.chat_bots.keys()):
+            try:
+                chat_bots[bot_type] = create_bot(bot_type)
+            except Exception as e:
+                logger.warning("[Bridge] recreate chat bot {} failed: {}".format(bot_type, e))
+        with self._lock:
+            self.btype, self.bots, self.chat_bots = btype, bots, chat_bots
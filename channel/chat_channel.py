@@ -1,15 +1,18 @@
 import os
-import re
 import requests
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from queue import Full
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
 from common.dequeue import Dequeue
+from common.handler_pool import HandlerPool
+from common.trigger_matcher import keyword_matcher, mention_pattern, prefix_matcher
 from common import memory
+from common import metrics, resilience
 from plugins import *
 from video_task.video_task import process_video, read_text_file, get_tts_file_url
 from video_task.user_data import generate_user_id
@@ -20,7 +23,38 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 分阶段处理消息的线程池，避免耗时的视频、语音和媒体发送占满文本对话的线程
+HANDLER_POOL_DEFAULTS = {
+    "text": {"max_workers": 8, "max_queue": 0},  # 文本对话、画图等LLM调用
+    "voice": {"max_workers": 4, "max_queue": 0},  # 语音识别
+    "video": {"max_workers": 2, "max_queue": 0},  # 视频处理
+    "media": {"max_workers": 4, "max_queue": 0},  # 图片文件等消息处理，以及媒体回复的下载和发送
+}
+CONTEXT_HANDLER_STAGE = {
+    ContextType.VOICE: "voice",
+    ContextType.VIDEO: "video",
+    ContextType.IMAGE: "media",
+    ContextType.FILE: "media",
+    ContextType.TXT: "media",
+    ContextType.SHARING: "media",
+}
+MEDIA_REPLY_TYPES = [ReplyType.VOICE, ReplyType.IMAGE, ReplyType.IMAGE_URL, ReplyType.FILE, ReplyType.VIDEO, ReplyType.VIDEO_URL]
+
+handler_pools = {}
+_handler_pools_lock = threading.Lock()
+
+
+def get_handler_pool(stage) -> HandlerPool:
+    if not handler_pools:
+        with _handler_pools_lock:
+            if not handler_pools:
+                pools_conf = conf().get("handler_pools") or {}
+                pools = {}
+                for name, default in HANDLER_POOL_DEFAULTS.items():
+                    pool_conf = dict(default, **pools_conf.get(name, {}))
+                    pools[name] = HandlerPool(name, max_workers=pool_conf["max_workers"], max_queue=pool_conf["max_queue"])
+                handler_pools.update(pools)
+    return handler_pools[stage]
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -29,7 +63,17 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    lock = threading.RLock()  # 用于控制对sessions的访问，future已完成时回调会在持锁线程内同步执行，因此需要可重入
+    ready_cond = threading.Condition(lock)  # 有新消息或任务完成时唤醒消费者线程
+    ready_sessions = deque()  # 有待处理消息的session_id队列，消费者只遍历这里而不是全部sessions
+    ready_set = set()  # ready_sessions的去重集合
+    pool_waiting = {}  # 因线程池排队已满而暂缓调度的session_id，key为线程池阶段名
+    busy_notified = set()  # 已回复过繁忙提示、尚未恢复处理的session_id
+    # 消息队列统计，queued为当前所有session排队中的消息总数
+    queue_stats = {"queued": 0, "dispatched": 0, "dropped_oldest": 0, "dropped_newest": 0, "coalesced": 0, "busy": 0, "wait_total": 0.0, "wait_max": 0.0}
+    # 消息进入队列前被丢弃的数量，key为丢弃阶段
+    drop_stats = {"duplicate": 0, "history": 0, "self": 0, "whitelist": 0, "voice_off": 0, "reference": 0, "trigger": 0}
+    drop_lock = threading.Lock()
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -40,6 +84,7 @@ class ChatChannel(Channel):
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
+        config = conf()  # 同一条消息的处理过程使用同一份配置快照
         # context首次传入时，origin_ctype是None,
         # 引入的起因是：当输入语音时，会嵌套生成两个context，第一步语音转文本，第二步通过文本生成文字回复。
         # origin_ctype用于第二步文本回复时，判断是否需要匹配前缀，如果是私聊的语音，就不需要匹配前缀
@@ -49,12 +94,17 @@ class ChatChannel(Channel):
         first_in = "receiver" not in context
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
+            context["receive_time"] = time.monotonic()
+            if metrics.ENABLED:
+                metrics.MESSAGES_RECEIVED.inc(channel=self.channel_type, ctype=ctype)
             cmsg = context["msg"]
             context["openai_api_key"] = config.get("open_ai_api_key")
             context["gpt_model"] = config.get("model")
-            # 这里加消息字段传入后面！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！
-            print(f"消息字段：{cmsg}")
+            if context.get("isgroup", False) and not self._group_allowed(cmsg.other_user_nickname, config):
+                logger.debug(f"No need reply, groupName not in whitelist, group_name={cmsg.other_user_nickname}")
+                return None
+            # 这里加消息字段传入后面！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！！
+            logger.debug("[chat_channel] 消息字段：%s", cmsg)
 
             user_id_hex = generate_user_id(cmsg.other_user_nickname, cmsg.actual_user_nickname)
             context["user_id_hex"] = user_id_hex
@@ -64,27 +114,10 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
-                    session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
-                        session_id = group_id
-                else:
-                    logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
-                    return None
+                group_chat_in_one_session = config.frozen("group_chat_in_one_session")
+                session_id = cmsg.actual_user_id
+                if group_name in group_chat_in_one_session or "ALL_GROUP" in group_chat_in_one_session:
+                    session_id = group_id
                 context["session_id"] = session_id
                 context["receiver"] = group_id
             else:
@@ -106,14 +139,13 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
+            nick_name_black_list = config.frozen("nick_name_black_list")
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = prefix_matcher(config, "group_chat_prefix").match(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
-                    if match_prefix is not None or match_contain is not None:
+                    if match_prefix is not None or keyword_matcher(config, "group_chat_keyword").match(content) is not None:
                         flag = True
                         if match_prefix:
                             content = content.replace(match_prefix, "", 1).strip()
@@ -125,19 +157,16 @@ class ChatChannel(Channel):
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not conf().get("group_at_off", False):
+                        if not config.get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = mention_pattern(self.name).sub(r"", content)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = mention_pattern(at).sub(r"", subtract_res)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -150,7 +179,7 @@ class ChatChannel(Channel):
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = prefix_matcher(config, "single_chat_prefix", [""]).match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -158,17 +187,17 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = prefix_matcher(config, "image_create_prefix", [""]).match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
@@ -177,15 +206,24 @@ class ChatChannel(Channel):
             return
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
+        start = time.monotonic()
         reply = self._generate_reply(context)
+        metrics.STAGE_SECONDS.observe(time.monotonic() - start, channel=self.channel_type, stage="generate", ctype=context.type)
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
         # reply的包装步骤
         if reply and reply.content:
+            start = time.monotonic()
             reply = self._decorate_reply(context, reply)
+            metrics.STAGE_SECONDS.observe(time.monotonic() - start, channel=self.channel_type, stage="decorate", ctype=context.type)
 
-            # reply的发送步骤
+            # reply的发送步骤，媒体回复转交给media线程池发送，返回的future结束后才会释放该session的信号量
+            if reply and reply.type in MEDIA_REPLY_TYPES and self._select_stage(context) != "media":
+                try:
+                    return get_handler_pool("media").submit(self._send_reply, context, reply)
+                except Full:
+                    logger.warning("[chat_channel] media handler pool is full, send reply in current thread")
             self._send_reply(context, reply)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
@@ -244,18 +282,20 @@ class ChatChannel(Channel):
                         print("用户在群中的昵称：",actual_user_nickname)
                         daily_content = conf().get("daily_contents").get(actual_user_nickname,"")
                         print(f"每日跟读内容：{daily_content}")
-                        user_info = User_manager.load_user(user_id_hex)
+                        # 私聊时other_user_nickname是好友昵称，不能当作所在群
+                        group_name = context.get("other_user_nickname") if context.get("isgroup", False) else None
+                        user_info = User_manager.load_user(user_id_hex, group_name, fresh=True)
                         reply_str = generate_peppa_reading_evaluation(conf().get("open_ai_api_key"),daily_content,actual_user_nickname,user_info, text)
                         reply_json = json.loads(reply_str)
                         print(f"回复的json: {reply_json}")
                         score = reply_json['score']
                         # score = str(min(int(score)+1,5))
                         reply_text = reply_json['response']
-                        User_manager.update_user_score(user_id_hex,actual_user_nickname, score)
+                        user_info = User_manager.update_user_score(user_id_hex,actual_user_nickname, score, group_name)
                         print(f"更新用户得分为：{score}")
-                        cur_stage = User_manager.load_user(user_id_hex).get("level", "青铜")
+                        cur_stage = user_info.get("level", "青铜")
                         print(f"当前用户等级为：{cur_stage}")
-                        total_score = User_manager.load_user(user_id_hex).get("total_score", 0)
+                        total_score = user_info.get("total_score", 0)
                         print(f"当前用户总分为：{total_score}")
                         achievements = User_manager.get_active_achievements(user_id_hex)
                         print(f"当前用户成就为：{achievements}")
@@ -313,8 +353,8 @@ _____________________
                                             reply = Reply(ReplyType.INFO, f"跟读任务更新失败：\n" + f"群 '{group_name}' 不在白名单中")
                                         else:
                                             try:
-                                                # 获取当前的daily_contents字典
-                                                daily_contents = conf().get("daily_contents",{})
+                                                # 获取当前的daily_contents字典，复制一份再修改，不改动正在使用的配置快照
+                                                daily_contents = dict(conf().get("daily_contents") or {})
 
                                                 # 更新特定群的内容
                                                 daily_contents[group_name] = content
@@ -325,7 +365,7 @@ _____________________
                                                     print(f"成功更新群 '{group_name}' 的跟读内容")
                                                     wav_url = get_tts_file_url("edu_english_root_01", "azure",
                                                                                "zh-CN-XiaoxiaoMultilingualNeural", content)
-                                                    wav_urls = conf().get("wav_urls", {})
+                                                    wav_urls = dict(conf().get("wav_urls") or {})
                                                     wav_urls[group_name] = wav_url
                                                     update_config("wav_urls", wav_urls)
                                                     reply = Reply(ReplyType.INFO, f"{group_name}的今日跟读任务已更新：\n" + content[:(
@@ -420,7 +460,12 @@ _____________________
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                start = time.monotonic()
                 self._send(reply, context)
+                end = time.monotonic()
+                metrics.STAGE_SECONDS.observe(end - start, channel=self.channel_type, stage="send", ctype=context.type)
+                if "receive_time" in context:
+                    metrics.STAGE_SECONDS.observe(end - context["receive_time"], channel=self.channel_type, stage="total", ctype=context.type)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
@@ -431,8 +476,11 @@ _____________________
                 return
             logger.exception(e)
             if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+                metrics.SEND_RETRIES.inc(channel=self.channel_type, reply_type=reply.type)
+                # 延迟重试交给定时器，不占用处理线程
+                resilience.call_later(3 + 3 * retry_cnt, self._send, reply, context, retry_cnt + 1)
+            else:
+                metrics.SEND_FAILURES.inc(channel=self.channel_type, reply_type=reply.type)
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -446,6 +494,15 @@ _____________________
                 worker_exception = worker.exception()
                 if worker_exception:
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
+                elif isinstance(worker.result(), Future):  # 回复已转交给media线程池发送，等发送结束再回调
+                    media_future = worker.result()
+                    with self.lock:
+                        # 记录到futures中，cancel_session可以取消排队中的媒体发送
+                        self.futures.setdefault(session_id, []).append(media_future)
+                        # 原线程池已经空出位置，唤醒等待该线程池的session
+                        self._wake_pool_waiting(kwargs.get("stage"))
+                    media_future.add_done_callback(self._thread_pool_callback(session_id, **dict(kwargs, stage="media")))
+                    return
                 else:
                     self._success_callback(session_id, **kwargs)
             except CancelledError as e:
@@ -454,68 +511,233 @@ _____________________
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
                 self.sessions[session_id][1].release()
+                self._mark_ready(session_id)
+                self._wake_pool_waiting(kwargs.get("stage"))
 
         return func
 
+    # 唤醒因stage线程池排队已满而暂缓调度的session，调用方需持有self.lock
+    def _wake_pool_waiting(self, stage):
+        for waiting_session_id in self.pool_waiting.pop(stage, []):
+            self._mark_ready(waiting_session_id)
+
+    # 将session_id放入就绪队列并唤醒消费者，调用方需持有self.lock
+    def _mark_ready(self, session_id):
+        if session_id not in self.ready_set:
+            self.ready_set.add(session_id)
+            self.ready_sessions.append(session_id)
+            self.ready_cond.notify()
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        busy_reply = False
         with self.lock:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
                 ]
+            context_queue = self.sessions[session_id][0]
+            context["produce_time"] = time.monotonic()
+            if metrics.ENABLED and "receive_time" in context:
+                metrics.STAGE_SECONDS.observe(context["produce_time"] - context["receive_time"], channel=self.channel_type, stage="compose", ctype=context.type)
             if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                context_queue.putleft(context)  # 优先处理管理命令，不受队列上限限制
+                self.queue_stats["queued"] += 1
+            elif self._is_queue_full(context_queue):
+                busy_reply = self._shed_load(session_id, context_queue, context)
             else:
-                self.sessions[session_id][0].put(context)
+                context_queue.put(context)
+                self.queue_stats["queued"] += 1
+            self._mark_ready(session_id)
+        if busy_reply:
+            # 在text线程池发送繁忙提示，不在接收消息的线程上发起网络请求
+            try:
+                get_handler_pool("text").submit(self._send_busy_reply, context)
+            except Full:
+                logger.warning("[chat_channel] text handler pool is full, skip busy reply in session {}".format(session_id))
+
+    def _send_busy_reply(self, context: Context):
+        reply = self._decorate_reply(context, Reply(ReplyType.INFO, conf().get("queue_busy_reply", "当前消息较多，请稍后再试")))
+        self._send_reply(context, reply)
+
+    def _is_queue_full(self, context_queue):
+        session_queue_size = conf().get("session_queue_size", 0)
+        global_queue_size = conf().get("global_queue_size", 0)
+        if session_queue_size and context_queue.qsize() >= session_queue_size:
+            return True
+        return bool(global_queue_size and self.queue_stats["queued"] >= global_queue_size)
+
+    # 队列已满时按queue_overflow_policy处理新消息，调用方需持有self.lock，返回是否需要回复繁忙提示
+    def _shed_load(self, session_id, context_queue, context: Context):
+        policy = conf().get("queue_overflow_policy", "drop_oldest")
+        if policy == "drop_oldest":
+            for queued_context in context_queue.queue:
+                if not (queued_context.type == ContextType.TEXT and queued_context.content.startswith("#")):
+                    context_queue.queue.remove(queued_context)
+                    context_queue.put(context)
+                    self.queue_stats["dropped_oldest"] += 1
+                    logger.warning("[chat_channel] queue full, drop oldest message in session {}: {}".format(session_id, queued_context.content))
+                    return False
+        elif policy == "coalesce" and context.type == ContextType.TEXT and context_queue.qsize() > 0:
+            last_context = context_queue.queue[-1]
+            sender_id = _sender_id(context)
+            if last_context.type == ContextType.TEXT and sender_id and _sender_id(last_context) == sender_id and not last_context.content.startswith("#"):
+                last_context.content = last_context.content + "\n" + context.content
+                self.queue_stats["coalesced"] += 1
+                logger.info("[chat_channel] queue full, coalesce message into previous one in session {}".format(session_id))
+                return False
+        elif policy == "busy":
+            self.queue_stats["busy"] += 1
+            logger.warning("[chat_channel] queue full, reply busy in session {}: {}".format(session_id, context.content))
+            if session_id in self.busy_notified:
+                return False
+            self.busy_notified.add(session_id)
+            return True
+        self.queue_stats["dropped_newest"] += 1
+        logger.warning("[chat_channel] queue full, drop newest message in session {}: {}".format(session_id, context.content))
+        return False
+
+    def _group_allowed(self, group_name, config):
+        group_name_white_list = config.frozen("group_name_white_list")
+        return (
+            group_name in group_name_white_list
+            or "ALL_GROUP" in group_name_white_list
+            or keyword_matcher(config, "group_name_keyword_white_list").match(group_name) is not None
+        )
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    def _prefilter_group(self, cmsg) -> bool:
+        """
+        群消息进入_compose_context前的预过滤，返回False表示丢弃
+        只做集合查找和预编译的前缀匹配，大部分不需要回复的群消息在这里就被丢弃，不再计算用户id、打印日志和构造Context；
+        有插件监听ON_RECEIVE_MESSAGE(或插件还在后台加载)时，未触发的文本消息仍交给插件处理
+        """
+        config = conf()
+        if not self._group_allowed(cmsg.other_user_nickname, config):
+            return self.count_drop("whitelist")
+        if cmsg.ctype != ContextType.TEXT:
+            return True
+        content = cmsg.content or ""
+        if "」\n- - - - - - -" in content:
+            return self.count_drop("reference")
+        plugin_manager = PluginManager()
+        if (
+            plugin_manager.loading()
+            or plugin_manager.listeners.get(Event.ON_RECEIVE_MESSAGE)
+            or plugin_manager.observers.get(Event.ON_RECEIVE_MESSAGE)
+        ):
+            return True
+        if cmsg.to_user_id != cmsg.actual_user_id and (
+            (cmsg.is_at and not config.get("group_at_off", False))
+            or prefix_matcher(config, "group_chat_prefix").match(content) is not None
+            or keyword_matcher(config, "group_chat_keyword").match(content) is not None
+        ):
+            return True
+        return self.count_drop("trigger")
+
+    def count_drop(self, stage) -> bool:
+        with self.drop_lock:
+            self.drop_stats[stage] = self.drop_stats.get(stage, 0) + 1
+        if metrics.ENABLED:
+            metrics.MESSAGES_DROPPED.inc(channel=self.channel_type, stage=stage)
+        return False
+
+    def get_drop_stats(self) -> dict:
+        with self.drop_lock:
+            return dict(self.drop_stats)
+
+    def get_queue_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.queue_stats)
+            now = time.monotonic()
+            oldest = [now - q.queue[0].get("produce_time", now) for q, _ in self.sessions.values() if q.qsize() > 0]
+            stats["sessions"] = len(self.sessions)
+            stats["oldest_age"] = round(max(oldest), 3) if oldest else 0
+            stats["wait_avg"] = round(stats["wait_total"] / stats["dispatched"], 3) if stats["dispatched"] else 0
+            stats["wait_max"] = round(stats["wait_max"], 3)
+            del stats["wait_total"]
+            return stats
+
+    # 消费者函数，单独线程，在produce或任务完成时被唤醒，只处理就绪队列中的session
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[chat_channel] consume context: {}".format(context))
-                            future: Future = handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+            with self.ready_cond:
+                while not self.ready_sessions:
+                    self.ready_cond.wait()
+                session_id = self.ready_sessions.popleft()
+                self.ready_set.discard(session_id)
+                if session_id in self.sessions:
+                    self._dispatch(session_id)
+
+    # 根据消息类型选择处理的线程池
+    def _select_stage(self, context: Context):
+        return CONTEXT_HANDLER_STAGE.get(context.type, "text")
+
+    # 在信号量允许的范围内提交session_id的待处理消息，调用方需持有self.lock
+    def _dispatch(self, session_id):
+        context_queue, semaphore = self.sessions[session_id]
+        while semaphore.acquire(blocking=False):
+            if context_queue.empty():
+                semaphore.release()
+                break
+            stage = self._select_stage(context_queue.queue[0])
+            pool = get_handler_pool(stage)
+            if pool.is_full():  # 线程池排队已满，等该线程池有任务结束时再调度
+                semaphore.release()
+                self.pool_waiting.setdefault(stage, set()).add(session_id)
+                break
+            context = context_queue.get()
+            wait = time.monotonic() - context.get("produce_time", time.monotonic())
+            self.queue_stats["queued"] -= 1
+            self.queue_stats["dispatched"] += 1
+            self.queue_stats["wait_total"] += wait
+            self.queue_stats["wait_max"] = max(self.queue_stats["wait_max"], wait)
+            if metrics.ENABLED:
+                metrics.STAGE_SECONDS.observe(wait, channel=self.channel_type, stage="queue", ctype=context.type)
+            self.busy_notified.discard(session_id)
+            logger.debug("[chat_channel] consume context: {}, stage: {}".format(context, stage))
+            future: Future = pool.submit(self._handle, context)
+            if session_id not in self.futures:
+                self.futures[session_id] = []
+            self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context, stage=stage))
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:  # 没有排队和处理中的任务，清理session
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.sessions[session_id]
+            del self.futures[session_id]
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queue_stats["queued"] -= cnt
                 self.sessions[session_id][0] = Dequeue()
 
     def cancel_all_session(self):
         with self.lock:
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queue_stats["queued"] -= cnt
                 self.sessions[session_id][0] = Dequeue()
 
 
+def _sender_id(context: Context):
+    cmsg = context.get("msg")
+    if cmsg is None:
+        return None
+    return cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
+
+
 def check_prefix(content, prefix_list):
     if not prefix_list:
         return None
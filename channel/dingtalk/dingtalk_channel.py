@@ -24,7 +24,7 @@ from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
-from config import conf
+from config import conf, set_overrides
 
 
 class CustomAICardReplier(CardReplier):
@@ -103,10 +103,8 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
         logger.info("[DingTalk] client_id={}, client_secret={} ".format(
             self.dingtalk_client_id, self.dingtalk_client_secret))
-        # 无需群校验和前缀
-        conf()["group_name_white_list"] = ["ALL_GROUP"]
-        # 单聊无需前缀
-        conf()["single_chat_prefix"] = [""]
+        # 无需群校验和前缀，单聊无需前缀
+        set_overrides({"group_name_white_list": ["ALL_GROUP"], "single_chat_prefix": [""]})
 
     def startup(self):
         credential = dingtalk_stream.Credential(self.dingtalk_client_id, self.dingtalk_client_secret)
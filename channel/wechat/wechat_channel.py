@@ -9,7 +9,7 @@ import json
 import os
 import threading
 import time
-import requests
+from common import media_cache
 
 from bridge.context import *
 from bridge.reply import *
@@ -17,7 +17,7 @@ from channel.chat_channel import ChatChannel
 from channel import chat_channel
 from channel.wechat.wechat_message import *
 from common.expired_dict import ExpiredDict
-from common.log import logger
+from common.log import lazy_json, logger
 from common.singleton import singleton
 from common.time_check import time_checker
 from common.utils import convert_webp_to_png
@@ -53,14 +53,17 @@ def _check(func):
         msgId = cmsg.msg_id
         if msgId in self.receivedMsgs:
             logger.info("Wechat message {} already received, ignore".format(msgId))
+            self.count_drop("duplicate")
             return
         self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
             logger.debug("[WX]history message {} skipped".format(msgId))
+            self.count_drop("history")
             return
         if cmsg.my_msg and not cmsg.is_group:
             logger.debug("[WX]my message {} skipped".format(msgId))
+            self.count_drop("self")
             return
         return func(self, cmsg)
 
@@ -145,7 +148,8 @@ class WechatChannel(ChatChannel):
                 time.sleep(2)
                 self.auto_login_times += 1
                 if self.auto_login_times < 100:
-                    chat_channel.handler_pool._shutdown = False
+                    for pool in chat_channel.handler_pools.values():
+                        pool._shutdown = False
                     self.startup()
         except Exception as e:
             pass
@@ -180,11 +184,11 @@ class WechatChannel(ChatChannel):
         elif cmsg.ctype == ContextType.PATPAT:
             logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", lazy_json(cmsg._rawmsg), cmsg)
         elif cmsg.ctype == ContextType.TXT:
-            logger.debug("[WX]receive txt file msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive txt file msg: %s, cmsg=%s", cmsg.content, cmsg)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -192,9 +196,12 @@ class WechatChannel(ChatChannel):
     @time_checker
     @_check
     def handle_group(self, cmsg: ChatMessage):
-        logger.info("cmsg(rowmsg):{}".format(cmsg.rawmsg))
+        if not self._prefilter_group(cmsg):
+            return
+        logger.info("cmsg(rowmsg):%s", cmsg.rawmsg, extra={"sample": "wx_rawmsg"})
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("group_speech_recognition") != True:
+                self.count_drop("voice_off")
                 return
             logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
         elif cmsg.ctype == ContextType.IMAGE:
@@ -202,7 +209,7 @@ class WechatChannel(ChatChannel):
         elif cmsg.ctype in [ContextType.JOIN_GROUP, ContextType.PATPAT, ContextType.ACCEPT_FRIEND, ContextType.EXIT_GROUP]:
             logger.debug("[WX]receive note msg: {}".format(cmsg.content))
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive group msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive group msg: %s, cmsg=%s", lazy_json(cmsg._rawmsg), cmsg)
 
         elif cmsg.ctype == ContextType.FILE:
             logger.debug(f"[WX]receive attachment msg, file_name={cmsg.content}")
@@ -229,21 +236,24 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            size = 0
-            for block in pic_res.iter_content(1024):
-                size += len(block)
-                image_storage.write(block)
-            logger.info(f"[WX] download image success, size={size}, img_url={img_url}")
-            image_storage.seek(0)
-            if ".webp" in img_url:
-                try:
-                    image_storage = convert_webp_to_png(image_storage)
-                except Exception as e:
-                    logger.error(f"Failed to convert image: {e}")
-                    return
-            itchat.send_image(image_storage, toUserName=receiver)
+            try:
+                # 流式下载到缓存文件，同一url只下载一次，with块内缓存文件不会被淘汰
+                with media_cache.download_url(img_url) as img_path:
+                    logger.info(f"[WX] download image success, size={os.path.getsize(img_path)}, img_url={img_url}")
+                    if ".webp" in img_url:
+                        try:
+                            with open(img_path, "rb") as f:
+                                image_storage = convert_webp_to_png(f)
+                        except Exception as e:
+                            logger.error(f"Failed to convert image: {e}")
+                            return
+                    else:
+                        image_storage = open(img_path, "rb")
+                    with image_storage:
+                        itchat.send_image(image_storage, toUserName=receiver)
+            except media_cache.MediaTooLarge as e:
+                logger.error(f"[WX] image too large, img_url={img_url}: {e}")
+                return
             logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
@@ -261,15 +271,14 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
-            video_storage = io.BytesIO()
-            size = 0
-            for block in video_res.iter_content(1024):
-                size += len(block)
-                video_storage.write(block)
-            logger.info(f"[WX] download video success, size={size}, video_url={video_url}")
-            video_storage.seek(0)
-            itchat.send_video(video_storage, toUserName=receiver)
+            try:
+                with media_cache.download_url(video_url) as video_path:
+                    logger.info(f"[WX] download video success, size={os.path.getsize(video_path)}, video_url={video_url}")
+                    with open(video_path, "rb") as f:
+                        itchat.send_video(f, toUserName=receiver)
+            except media_cache.MediaTooLarge as e:
+                logger.error(f"[WX] video too large, video_url={video_url}: {e}")
+                return
             logger.info("[WX] sendVideo url={}, receiver={}".format(video_url, receiver))
 
 def _send_login_success():
@@ -6,6 +6,7 @@ from common.log import logger
 from common.tmp_dir import TmpDir
 from lib import itchat
 from lib.itchat.content import *
+from lib.itchat.returnvalues import ReturnValue
 
 
 class WechatMessage(ChatMessage):
@@ -26,12 +27,12 @@ class WechatMessage(ChatMessage):
         elif itchat_msg["Type"] == VOICE:
             self.ctype = ContextType.VOICE
             self.content = TmpDir().path() + itchat_msg["FileName"]  # content直接存临时目录路径
-            self._prepare_fn = lambda: itchat_msg.download(self.content)
+            self._prepare_fn = lambda: self._download(itchat_msg)
             logger.info("语音消息", self.content)
         elif itchat_msg["Type"] == PICTURE and itchat_msg["MsgType"] == 3:
             self.ctype = ContextType.IMAGE
             self.content = TmpDir().path() + itchat_msg["FileName"]  # content直接存临时目录路径
-            self._prepare_fn = lambda: itchat_msg.download(self.content)
+            self._prepare_fn = lambda: self._download(itchat_msg)
         elif itchat_msg["Type"] == NOTE and itchat_msg["MsgType"] == 10000:
             if is_group:
                 if any(note_bot_join_group in itchat_msg["Content"] for note_bot_join_group in
@@ -82,7 +83,7 @@ class WechatMessage(ChatMessage):
         elif itchat_msg["Type"] == ATTACHMENT:
             self.ctype = ContextType.FILE
             self.content = TmpDir().path() + itchat_msg["FileName"]  # content直接存临时目录路径
-            self._prepare_fn = lambda: itchat_msg.download(self.content)
+            self._prepare_fn = lambda: self._download(itchat_msg)
         elif itchat_msg["Type"] == SHARING:
             self.ctype = ContextType.SHARING
             self.content = itchat_msg.get("Url")
@@ -90,13 +91,13 @@ class WechatMessage(ChatMessage):
         elif itchat_msg["Type"] == VIDEO:
             self.ctype = ContextType.VIDEO
             self.content = TmpDir().path() + itchat_msg["FileName"]  # content直接存临时目录路径
-            self._prepare_fn = lambda: itchat_msg.download(self.content)
+            self._prepare_fn = lambda: self._download(itchat_msg)
             print("视频文件路径：", self.content)
         elif itchat_msg["Type"] == ContextType.FILE or itchat_msg["Type"] == ContextType.TXT:
             if itchat_msg["FileName"].endswith(".txt"):
                 self.ctype = ContextType.TXT
             self.content = TmpDir().path() + itchat_msg["FileName"]  # content直接存临时目录路径
-            self._prepare_fn = lambda: itchat_msg.download(self.content)
+            self._prepare_fn = lambda: self._download(itchat_msg)
 
         else:
             raise NotImplementedError(
@@ -139,3 +140,9 @@ class WechatMessage(ChatMessage):
             self.actual_user_id = itchat_msg["ActualUserName"]
             if self.ctype not in [ContextType.JOIN_GROUP, ContextType.PATPAT, ContextType.EXIT_GROUP]:
                 self.actual_user_nickname = itchat_msg["ActualNickName"]
+
+    def _download(self, itchat_msg):
+        # 下载失败时itchat返回失败的ReturnValue，这里抛出异常，避免后续处理使用不存在的文件
+        r = itchat_msg.download(self.content)
+        if isinstance(r, ReturnValue) and not r:
+            raise IOError("download {} failed: {}".format(self.content, r["BaseResponse"].get("RawMsg")))
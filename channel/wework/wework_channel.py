@@ -5,7 +5,7 @@ import tempfile
 import threading
 os.environ['ntwork_LOG'] = "ERROR"
 import ntwork
-import requests
+from common import http_client, media_cache
 import uuid
 
 from bridge.context import *
@@ -14,7 +14,7 @@ from channel.chat_channel import ChatChannel
 from channel.wework.wework_message import *
 from channel.wework.wework_message import WeworkMessage
 from common.singleton import singleton
-from common.log import logger
+from common.log import lazy_json, logger
 from common.time_check import time_checker
 from common.utils import compress_imgfile, fsize
 from config import conf
@@ -39,7 +39,7 @@ def download_and_compress_image(url, filename, quality=30):
         os.makedirs(directory)
 
     # 下载图片
-    pic_res = requests.get(url, stream=True)
+    pic_res = http_client.get(url, stream=True)
     image_storage = io.BytesIO()
     for block in pic_res.iter_content(1024):
         image_storage.write(block)
@@ -69,22 +69,15 @@ def download_video(url, filename):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    # 下载视频
-    response = requests.get(url, stream=True)
-    total_size = 0
-
+    # 流式下载视频到缓存，同一url只下载一次
     video_path = os.path.join(directory, f"{filename}.mp4")
-
-    with open(video_path, 'wb') as f:
-        for block in response.iter_content(1024):
-            total_size += len(block)
-
-            # 如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
-            if total_size > 30 * 1024 * 1024:
-                logger.info("[WX] Video is larger than 30MB, skipping...")
-                return None
-
-            f.write(block)
+    try:
+        with media_cache.download_url(url, max_size=30 * 1024 * 1024) as path:
+            media_cache.copy_to(path, video_path)
+    except media_cache.MediaTooLarge:
+        # 如果视频的总大小超过30MB，则停止下载并返回
+        logger.info("[WX] Video is larger than 30MB, skipping...")
+        return None
 
     return video_path
 
@@ -113,6 +106,7 @@ def _check(func):
             return func(self, cmsg)
         if int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
             logger.debug("[WX]history message {} skipped".format(msgId))
+            self.count_drop("history")
             return
         return func(self, cmsg)
 
@@ -239,9 +233,9 @@ class WeworkChannel(ChatChannel):
         elif cmsg.ctype == ContextType.PATPAT:
             logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", lazy_json(cmsg._rawmsg), cmsg)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -249,8 +243,11 @@ class WeworkChannel(ChatChannel):
     @time_checker
     @_check
     def handle_group(self, cmsg: ChatMessage):
+        if not self._prefilter_group(cmsg):
+            return
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
+                self.count_drop("voice_off")
                 return
             logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
         elif cmsg.ctype == ContextType.IMAGE:
@@ -1,42 +1,128 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+_MISSING = object()
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读取会刷新过期时间
+    所有key的有效期相同，因此按最近访问顺序排列的OrderedDict同时也是按过期时间排序的，过期的key总在队首，
+    写入时按批从队首清理，也可以通过sweep_interval开启后台定时清理；max_size大于0时超出部分按LRU淘汰
+    """
+
+    EVICT_BATCH = 64  # 每次写入最多顺带清理的过期key数量
+
+    def __init__(self, expires_in_seconds, max_size=0, sweep_interval=0):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (value, expiry_time)
+        self._lock = threading.Lock()
+        if sweep_interval > 0:
+            _start_sweeper(self, sweep_interval)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        value = self._lookup(key, _MISSING)
+        if value is _MISSING:
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
         return value
 
+    def _lookup(self, key, default):
+        # 未命中时不抛异常，消息查重等高频路径里大部分都是未命中
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            now = time.monotonic()
+            if now > item[1]:
+                del self._data[key]
+                return default
+            self._data[key] = (item[0], now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            return item[0]
+
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            self._evict(now, self.EVICT_BATCH)
+            if self.max_size > 0:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        return self._lookup(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self._data)
+
+    def get(self, key, default=None):
+        return self._lookup(key, default)
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, (_, expiry_time) in self._data.items() if expiry_time >= now]
+
+    def values(self):
+        now = time.monotonic()
+        with self._lock:
+            return [value for value, expiry_time in self._data.values() if expiry_time >= now]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expiry_time) in self._data.items() if expiry_time >= now]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """清理全部过期的key，返回清理的数量"""
+        with self._lock:
+            return self._evict(time.monotonic())
+
+    def _evict(self, now, limit=None):
+        # 调用方需持有self._lock
+        evicted = 0
+        while self._data and (limit is None or evicted < limit):
+            key, (_, expiry_time) = next(iter(self._data.items()))
+            if expiry_time >= now:
+                break
+            del self._data[key]
+            evicted += 1
+        return evicted
+
+    def __repr__(self):
+        return "{}({}, expires_in_seconds={})".format(type(self).__name__, dict(self.items()), self.expires_in_seconds)
+
+
+def _start_sweeper(expired_dict, interval):
+    # 线程只持有弱引用，字典被回收后线程自动退出
+    ref = weakref.ref(expired_dict)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            target = ref()
+            if target is None:
+                return
+            target.sweep()
+            del target
+
+    _thread = threading.Thread(target=run, daemon=True)
+    _thread.start()
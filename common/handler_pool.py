@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+
+
+class HandlerPool(ThreadPoolExecutor):
+    """
+    带排队上限和运行统计的线程池
+    max_queue为已提交但未开始执行的任务上限，0表示不限制，超出时submit抛出queue.Full
+    """
+
+    def __init__(self, name, max_workers, max_queue=0, **kwargs):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name, **kwargs)
+        self.name = name
+        self.max_queue = max_queue
+        self._stats_lock = threading.Lock()
+        self.queued = 0  # 排队中的任务数
+        self.active = 0  # 执行中的任务数
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0  # 因排队已满被拒绝的任务数
+        self.wait_total = 0.0  # 任务从提交到开始执行的累计等待时间，单位秒
+        self.wait_max = 0.0
+
+    def is_full(self):
+        return 0 < self.max_queue <= self.queued
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            if self.is_full():
+                self.rejected += 1
+                raise Full("handler pool {} is full, max_queue={}".format(self.name, self.max_queue))
+            self.queued += 1
+            self.submitted += 1
+        try:
+            future = super().submit(self._run, time.monotonic(), fn, *args, **kwargs)
+        except Exception:
+            with self._stats_lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run(self, submit_time, fn, *args, **kwargs):
+        wait = time.monotonic() - submit_time
+        with self._stats_lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _on_done(self, future):
+        if future.cancelled():  # 未开始就被取消的任务不会进入_run
+            with self._stats_lock:
+                self.queued -= 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            started = self.completed + self.active
+            return {
+                "name": self.name,
+                "max_workers": self._max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "active": self.active,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.wait_total / started * 1000, 2) if started else 0,
+                "max_wait_ms": round(self.wait_max * 1000, 2),
+            }
@@ -0,0 +1,123 @@
+"""
+共享的HTTP客户端
+所有后端(模型、语音、翻译、媒体下载等)共用一个带连接池的requests.Session，同一host的请求复用keep-alive连接，
+不必每次重新做TCP和TLS握手；未指定timeout的请求使用统一的默认超时，建立连接失败时按带随机抖动的退避时间重试
+用法与requests相同：http_client.get(url, ...)、http_client.post(url, ...)
+"""
+import random
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common import metrics
+from config import available_setting, conf
+
+HTTP_SECONDS = metrics.histogram("cow_http_request_seconds", "Outgoing HTTP request latency (until response headers)", ["host", "method", "status"])
+HTTP_ERRORS = metrics.counter("cow_http_errors_total", "Outgoing HTTP requests that failed without a response", ["host", "method", "error"])
+
+
+class JitterRetry(Retry):
+    """
+    指数退避加上随机抖动，避免多个线程在同一时刻重试
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff) if backoff > 0 else 0
+
+
+def _build_session(config):
+    retry = JitterRetry(
+        total=config.get("http_retries", 2),
+        # 只有建立连接失败的请求一定没有发出，所有方法都可以安全重试；读超时和5xx只对幂等方法重试
+        connect=config.get("http_retries", 2),
+        read=config.get("http_retries", 2),
+        status=config.get("http_retries", 2),
+        status_forcelist=(502, 503, 504),
+        backoff_factor=config.get("http_backoff", 0.5),
+        # 不按服务端返回的Retry-After等待，否则可能在处理线程上sleep很久；限流等待交给各后端的熔断和延迟重试
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.get("http_pool_connections", 20),
+        pool_maxsize=config.get("http_pool_maxsize", 20),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # 与直接调用requests.get/post一致，不在请求之间保存cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+_session = None
+_session_settings = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    返回共享的Session，连接池和重试相关配置改变后重新创建
+    """
+    global _session, _session_settings
+    config = conf()
+    settings = tuple(config.get(key) for key in ("http_retries", "http_backoff", "http_pool_connections", "http_pool_maxsize"))
+    session = _session
+    if session is not None and settings == _session_settings:
+        return session
+    with _session_lock:
+        if _session is None or settings != _session_settings:
+            old = _session
+            _session, _session_settings = _build_session(config), settings
+            if old is not None:
+                # 正在使用旧连接的请求不受影响，连接归还时会被关闭
+                old.close()
+        return _session
+
+
+def _metric_hosts(config):
+    # 配置中出现的地址(各模型的api_base、语音服务地址等)对应的host，其他host(如媒体下载的CDN)统计为other，避免标签无限增长
+    hosts = set()
+    for values in (available_setting, config):
+        for value in values.values():
+            if isinstance(value, str) and value.startswith(("http://", "https://")):
+                hosts.add(urlsplit(value).hostname)
+    return frozenset(hosts)
+
+
+def _host_label(url):
+    host = urlsplit(url).hostname or ""
+    return host if host in conf().derive("http_metric_hosts", _metric_hosts) else "other"
+
+
+def request(method, url, **kwargs):
+    if kwargs.get("timeout") is None:
+        kwargs["timeout"] = (conf().get("http_connect_timeout", 5), conf().get("http_read_timeout", 300))
+    session = get_session()
+    if not metrics.ENABLED:
+        return session.request(method, url, **kwargs)
+    host = _host_label(url)
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        HTTP_ERRORS.inc(host=host, method=method.upper(), error=type(e).__name__)
+        raise
+    HTTP_SECONDS.observe(time.perf_counter() - start, host=host, method=method.upper(), status=response.status_code)
+    return response
+
+
+def get(url, params=None, **kwargs):
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request("POST", url, data=data, json=json, **kwargs)
+
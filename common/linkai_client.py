@@ -2,7 +2,7 @@ from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from linkai import LinkAIClient, PushMsg
-from config import conf, pconf, plugin_config, available_setting
+from config import conf, pconf, plugin_config, available_setting, set_overrides
 from plugins import PluginManager
 import time
 
@@ -32,8 +32,10 @@ class ChatClient(LinkAIClient):
         logger.info(f"[LinkAI] 从客户端管理加载远程配置: {config}")
         if config.get("enabled") != "Y":
             return
+        # 插件可能还在后台加载，下面会用到插件实例
+        PluginManager().wait_loaded()
 
-        local_config = conf()
+        local_config = {}
         for key in config.keys():
             if key in available_setting and config.get(key) is not None:
                 local_config[key] = config.get(key)
@@ -49,6 +51,8 @@ class ChatClient(LinkAIClient):
             elif reply_voice_mode == "no_reply_voice":
                 local_config["always_reply_voice"] = False
                 local_config["voice_reply_voice"] = False
+        if local_config:
+            set_overrides(local_config)
 
         if config.get("admin_password"):
             if not plugin_config.get("Godcmd"):
@@ -1,38 +1,209 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
+import time
 
+LOG_FORMAT = "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 
-def _reset_logger(log):
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行json，便于日志平台采集
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, LOG_DATEFMT),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    只在调用线程里合并消息参数，格式化和写文件都交给后台的QueueListener线程
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    按模块设置日志级别，key为模块名(文件名去掉.py)，如{"wechat_channel": "DEBUG", "chat_channel": "WARNING"}
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.default_level = logging.INFO
+        self.levels = {}
+
+    def filter(self, record):
+        if not self.levels:
+            return True
+        return record.levelno >= self.levels.get(record.module, self.default_level)
+
+
+class SampleFilter(logging.Filter):
+    """
+    逐条消息的日志限流，带extra={"sample": key}的日志每个key每秒最多输出rate条，
+    被丢弃的条数附在下一条输出的日志后面
+    """
+
+    def __init__(self, rate=0):
+        super().__init__()
+        self.rate = rate  # 0表示不限流
+        self._buckets = {}  # key -> [当前秒, 已输出条数, 丢弃条数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None or self.rate <= 0:
+            return True
+        now = int(time.monotonic())
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket[0] != now:
+                suppressed = bucket[2] if bucket else 0
+                bucket = self._buckets[key] = [now, 0, suppressed]
+            if bucket[1] >= self.rate:
+                bucket[2] += 1
+                return False
+            bucket[1] += 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = "{} (sampled, {} suppressed)".format(record.msg, suppressed)
+        return True
+
+
+class lazy_json(object):
+    """
+    日志参数延迟序列化，只有日志真正输出时才会调用json.dumps
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, ensure_ascii=False, default=str)
+
+
+_module_filter = ModuleLevelFilter()
+_sample_filter = SampleFilter()
+_listener = None
+_handler_settings = None
+
+
+def _build_handlers(log_file, fmt, max_bytes, backup_count, rotate_when):
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+    console_handle = logging.StreamHandler(sys.stdout)
+    console_handle.setFormatter(formatter)
+    if rotate_when:
+        file_handle = logging.handlers.TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    elif max_bytes > 0:
+        file_handle = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handle = logging.FileHandler(log_file, encoding="utf-8")
+    file_handle.setFormatter(formatter)
+    return [file_handle, console_handle]
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def _reset_logger(log, log_file="run.log", fmt="text", max_bytes=0, backup_count=5, rotate_when="", use_async=True):
+    global _listener
+    _stop_listener()
     for handler in log.handlers:
         handler.close()
         log.removeHandler(handler)
         del handler
     log.handlers.clear()
     log.propagate = False
-    console_handle = logging.StreamHandler(sys.stdout)
-    console_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-    )
-    file_handle = logging.FileHandler("run.log", encoding="utf-8")
-    file_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
+    handlers = _build_handlers(log_file, fmt, max_bytes, backup_count, rotate_when)
+    if use_async:
+        # 调用方只把日志放入队列，写控制台和文件在后台线程完成
+        log_queue = queue.SimpleQueue()
+        log.addHandler(_AsyncQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+    else:
+        for handler in handlers:
+            log.addHandler(handler)
+    if _module_filter not in log.filters:
+        log.addFilter(_module_filter)
+        log.addFilter(_sample_filter)
+
+
+def setup_logging(config):
+    """
+    按配置调整日志，配置重载时再次调用；输出相关配置未变化时只更新级别和限流
+    """
+    settings = (
+        config.get("log_file", "run.log"),
+        config.get("log_format", "text"),
+        config.get("log_max_bytes", 0),
+        config.get("log_backup_count", 5),
+        config.get("log_rotate_when", ""),
+        config.get("log_async", True),
     )
-    log.addHandler(file_handle)
-    log.addHandler(console_handle)
+    global _handler_settings
+    if settings != _handler_settings:
+        _reset_logger(logger, *settings)
+        _handler_settings = settings
+    level = logging.DEBUG if config.get("debug", False) else logging.INFO
+    module_levels = {}
+    for module, module_level in (config.get("log_levels") or {}).items():
+        module_levels[module] = logging.getLevelName(module_level.upper()) if isinstance(module_level, str) else module_level
+    module_levels = {module: lv for module, lv in module_levels.items() if isinstance(lv, int)}
+    _module_filter.levels = module_levels
+    _sample_filter.rate = config.get("log_sample_rate", 0)
+    set_log_level(level)
+
+
+def set_log_level(level):
+    """
+    修改全局日志级别，log_levels中单独配置的模块不受影响
+    """
+    _module_filter.default_level = level
+    # logger本身取最低级别，未开启的模块由_module_filter过滤
+    logger.setLevel(min([level] + list(_module_filter.levels.values())))
+
+
+def get_log_level():
+    return _module_filter.default_level
 
 
 def _get_logger():
+    global _handler_settings
     log = logging.getLogger("log")
     _reset_logger(log)
+    _handler_settings = ("run.log", "text", 0, 5, "", True)
     log.setLevel(logging.INFO)
     return log
 
 
 # 日志句柄
 logger = _get_logger()
+atexit.register(_stop_listener)
@@ -0,0 +1,215 @@
+"""
+媒体文件的流式下载和缓存
+- 下载内容按CHUNK_SIZE大小的块直接写入磁盘，不在内存中保存完整文件；超过media_download_max_mb时中止下载
+- 缓存文件以内容的sha256命名，同一URL或同一条消息的媒体只下载一次，内容相同的文件只保存一份；
+  缓存总大小超过media_cache_max_mb时删除最久未使用的文件
+- with块内使用的缓存文件不会被淘汰，离开with块后才可能被删除
+用法: with media_cache.download_url(url) as path，或with media_cache.fetch(key, open_stream) as path下载任意数据块迭代器
+"""
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from common import http_client, metrics
+from common.log import logger
+from common.tmp_dir import TmpDir
+from config import conf
+
+CHUNK_SIZE = 256 * 1024
+
+MEDIA_CACHE = metrics.counter("cow_media_cache_total", "Media fetches served from the cache or downloaded", ["result"])
+
+
+class MediaTooLarge(IOError):
+    pass
+
+
+def default_max_size():
+    return conf().get("media_download_max_mb", 0) * 1024 * 1024
+
+
+def iter_response(response, max_size=None):
+    """
+    逐块读取requests的stream响应，响应头中的Content-Length超过max_size时不开始下载
+    """
+    if max_size is None:
+        max_size = default_max_size()
+    try:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length")
+        if max_size and length and length.isdigit() and int(length) > max_size:
+            raise MediaTooLarge("media size {} exceeds {} bytes".format(length, max_size))
+        for chunk in response.iter_content(CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
+
+
+def write_stream(chunks, path, max_size=None):
+    """
+    把数据块逐块写入path，返回(大小, sha256)；超过max_size字节时删除已写入的部分并抛出MediaTooLarge
+    """
+    if max_size is None:
+        max_size = default_max_size()
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise MediaTooLarge("media size exceeds {} bytes".format(max_size))
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return size, digest.hexdigest()
+
+
+def copy_to(path, dest):
+    """
+    把缓存文件复制到dest，不在内存中读入整个文件
+    """
+    shutil.copyfile(path, dest)
+    return dest
+
+
+class MediaCache(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._keys = {}  # key -> 缓存文件路径
+        self._blobs = OrderedDict()  # 缓存文件路径 -> 大小，按最近使用排序
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}  # 正在下载的key -> (锁, 等待数)
+        self._pins = {}  # 正在使用的缓存文件路径 -> 使用数，不会被淘汰
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory), key=lambda n: os.path.getmtime(os.path.join(directory, n))):
+            path = os.path.join(directory, name)
+            if name.startswith("."):
+                os.remove(path)  # 上次中断的下载
+            elif os.path.isfile(path):
+                self._blobs[path] = os.path.getsize(path)
+                self._size += self._blobs[path]
+
+    def _get_pinned(self, key):
+        with self._lock:
+            path = self._keys.get(key)
+            if path is None:
+                return None
+            if path not in self._blobs or not os.path.exists(path):
+                self._keys.pop(key, None)
+                return None
+            self._blobs.move_to_end(path)
+            self._pins[path] = self._pins.get(path, 0) + 1
+            return path
+
+    def _unpin(self, path):
+        with self._lock:
+            if self._pins[path] > 1:
+                self._pins[path] -= 1
+            else:
+                del self._pins[path]
+                self._evict()
+
+    @contextmanager
+    def fetch(self, key, open_stream, suffix="", max_size=None):
+        """
+        with块内得到key对应的缓存文件路径，不在缓存中时调用open_stream()得到数据块迭代器并下载，
+        同一个key同时只会下载一次；with块结束前该文件不会被淘汰
+        """
+        path = self._fetch_pinned(key, open_stream, suffix, max_size)
+        try:
+            yield path
+        finally:
+            self._unpin(path)
+
+    def _fetch_pinned(self, key, open_stream, suffix, max_size):
+        path = self._get_pinned(key)
+        if path is not None:
+            MEDIA_CACHE.inc(result="hit")
+            return path
+        with self._lock:
+            lock, waiters = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, waiters + 1)
+        try:
+            with lock:
+                path = self._get_pinned(key)
+                if path is not None:
+                    MEDIA_CACHE.inc(result="hit")
+                    return path
+                MEDIA_CACHE.inc(result="miss")
+                return self._download(key, open_stream, suffix, max_size)
+        finally:
+            with self._lock:
+                lock, waiters = self._key_locks[key]
+                if waiters > 1:
+                    self._key_locks[key] = (lock, waiters - 1)
+                else:
+                    del self._key_locks[key]
+
+    def _download(self, key, open_stream, suffix, max_size):
+        tmp_path = os.path.join(self.directory, "." + uuid.uuid4().hex)
+        size, digest = write_stream(open_stream(), tmp_path, max_size)
+        path = os.path.join(self.directory, digest + suffix)
+        with self._lock:
+            if path in self._blobs and os.path.exists(path):
+                os.remove(tmp_path)  # 内容相同的文件已经缓存
+            else:
+                os.replace(tmp_path, path)
+                self._size += size - self._blobs.get(path, 0)
+                self._blobs[path] = size
+            self._blobs.move_to_end(path)
+            if size:
+                self._keys[key] = path
+            self._pins[path] = self._pins.get(path, 0) + 1
+            self._evict()
+        return path
+
+    def _evict(self):
+        # 调用方需持有self._lock，从最久未使用的文件开始删除，跳过正在使用的文件
+        for path in list(self._blobs):
+            if self._size <= self.max_bytes:
+                break
+            if path in self._pins:
+                continue
+            self._size -= self._blobs.pop(path)
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("[media_cache] failed to remove {}: {}".format(path, e))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> MediaCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MediaCache(os.path.join(TmpDir().path(), "media_cache"), conf().get("media_cache_max_mb", 256) * 1024 * 1024)
+    return _cache
+
+
+def fetch(key, open_stream, suffix="", max_size=None):
+    return get_cache().fetch(key, open_stream, suffix, max_size)
+
+
+def download_url(url, suffix="", max_size=None, **kwargs):
+    """
+    流式下载url到缓存，with块内得到缓存文件路径，同一url只下载一次
+    """
+    return fetch(url, lambda: iter_response(http_client.get(url, stream=True, **kwargs), max_size), suffix, max_size)
@@ -0,0 +1,257 @@
+"""
+消息处理链路的运行指标，输出为Prometheus文本格式
+metrics_enabled关闭时所有记录操作直接返回；开启后可以通过metrics_port的本地HTTP服务、
+web类通道(wechatmp、wechatcom、feishu)自带服务的/metrics路径，或定期写入metrics_file获取
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from common.log import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ENABLED = False  # 调用频繁的地方可以先判断metrics.ENABLED，关闭时连标签参数都不用构造
+
+
+class _Metric(object):
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # 标签值tuple -> 数值
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type_name)]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+    def _render_items(self, items):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_items(self, items):
+        return ["{}{} {}".format(self.name, self._format_labels(key), _format_value(value)) for key, value in items]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _render_items(self, items):
+        return ["{}{} {}".format(self.name, self._format_labels(key), _format_value(value)) for key, value in items]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # [各桶计数, 总和, 次数]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] += 1
+                    break
+            item[1] += value
+            item[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, ("le", _format_value(bound))), cumulative))
+            lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, ("le", "+Inf")), count))
+            lines.append("{}_sum{} {}".format(self.name, self._format_labels(key), _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, self._format_labels(key), count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric_cls, name, documentation, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render():
+    return REGISTRY.render()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# 消息处理链路的指标
+MESSAGES_RECEIVED = counter("cow_messages_received_total", "Messages that reached context composition", ["channel", "ctype"])
+MESSAGES_DROPPED = counter("cow_messages_dropped_total", "Messages dropped before entering the session queue", ["channel", "stage"])
+STAGE_SECONDS = histogram("cow_stage_seconds", "Time spent in each stage of the message pipeline", ["channel", "stage", "ctype"])
+BOT_SECONDS = histogram("cow_bot_request_seconds", "Bot call latency", ["bot", "kind"])
+BOT_ERRORS = counter("cow_bot_errors_total", "Bot calls that raised an exception", ["bot", "kind"])
+PLUGIN_SECONDS = histogram("cow_plugin_seconds", "Plugin event handler latency", ["event", "plugin"])
+SEND_RETRIES = counter("cow_send_retries_total", "Reply send retries", ["channel", "reply_type"])
+SEND_FAILURES = counter("cow_send_failures_total", "Replies that could not be sent", ["channel", "reply_type"])
+
+
+class WebMetricsController(object):
+    """
+    web.py通道的/metrics路径
+    """
+
+    def GET(self):
+        import web
+
+        if not ENABLED:
+            raise web.notfound()
+        web.header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return render()
+
+
+_started = False
+
+
+def setup_metrics(config):
+    """
+    按配置开启指标收集和导出，只在启动时生效
+    """
+    global ENABLED, _started
+    ENABLED = bool(config.get("metrics_enabled", False))
+    if not ENABLED or _started:
+        return
+    _started = True
+    port = config.get("metrics_port", 0)
+    if port:
+        _start_http_server(config.get("metrics_host", "127.0.0.1"), port)
+    path = config.get("metrics_file", "")
+    if path:
+        _start_file_exporter(path, config.get("metrics_file_interval", 15))
+
+
+def _start_http_server(host, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        logger.error("[metrics] failed to listen on {}:{}: {}".format(host, port, e))
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("[metrics] serving on http://{}:{}/metrics".format(host, port))
+
+
+def _start_file_exporter(path, interval):
+    def run():
+        while True:
+            try:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(render())
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning("[metrics] failed to write {}: {}".format(path, e))
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
+    logger.info("[metrics] writing to {} every {}s".format(path, interval))
@@ -0,0 +1,258 @@
+"""
+后端调用的熔断、重试预算和延迟重试
+- 熔断器：某个后端连续失败circuit_failure_threshold次后熔断，circuit_reset_seconds内的调用直接失败，不再占用处理线程；
+  到时间后放行一次试探调用，成功则恢复，失败则继续熔断
+- 重试预算：每个后端在retry_budget_window秒内的重试次数不超过请求数的retry_budget_ratio(至少retry_budget_min次)，
+  后端故障时不会因为重试把请求量放大数倍
+- 延迟重试：call_later把重试放到定时器上，到时间后在后台线程池执行，调用方线程不用sleep等待
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from queue import Full
+
+from common import metrics
+from common.handler_pool import HandlerPool
+from common.log import logger
+from config import conf
+
+CIRCUIT_STATE = metrics.gauge("cow_circuit_state", "Circuit breaker state per backend (0 closed, 1 half open, 2 open)", ["backend"])
+CIRCUIT_REJECTED = metrics.counter("cow_circuit_rejected_total", "Calls rejected because the circuit was open", ["backend"])
+RETRIES = metrics.counter("cow_retries_total", "Retry decisions per backend", ["backend", "outcome"])
+FAILOVERS = metrics.counter("cow_failovers_total", "Chat requests served by the fallback bot", ["primary", "fallback"])
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self._trial_running = False  # 半开状态下是否已有试探调用
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("[resilience] circuit {} {} -> {}".format(self.name, self.state, state))
+            self.state = state
+            CIRCUIT_STATE.set(self._STATE_VALUES[state], backend=self.name)
+
+    def available(self):
+        """
+        不占用试探名额地判断后端当前是否可用
+        """
+        if self.state == self.CLOSED:
+            return True
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= conf().get("circuit_reset_seconds", 30)
+
+    def allow(self):
+        """
+        发起调用前调用，返回False时应直接失败
+        """
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        reset_seconds = conf().get("circuit_reset_seconds", 30)
+        with self._lock:
+            if self.state == self.OPEN and now - self.opened_at >= reset_seconds:
+                self._set_state(self.HALF_OPEN)
+                self._trial_running = False
+            # 试探调用没有记录结果(比如调用方异常退出)时，超过reset_seconds后允许新的试探
+            if self.state == self.HALF_OPEN and (not self._trial_running or now - self._trial_started >= reset_seconds):
+                self._trial_running = True
+                self._trial_started = now
+                return True
+        CIRCUIT_REJECTED.inc(backend=self.name)
+        return False
+
+    def record_success(self):
+        if self.state == self.CLOSED and self.failures == 0:
+            return
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= conf().get("circuit_failure_threshold", 5):
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class RetryBudget(object):
+    def __init__(self, name):
+        self.name = name
+        self._requests = deque()  # 窗口内请求的时间
+        self._retries = deque()  # 窗口内重试的时间
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        start = now - conf().get("retry_budget_window", 10)
+        for q in (self._requests, self._retries):
+            while q and q[0] < start:
+                q.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def acquire(self):
+        """
+        申请一次重试，预算用完时返回False
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            limit = max(conf().get("retry_budget_min", 3), len(self._requests) * conf().get("retry_budget_ratio", 0.2))
+            if len(self._retries) >= limit:
+                RETRIES.inc(backend=self.name, outcome="budget_exhausted")
+                return False
+            self._retries.append(now)
+        RETRIES.inc(backend=self.name, outcome="retried")
+        return True
+
+
+class CallOutcome(object):
+    failed = False  # 最后一次请求(包括重试)失败或被熔断拒绝
+
+
+_local = threading.local()
+
+
+@contextmanager
+def track_call(name):
+    """
+    记录当前线程在with块内对后端name的调用结果，不受其他线程同时调用的影响
+    """
+    outcomes = _local.__dict__.setdefault("outcomes", {})
+    previous = outcomes.get(name)
+    outcome = outcomes[name] = CallOutcome()
+    try:
+        yield outcome
+    finally:
+        if previous is None:
+            del outcomes[name]
+        else:
+            outcomes[name] = previous
+
+
+def _set_outcome(name, failed):
+    outcome = getattr(_local, "outcomes", {}).get(name)
+    if outcome is not None:
+        outcome.failed = failed
+
+
+class Backend(object):
+    """
+    一个后端的熔断器和重试预算
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.budget = RetryBudget(name)
+
+    def allow(self):
+        """
+        发起一次请求(包括重试)前调用，返回False表示后端已熔断
+        """
+        if not self.breaker.allow():
+            _set_outcome(self.name, True)
+            return False
+        self.budget.record_request()
+        return True
+
+    def record_success(self):
+        _set_outcome(self.name, False)
+        self.breaker.record_success()
+
+    def record_failure(self):
+        _set_outcome(self.name, True)
+        self.breaker.record_failure()
+
+    def can_retry(self, retry_count, max_retries=2):
+        return retry_count < max_retries and self.breaker.available() and self.budget.acquire()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def backend(name) -> Backend:
+    b = _backends.get(name)
+    if b is None:
+        with _backends_lock:
+            b = _backends.get(name)
+            if b is None:
+                b = _backends[name] = Backend(name)
+    return b
+
+
+def get_states():
+    """
+    返回{后端名: (熔断状态, 连续失败次数)}
+    """
+    return {name: (b.breaker.state, b.breaker.failures) for name, b in list(_backends.items())}
+
+
+class DelayedExecutor(object):
+    """
+    延迟任务调度，只用一个定时线程等待，任务到期后交给线程池执行
+    """
+
+    def __init__(self, name, max_workers, max_queue=0):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = HandlerPool(name, max_workers, max_queue)
+        threading.Thread(target=self._loop, name=name + "_timer", daemon=True).start()
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), fn, args, kwargs))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn, args, kwargs = heapq.heappop(self._heap)
+            try:
+                self._pool.submit(fn, *args, **kwargs)
+            except Full:
+                logger.warning("[resilience] delayed retry pool is full, drop {}".format(getattr(fn, "__name__", fn)))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def call_later(delay, fn, *args, **kwargs):
+    """
+    delay秒后在后台线程执行fn，不阻塞当前线程
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = DelayedExecutor("delayed_retry", conf().get("delayed_retry_workers", 2), conf().get("delayed_retry_queue", 1000))
+    _executor.call_later(delay, fn, *args, **kwargs)
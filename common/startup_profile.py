@@ -0,0 +1,81 @@
+"""
+启动耗时分析，用法: python app.py --profile-startup [--top 30]
+在子进程中以python -X importtime执行与正常启动相同的导入、读取配置、创建通道和加载插件步骤(不登录、不启动通道)，
+输出各阶段耗时以及耗时最多的模块
+"""
+import os
+import subprocess
+import sys
+
+# 子进程执行的启动步骤，各阶段耗时以STARTUP_PHASE开头的行写到stderr
+_CHILD_SCRIPT = r"""
+import sys, time
+_start = time.perf_counter()
+_last = _start
+def _phase(name):
+    global _last
+    now = time.perf_counter()
+    sys.stderr.write("STARTUP_PHASE|%s|%.1f\n" % (name, (now - _last) * 1000))
+    _last = now
+import app
+_phase("import app")
+from config import conf, load_config
+load_config()
+_phase("load config")
+from channel import channel_factory
+channel_name = conf().get("channel_type", "wx")
+channel_factory.create_channel(channel_name)
+_phase("create channel " + channel_name)
+from plugins import PluginManager
+PluginManager().load_plugins()
+_phase("load plugins")
+sys.stderr.write("STARTUP_PHASE|total|%.1f\n" % ((time.perf_counter() - _start) * 1000))
+sys.stderr.flush()
+import os
+os._exit(0)
+"""
+
+
+def _parse(stderr):
+    phases = []
+    imports = []  # (模块名, 自身耗时ms, 累计耗时ms, 层级)
+    for line in stderr.splitlines():
+        if line.startswith("STARTUP_PHASE|"):
+            _, name, ms = line.split("|")
+            phases.append((name, float(ms)))
+        elif line.startswith("import time:") and "self [us]" not in line:
+            parts = line[len("import time:"):].split("|")
+            if len(parts) != 3:
+                continue
+            name = parts[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            imports.append((name.strip(), int(parts[0]) / 1000, int(parts[1]) / 1000, depth))
+    return phases, imports
+
+
+def profile_startup(top=None):
+    if top is None:
+        top = 30
+        if "--top" in sys.argv:
+            top = int(sys.argv[sys.argv.index("--top") + 1])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD_SCRIPT], cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    phases, imports = _parse(proc.stderr)
+    if proc.returncode != 0 or not phases or phases[-1][0] != "total":
+        # 启动步骤出错，原样输出子进程中非导入耗时的内容
+        print("startup failed:")
+        print("\n".join(line for line in proc.stderr.splitlines() if not line.startswith(("import time:", "STARTUP_PHASE|"))))
+        return
+    print("startup phases:")
+    for name, ms in phases:
+        print("  {:<32}{:>10.1f} ms".format(name, ms))
+    print("\nslowest modules by cumulative import time (top {}):".format(top))
+    print("  {:>10} {:>10}  {}".format("self ms", "total ms", "module"))
+    for name, self_ms, total_ms, depth in sorted(imports, key=lambda item: item[2], reverse=True)[:top]:
+        print("  {:>10.1f} {:>10.1f}  {}{}".format(self_ms, total_ms, "  " * depth, name))
+    print("\nslowest modules by self import time (top {}):".format(top))
+    for name, self_ms, total_ms, depth in sorted(imports, key=lambda item: item[1], reverse=True)[:top]:
+        print("  {:>10.1f} {:>10.1f}  {}".format(self_ms, total_ms, name))
+    print("\n{} modules imported".format(len(imports)))
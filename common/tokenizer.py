@@ -0,0 +1,172 @@
+"""
+模型名到token编码器的注册表
+每个模型名只解析一次，结果(包括解析失败)会被缓存；无法加载编码器的模型返回None，由调用方按字符数计数
+"""
+import hashlib
+import os
+import threading
+
+from common import const
+from common.log import logger
+from config import conf
+
+TIKTOKEN_BLOB_URL = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+# 按字符计数的模型及前缀
+CHARACTER_MODELS = ["wenxin", "xunfei"]
+CHARACTER_MODEL_PREFIXES = [const.GEMINI]
+
+# 没有对应tiktoken编码的模型，按别名计数
+MODEL_ALIASES = {
+    "gpt-3.5-turbo-0301": "gpt-3.5-turbo",
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-3.5-turbo-1106": "gpt-3.5-turbo",
+    "moonshot": "gpt-3.5-turbo",
+    const.LINKAI_35: "gpt-3.5-turbo",
+}
+for _model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+               "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+               "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+               const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
+    MODEL_ALIASES[_model] = "gpt-4"
+MODEL_PREFIX_ALIASES = [("claude-3", "gpt-3.5-turbo")]
+
+# 聊天格式下每条消息及name字段的额外token数
+MESSAGE_OVERHEAD = {
+    "gpt-3.5-turbo": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-4": (3, 1),
+}
+
+
+class Tokenizer(object):
+    def __init__(self, encoding, tokens_per_message=3, tokens_per_name=1):
+        self.encoding = encoding
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_name = tokens_per_name
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+_factories = []  # [(匹配函数, 返回Tokenizer或None的工厂函数)]，后注册的优先
+_tokenizers = {}  # 模型名 -> Tokenizer或None
+_encodings = {}  # 编码名/模型名 -> tiktoken编码器或None
+_lock = threading.RLock()
+
+
+def register_tokenizer(match, factory):
+    """
+    注册自定义编码器，match为模型名前缀或接收模型名返回bool的函数，factory接收模型名返回Tokenizer，返回None表示按字符计数
+    """
+    if isinstance(match, str):
+        prefix = match
+        match = lambda model: model.startswith(prefix)
+    with _lock:
+        _factories.append((match, factory))
+        _tokenizers.clear()
+
+
+def get_tokenizer(model):
+    """
+    返回模型对应的Tokenizer，编码器不可用时返回None
+    """
+    tokenizer = _tokenizers.get(model, _tokenizers)
+    if tokenizer is not _tokenizers:
+        return tokenizer
+    with _lock:
+        if model not in _tokenizers:
+            _tokenizers[model] = _resolve(model)
+        return _tokenizers[model]
+
+
+def warm_up(models):
+    """
+    预先加载模型对应的编码器，避免首条消息回复时才读取BPE文件
+    """
+    for model in models:
+        if model:
+            get_tokenizer(model)
+
+
+def _resolve(model):
+    for match, factory in reversed(_factories):
+        if match(model):
+            return factory(model)
+    if model in CHARACTER_MODELS or any(model.startswith(prefix) for prefix in CHARACTER_MODEL_PREFIXES):
+        return None
+    base_model = MODEL_ALIASES.get(model)
+    if base_model is None:
+        base_model = next((alias for prefix, alias in MODEL_PREFIX_ALIASES if model.startswith(prefix)), model)
+    if base_model not in MESSAGE_OVERHEAD:
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        base_model = "gpt-3.5-turbo"
+    encoding = get_encoding(base_model)
+    if encoding is None:
+        return None
+    tokens_per_message, tokens_per_name = MESSAGE_OVERHEAD[base_model]
+    return Tokenizer(encoding, tokens_per_message, tokens_per_name)
+
+
+def get_encoding(model):
+    """
+    返回模型对应的tiktoken编码器，未知模型使用cl100k_base，加载失败时返回None
+    """
+    encoding = _encodings.get(model, _encodings)
+    if encoding is not _encodings:
+        return encoding
+    with _lock:
+        if model not in _encodings:
+            _encodings[model] = _load_encoding(model)
+        return _encodings[model]
+
+
+def _load_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warn("[tokenizer] tiktoken is not installed, counting tokens by character")
+        return None
+    _use_local_bpe_dir()
+    try:
+        encoding_name = tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        logger.debug("Warning: model not found. Using cl100k_base encoding.")
+        encoding_name = "cl100k_base"
+    # 多个模型共用同一个编码，按编码名缓存，加载失败也只尝试一次
+    if encoding_name not in _encodings:
+        try:
+            _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logger.warn("[tokenizer] failed to load encoding {}, counting tokens by character: {}".format(encoding_name, e))
+            _encodings[encoding_name] = None
+    return _encodings[encoding_name]
+
+
+_local_bpe_dir = None
+
+
+def _use_local_bpe_dir():
+    """
+    tiktoken_cache_dir指向本地BPE目录，供离线环境使用；目录中可以是tiktoken自身的缓存文件，
+    也可以是直接下载的cl100k_base.tiktoken这类文件，后者会按tiktoken缓存的命名方式链接一份
+    """
+    global _local_bpe_dir
+    bpe_dir = conf().get("tiktoken_cache_dir", "")
+    if not bpe_dir or bpe_dir == _local_bpe_dir:
+        return
+    _local_bpe_dir = bpe_dir
+    os.environ["TIKTOKEN_CACHE_DIR"] = bpe_dir
+    if not os.path.isdir(bpe_dir):
+        logger.warn("[tokenizer] tiktoken_cache_dir {} does not exist".format(bpe_dir))
+        return
+    for filename in os.listdir(bpe_dir):
+        if not filename.endswith(".tiktoken"):
+            continue
+        cache_key = hashlib.sha1(TIKTOKEN_BLOB_URL.format(filename[: -len(".tiktoken")]).encode()).hexdigest()
+        cache_path = os.path.join(bpe_dir, cache_key)
+        if os.path.exists(cache_path):
+            continue
+        try:
+            os.symlink(filename, cache_path)
+        except OSError as e:
+            logger.warn("[tokenizer] failed to link {} in {}: {}".format(filename, bpe_dir, e))
@@ -0,0 +1,61 @@
+"""
+触发词匹配
+群聊/私聊前缀、关键词和群名白名单关键词预先编译成正则，每条消息只需一次匹配；
+匹配器挂在配置快照上，配置重载后才会重新编译
+"""
+import re
+from functools import lru_cache
+
+
+class PrefixMatcher(object):
+    """
+    前缀匹配，返回列表中第一个匹配的前缀，与逐个startswith的结果一致
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = [p for p in (prefixes or []) if isinstance(p, str)]
+        # 正则的分支按书写顺序尝试，因此match到的就是列表中第一个匹配的前缀
+        self._pattern = re.compile("|".join(map(re.escape, self.prefixes))) if self.prefixes else None
+
+    def match(self, content):
+        if self._pattern is None or not isinstance(content, str):
+            return None
+        m = self._pattern.match(content)
+        return m.group(0) if m else None
+
+
+class KeywordMatcher(object):
+    """
+    关键词包含判断，命中任一关键词时返回True，否则返回None
+    """
+
+    def __init__(self, keywords):
+        self.keywords = [k for k in (keywords or []) if isinstance(k, str)]
+        self._pattern = re.compile("|".join(map(re.escape, self.keywords))) if self.keywords else None
+
+    def match(self, content):
+        if self._pattern is None or not isinstance(content, str):
+            return None
+        return True if self._pattern.search(content) else None
+
+
+def prefix_matcher(config, key, default=None):
+    """
+    返回配置项key对应的PrefixMatcher，按配置快照缓存
+    """
+    return config.derive("prefix_matcher:" + key, lambda c: PrefixMatcher(c.get(key, default)))
+
+
+def keyword_matcher(config, key, default=None):
+    """
+    返回配置项key对应的KeywordMatcher，按配置快照缓存
+    """
+    return config.derive("keyword_matcher:" + key, lambda c: KeywordMatcher(c.get(key, default)))
+
+
+@lru_cache(maxsize=1024)
+def mention_pattern(name):
+    """
+    @某人后跟空格或\u2005的正则，按昵称缓存
+    """
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
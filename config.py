@@ -1,10 +1,9 @@
 # encoding:utf-8
 import json
-import logging
 import os
 import pickle
 import copy
-from common.log import logger
+from common.log import logger, setup_logging
 import schedule
 import time
 import threading
@@ -51,13 +50,51 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    # 分阶段处理消息的线程池，可选text(文本对话)、voice(语音识别)、video(视频处理)、media(图片文件消息及媒体回复发送)
+    # max_workers为线程数，max_queue为排队上限，0为不限制，未配置的项使用默认值
+    "handler_pools": {"text": {"max_workers": 8, "max_queue": 0}, "voice": {"max_workers": 4, "max_queue": 0}},
+    # 消息排队上限，0为不限制，#开头的管理命令不受限制
+    "session_queue_size": 0,  # 单个会话最多排队的消息数
+    "global_queue_size": 0,  # 所有会话合计最多排队的消息数
+    # 队列满时的处理策略: drop_oldest(丢弃该会话最早的消息), drop_newest(丢弃新消息), coalesce(与同一用户的上一条文本合并，无法合并时丢弃新消息), busy(丢弃新消息并回复繁忙提示)
+    "queue_overflow_policy": "drop_oldest",
+    "queue_busy_reply": "当前消息较多，请稍后再试",
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "memory",  # 会话存储: memory(进程内，重启后丢失), sqlite(单机持久化), redis(兼容redis协议的服务，多进程共享)
+    "session_store_path": "",  # sqlite数据库文件路径，为空时使用数据目录下的sessions.db
+    "session_store_url": "redis://127.0.0.1:6379/0",  # redis连接地址
+    "session_cache_seconds": 300,  # 持久化存储时进程内缓存活跃会话的时间，多进程共享会话时建议调小或设为0
+    "session_cache_size": 10000,  # 持久化存储时进程内最多缓存的会话数
+    "session_flush_interval": 1,  # 会话改动批量写入存储的间隔，单位秒
+    "session_flush_batch": 200,  # 待写入会话达到该数量时立即写入
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "tiktoken_cache_dir": "",  # 本地tiktoken BPE文件目录，离线环境可放入cl100k_base.tiktoken等文件，为空时按tiktoken默认方式下载缓存
+    "tokenizer_warmup": True,  # 启动时预加载当前模型的token编码器，避免首条回复变慢
+    "bridge_warmup": [],  # 启动时在后台提前创建的bot，可选chat、voice_to_text、text_to_voice、translate
+    "bot_probe_timeout": 5,  # 后端健康检查(#probe)的请求超时时间，单位秒
+    # 共享HTTP客户端配置，各后端的请求复用同一个连接池
+    "http_pool_connections": 20,  # 连接池缓存的host数量
+    "http_pool_maxsize": 20,  # 每个host保持的keep-alive连接数
+    "http_connect_timeout": 5,  # 请求未指定timeout时的连接超时，单位秒
+    "http_read_timeout": 300,  # 请求未指定timeout时的读取超时，单位秒
+    "http_retries": 2,  # 连接失败的重试次数；GET等幂等请求在读超时、502/503/504时也会重试
+    "http_backoff": 0.5,  # 重试退避系数，第n次重试前等待backoff*2^(n-1)秒再加随机抖动
+    # 后端熔断和重试配置
+    "circuit_failure_threshold": 5,  # 后端连续失败多少次后熔断，熔断期间的请求直接失败
+    "circuit_reset_seconds": 30,  # 熔断多少秒后放行一次试探请求，成功则恢复
+    "retry_budget_ratio": 0.2,  # 每个后端在窗口内的重试次数上限为请求数的比例
+    "retry_budget_min": 3,  # 窗口内至少允许的重试次数
+    "retry_budget_window": 10,  # 重试预算的统计窗口，单位秒
+    "fallback_bot_type": "",  # 主模型熔断或调用失败时改用的备用bot类型，如linkai、chatGPT，为空时不切换
+    "delayed_retry_workers": 2,  # 执行延迟重试(如消息发送失败后的重试)的线程数
+    "delayed_retry_queue": 1000,  # 到期待执行的延迟重试上限
+    "media_download_max_mb": 0,  # 下载图片、视频等媒体文件的大小上限，单位MB，0表示不限制
+    "media_cache_max_mb": 256,  # 媒体文件缓存(tmp/media_cache)的总大小上限，单位MB，超过时删除最久未使用的文件
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -129,6 +166,9 @@ available_setting = {
     "baidu_translate_app_key": "",  # 百度翻译api的秘钥
     # itchat的配置
     "hot_reload": False,  # 是否开启热重载
+    "itchat_enrich_workers": 4,  # 个人微信收到消息后查询联系人、格式化消息的线程数，同一会话的消息由同一线程按顺序处理
+    "itchat_dispatch_workers": 4,  # 个人微信分发消息到回复处理函数的线程数，同一会话的消息按顺序分发
+    "itchat_pipeline_queue": 100,  # 个人微信上述每个线程的待处理队列上限，队列满时前一阶段等待
     # wechaty的配置
     "wechaty_puppet_service_token": "",  # wechaty的token
     # wechatmp的配置
@@ -162,11 +202,32 @@ available_setting = {
     "channel_type": "",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app,dingtalk}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
+    "log_file": "run.log",  # 日志文件路径
+    "log_format": "text",  # 日志格式，支持：{text,json}
+    "log_async": True,  # 是否由后台线程写日志，开启后记录日志不会阻塞消息处理
+    "log_max_bytes": 0,  # 日志文件超过该大小时轮转，单位字节，0为不按大小轮转
+    "log_rotate_when": "",  # 按时间轮转日志，如midnight、H，优先于log_max_bytes
+    "log_backup_count": 5,  # 轮转时保留的历史日志文件数
+    "log_levels": {},  # 按模块设置日志级别，如{"wechat_channel": "DEBUG"}
+    "log_sample_rate": 0,  # 逐条消息日志每类每秒最多输出的条数，0为不限制
+    "metrics_enabled": False,  # 是否收集消息处理链路的运行指标
+    "metrics_port": 0,  # 指标的本地HTTP端口，访问/metrics获取，0为不开启；wechatmp、wechatcom、feishu通道也可以直接访问自身服务的/metrics
+    "metrics_host": "127.0.0.1",  # 指标HTTP服务监听的地址
+    "metrics_file": "",  # 定期把指标写入该文件，适用于没有HTTP服务的个人微信等通道
+    "metrics_file_interval": 15,  # 写入指标文件的间隔，单位秒
     "appdata_dir": "",  # 数据目录
+    "config_watch_interval": 2,  # 检测config.json修改并自动重载的间隔，单位秒，0为不检测
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
     # 是否使用全局插件配置
     "use_global_plugin_config": False,
+    "plugin_time_budget": 0,  # 插件处理单个事件的耗时预算，单位毫秒，超出时打印警告，0为不限制
+    "plugin_time_budgets": {},  # 按插件设置耗时预算，如{"keyword": 50}，优先于plugin_time_budget
+    "plugin_budget_action": "log",  # 超出预算时的处理，支持：{log,disable}，disable会暂停连续超时的插件handler
+    "plugin_budget_strikes": 3,  # 连续超出预算多少次后暂停该handler
+    "plugin_observer_workers": 2,  # 执行插件异步observer的线程数
+    "plugin_observer_queue": 1000,  # 等待执行的observer上限，超出时丢弃
+    "plugin_lazy_load": True,  # 在后台线程加载插件，通道先启动；插件加载完成前到达的事件会等待加载结束
     "max_media_send_count": 3,  # 单次最大发送媒体资源的个数
     "media_send_interval": 1,  # 发送图片的事件间隔，单位秒
     # 智谱AI 平台配置
@@ -198,8 +259,16 @@ available_setting = {
 # settings = Settings()
 
 class Config(dict):
+    """
+    配置快照：重载或update_config时创建新的Config整体替换，读取方拿到的快照不会被其他线程改动
+    读取不再校验key，校验只在写入时进行；由配置计算出的值(集合、元组等)通过derive按快照缓存
+    发布后的快照只读，运行时修改配置需调用set_override
+    """
+
     def __init__(self, d=None):
         super().__init__()
+        self._derived = {}
+        self._published = False
         if d is None:
             d = {}
         for k, v in d.items():
@@ -207,23 +276,39 @@ class Config(dict):
         # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
         self.user_datas = {}
 
-    def __getitem__(self, key):
-        if key not in available_setting:
-            raise Exception("key {} not in available_setting".format(key))
-        return super().__getitem__(key)
-
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        if self._published:
+            raise TypeError("config snapshot is read-only, use set_override() to change {}".format(key))
+        self._derived = {}
         return super().__setitem__(key, value)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+    def derive(self, name, builder):
+        """
+        返回builder(self)的结果并缓存在当前快照上，配置重载后会在新快照上重新计算
+        """
+        derived = self._derived
+        if name not in derived:
+            derived[name] = builder(self)
+        return derived[name]
+
+    def frozen(self, key):
+        """
+        列表配置项对应的frozenset，用于成员判断
+        """
+        return self.derive("frozen:" + key, lambda c: frozenset(c.get(key) or []))
+
+    def copy_with(self, **changes):
+        """
+        复制出修改了部分配置项的新快照
+        """
+        snapshot = Config(self)
+        for k, v in changes.items():
+            snapshot[k] = v
+        snapshot.user_datas = self.user_datas
+        snapshot._published = True
+        return snapshot
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
@@ -252,6 +337,9 @@ class Config(dict):
 
 
 config = Config()
+_runtime_overrides = {}  # 运行时通过set_override修改的配置
+_override_lock = threading.Lock()
+_file_values = None  # 上次加载时config.json中的配置，用于判断重载时哪些配置项在文件中被修改过
 
 
 def drag_sensitive(config):
@@ -278,8 +366,15 @@ def drag_sensitive(config):
     return config
 
 
+_user_datas_loaded = False
+_config_watcher = None
+
+
 def load_config():
-    global config
+    """
+    读取config.json生成新的配置快照并整体替换，正在使用旧快照的线程不受影响
+    """
+    global config, _user_datas_loaded, _file_values
     config_path = "config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
@@ -289,7 +384,8 @@ def load_config():
     logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
 
     # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    file_values = json.loads(config_str)
+    snapshot = Config(file_values)
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -298,22 +394,73 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                snapshot[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    snapshot[name] = False
                 elif value == "true":
-                    config[name] = True
+                    snapshot[name] = True
                 else:
-                    config[name] = value
-
-    if config.get("debug", False):
-        logger.setLevel(logging.DEBUG)
+                    snapshot[name] = value
+
+    with _override_lock:
+        if _file_values is not None:
+            # config.json中被修改过的配置项以文件为准，不再沿用运行时的修改
+            for name in [n for n in _runtime_overrides if file_values.get(n) != _file_values.get(n)]:
+                del _runtime_overrides[name]
+        _file_values = file_values
+        for name, value in _runtime_overrides.items():
+            snapshot[name] = value
+
+    setup_logging(snapshot)
+    if snapshot.get("debug", False):
         logger.debug("[INIT] set log level to DEBUG")
 
-    logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
+    logger.info("[INIT] load config: {}".format(drag_sensitive(snapshot)))
 
-    config.load_user_datas()
+    if _user_datas_loaded:
+        # 重载时沿用内存中的用户数据，避免丢失尚未保存的修改
+        snapshot.user_datas = config.user_datas
+    else:
+        snapshot.load_user_datas()
+        _user_datas_loaded = True
+    snapshot._published = True
+    config = snapshot
+    _watch_config(config_path)
+
+
+def _watch_config(config_path):
+    """
+    后台检测配置文件的修改时间，有变化时自动重载，config_watch_interval为0时不检测
+    """
+    global _config_watcher
+    interval = config.get("config_watch_interval", 2)
+    if _config_watcher is not None or not interval:
+        return
+
+    def run():
+        last_mtime = _get_mtime(config_path)
+        while True:
+            time.sleep(interval)
+            mtime = _get_mtime(config_path)
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            try:
+                load_config()
+                logger.info("[Config] {} changed, config reloaded".format(config_path))
+            except Exception as e:
+                logger.error("[Config] reload {} failed: {}".format(config_path, e))
+
+    _config_watcher = threading.Thread(target=run, daemon=True)
+    _config_watcher.start()
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
 
 
 def get_root():
@@ -370,6 +517,21 @@ def pconf(plugin_name: str) -> dict:
 global_config = {"admin_users": []}
 
 
+def set_override(key: str, value: any):
+    """
+    在运行时修改配置项(不写入config.json)，生成新的配置快照替换当前配置；
+    自动重载配置后继续生效，直到config.json中的该配置项被修改
+    """
+    set_overrides({key: value})
+
+
+def set_overrides(changes: dict):
+    global config
+    with _override_lock:
+        config = config.copy_with(**changes)
+        _runtime_overrides.update(changes)
+
+
 def update_config(key: str, value: any) -> bool:
     """
     更新配置文件中的特定键值，并刷新内存中的配置
@@ -393,12 +555,16 @@ def update_config(key: str, value: any) -> bool:
         # 更新配置
         current_config[key] = value
 
-        # 写入更新后的配置
-        with open(config_path, 'w', encoding='utf-8') as f:
+        # 写入更新后的配置，先写临时文件再替换，避免其他进程或配置重载读到写了一半的文件
+        tmp_path = config_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(current_config, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, config_path)
 
-        # 更新内存中的配置
-        config[key] = value
+        # 替换为新的配置快照，value复制一份，调用方之后修改value不会影响快照
+        with _override_lock:
+            _runtime_overrides.pop(key, None)
+            config = config.copy_with(**{key: copy.deepcopy(value)})
 
         logger.info(f"配置项 '{key}' 已更新为: {value}")
         return True
@@ -434,8 +600,6 @@ def get_value_from_config(key: str) -> any:
                 current_config = json.load(f)
 
             if key in current_config:
-                # 更新内存中的配置
-                config[key] = current_config[key]
                 return current_config[key]
             else:
                 logger.warning(f"配置项 '{key}' 在配置文件中不存在")
@@ -115,6 +115,8 @@ def update_local_chatrooms(core, l):
             if 'RemarkName' in member:
                 utils.emoji_formatter(member, 'RemarkName')
         # update it to old chatrooms
+        core.storageClass.load_pending_chatroom(chatroom['UserName'])
+        core.storageClass.dirtyChatrooms.add(chatroom['UserName'])
         oldChatroom = utils.search_dict_list(
             core.chatroomList, 'UserName', chatroom['UserName'])
         if oldChatroom:
@@ -130,6 +132,8 @@ def update_local_chatrooms(core, l):
                         update_info_dict(oldMember, member)
                     else:
                         oldMemberList.append(member)
+                # names of members may be changed in place
+                oldMemberList.touch()
         else:
             core.chatroomList.append(chatroom)
             oldChatroom = utils.search_dict_list(
@@ -137,7 +141,7 @@ def update_local_chatrooms(core, l):
         # delete useless members
         if len(chatroom['MemberList']) != len(oldChatroom['MemberList']) and \
                 chatroom['MemberList']:
-            existsUserNames = [member['UserName'] for member in chatroom['MemberList']]
+            existsUserNames = {member['UserName'] for member in chatroom['MemberList']}
             delList = []
             for i, member in enumerate(oldChatroom['MemberList']):
                 if member['UserName'] not in existsUserNames:
@@ -160,6 +164,8 @@ def update_local_chatrooms(core, l):
         newSelf = utils.search_dict_list(oldChatroom['MemberList'],
             'UserName', core.storageClass.userName)
         oldChatroom['Self'] = newSelf or copy.deepcopy(core.loginInfo['User'])
+    # NickName of chatrooms may be changed in place
+    core.chatroomList.touch()
     return {
         'Type'         : 'System',
         'Text'         : [chatroom['UserName'] for chatroom in l],
@@ -172,7 +178,6 @@ def update_local_friends(core, l):
     '''
         get a list of friends or mps for updating local contact
     '''
-    fullList = core.memberList + core.mpList
     for friend in l:
         if 'NickName' in friend:
             utils.emoji_formatter(friend, 'NickName')
@@ -180,8 +185,9 @@ def update_local_friends(core, l):
             utils.emoji_formatter(friend, 'DisplayName')
         if 'RemarkName' in friend:
             utils.emoji_formatter(friend, 'RemarkName')
-        oldInfoDict = utils.search_dict_list(
-            fullList, 'UserName', friend['UserName'])
+        core.storageClass.friendsDirty = True
+        oldInfoDict = core.memberList.find_user_name(friend['UserName']) or \
+            core.mpList.find_user_name(friend['UserName'])
         if oldInfoDict is None:
             oldInfoDict = copy.deepcopy(friend)
             if oldInfoDict['VerifyFlag'] & 8 == 0:
@@ -190,6 +196,9 @@ def update_local_friends(core, l):
                 core.mpList.append(oldInfoDict)
         else:
             update_info_dict(oldInfoDict, friend)
+    # names of friends may be changed in place
+    core.memberList.touch()
+    core.mpList.touch()
 
 @contact_change
 def update_local_uin(core, msg):
@@ -212,12 +221,17 @@ def update_local_uin(core, msg):
         if 0 < len(uins) == len(usernames):
             for uin, username in zip(uins, usernames):
                 if not '@' in username: continue
+                core.storageClass.load_pending_chatroom(username)
                 fullContact = core.memberList + core.chatroomList + core.mpList
                 userDicts = utils.search_dict_list(fullContact,
                     'UserName', username)
                 if userDicts:
                     if userDicts.get('Uin', 0) == 0:
                         userDicts['Uin'] = uin
+                        if '@@' in username:
+                            core.storageClass.dirtyChatrooms.add(username)
+                        else:
+                            core.storageClass.friendsDirty = True
                         usernameChangedList.append(username)
                         logger.debug('Uin fetched: %s, %s' % (username, uin))
                     else:
@@ -264,6 +278,7 @@ def update_local_uin(core, msg):
 
 def get_contact(self, update=False):
     if not update:
+        self.storageClass.load_pending_chatrooms()
         return utils.contact_deep_copy(self, self.chatroomList)
     def _get_contact(seq=0):
         url = '%s/webwxgetcontact?r=%s&seq=%s&skey=%s' % (self.loginInfo['url'],
@@ -312,6 +327,7 @@ def get_chatrooms(self, update=False, contactOnly=False):
     else:
         if update:
             self.get_contact(True)
+        self.storageClass.load_pending_chatrooms()
         return utils.contact_deep_copy(self, self.chatroomList)
 
 def get_mps(self, update=False):
@@ -1,4 +1,4 @@
-import pickle, os
+import pickle, os, threading
 import logging
 
 import requests  # type: ignore
@@ -6,6 +6,7 @@ import requests  # type: ignore
 from ..config import VERSION
 from ..returnvalues import ReturnValue
 from ..storage import templates
+from ..storage.snapshot import Snapshot
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
 
@@ -18,25 +19,31 @@ def load_hotreload(core):
 async def dump_login_status(self, fileDir=None):
     fileDir = fileDir or self.hotReloadDir
     try:
-        with open(fileDir, 'w') as f:
-            f.write('itchat - DELETE THIS')
-        os.remove(fileDir)
+        # the snapshot is appended to, so it is not truncated here
+        existed = os.path.exists(fileDir)
+        with open(fileDir, 'ab'):
+            pass
+        if not existed:
+            os.remove(fileDir)
     except:
         raise Exception('Incorrect fileDir')
     status = {
         'version'   : VERSION,
         'loginInfo' : self.loginInfo,
-        'cookies'   : self.s.cookies.get_dict(),
-        'storage'   : self.storageClass.dumps()}
-    with open(fileDir, 'wb') as f:
-        pickle.dump(status, f)
+        'cookies'   : self.s.cookies.get_dict(), }
+    # only contacts changed since the last dump are written, see storage.Storage.dump_snapshot
+    self.storageClass.dump_snapshot(fileDir, status)
     logger.debug('Dump login status for hot reload successfully.')
 
 async def load_login_status(self, fileDir,
         loginCallback=None, exitCallback=None):
     try:
-        with open(fileDir, 'rb') as f:
-            j = pickle.load(f)
+        snapshot = Snapshot.open(fileDir)
+        if snapshot is None: # status dumped by old versions
+            with open(fileDir, 'rb') as f:
+                j = pickle.load(f)
+        else:
+            j = pickle.loads(snapshot.read('status'))
     except Exception as e:
         logger.debug('No such file, loading login status failed.')
         return ReturnValue({'BaseResponse': {
@@ -47,6 +54,8 @@ async def load_login_status(self, fileDir,
         logger.debug(('you have updated itchat from %s to %s, ' +
             'so cached status is ignored') % (
             j.get('version', 'old version'), VERSION))
+        if snapshot is not None:
+            snapshot.close()
         return ReturnValue({'BaseResponse': {
             'ErrMsg': 'cached status ignored because of version',
             'Ret': -1005, }})
@@ -54,7 +63,11 @@ async def load_login_status(self, fileDir,
     self.loginInfo['User'] = templates.User(self.loginInfo['User'])
     self.loginInfo['User'].core = self
     self.s.cookies = requests.utils.cookiejar_from_dict(j['cookies'])
-    self.storageClass.loads(j['storage'])
+    if snapshot is None:
+        self.storageClass.loads(j['storage'])
+    else:
+        # chatrooms are loaded on first use and in background after receiving starts
+        self.storageClass.load_snapshot(snapshot)
     try:
         msgList, contactList = self.get_msg()
     except:
@@ -77,6 +90,10 @@ async def load_login_status(self, fileDir,
             msgList = produce_msg(self, msgList)
             for msg in msgList: self.msgList.put(msg)
         await self.start_receiving(exitCallback)
+        if self.storageClass.pendingChatrooms:
+            loader = threading.Thread(target=self.storageClass.load_pending_chatrooms)
+            loader.daemon = True
+            loader.start()
         logger.debug('loading login status succeeded.')
         if hasattr(loginCallback, '__call__'):
             await loginCallback(self.storageClass.userName)
@@ -414,6 +414,8 @@ def logout(self):
         self.alive = False
     self.isLogging = False
     self.s.cookies.clear()
+    with self.storageClass.updateLock:
+        self.storageClass.drop_snapshot()
     del self.chatroomList[:]
     del self.memberList[:]
     del self.mpList[:]
@@ -18,6 +18,7 @@ from pyqrcode import QRCode
 from .. import config, utils
 from ..returnvalues import ReturnValue
 from ..storage.templates import wrap_user_dict
+from ..pipeline import ShardedWorkers, conversation_key, LONGPOLL_SECONDS, ENRICH_SECONDS
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
 from config import conf
@@ -286,34 +287,26 @@ def show_mobile_login(self):
 
 def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
     self.alive = True
+    if self.enrichWorkers is None:
+        self.enrichWorkers = ShardedWorkers('enrich',
+            lambda *batch: produce_received(self, *batch),
+            conf().get('itchat_enrich_workers', 4), conf().get('itchat_pipeline_queue', 100))
 
     def maintain_loop():
         retryCount = 0
         while self.alive:
             try:
-                i = sync_check(self)
+                with LONGPOLL_SECONDS.time(request='synccheck'):
+                    i = sync_check(self)
                 if i is None:
                     self.alive = False
                 elif i == '0':
                     pass
                 else:
-                    msgList, contactList = self.get_msg()
-                    if msgList:
-                        msgList = produce_msg(self, msgList)
-                        for msg in msgList:
-                            self.msgList.put(msg)
-                    if contactList:
-                        chatroomList, otherList = [], []
-                        for contact in contactList:
-                            if '@@' in contact['UserName']:
-                                chatroomList.append(contact)
-                            else:
-                                otherList.append(contact)
-                        chatroomMsg = update_local_chatrooms(
-                            self, chatroomList)
-                        chatroomMsg['User'] = self.loginInfo['User']
-                        self.msgList.put(chatroomMsg)
-                        update_local_friends(self, otherList)
+                    with LONGPOLL_SECONDS.time(request='webwxsync'):
+                        msgList, contactList = self.get_msg()
+                    # producing is left to the enrich workers so the next long-poll is not delayed
+                    enqueue_received(self, msgList, contactList)
                 retryCount = 0
             except requests.exceptions.ReadTimeout:
                 pass
@@ -339,6 +332,34 @@ def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
         maintainThread.start()
 
 
+def enqueue_received(core, msgList, contactList):
+    ''' split a webwxsync result by conversation and hand it to the enrich workers '''
+    batches = {}
+    for m in msgList or ():
+        batches.setdefault(conversation_key(core, m), ([], [], []))[0].append(m)
+    for contact in contactList or ():
+        batch = batches.setdefault(contact['UserName'], ([], [], []))
+        batch[1 if '@@' in contact['UserName'] else 2].append(contact)
+    for key, batch in batches.items():
+        core.enrichWorkers.put(key, *batch)
+
+
+def produce_received(core, msgList, chatroomList, otherList):
+    if msgList:
+        with ENRICH_SECONDS.time(kind='msg'):
+            msgList = produce_msg(core, msgList)
+        for msg in msgList:
+            core.msgList.put(msg)
+    if chatroomList or otherList:
+        with ENRICH_SECONDS.time(kind='contact'):
+            if chatroomList:
+                chatroomMsg = update_local_chatrooms(core, chatroomList)
+                chatroomMsg['User'] = core.loginInfo['User']
+                core.msgList.put(chatroomMsg)
+            if otherList:
+                update_local_friends(core, otherList)
+
+
 def sync_check(self):
     url = '%s/synccheck' % self.loginInfo.get('syncUrl', self.loginInfo['url'])
     params = {
@@ -415,6 +436,8 @@ def logout(self):
         self.alive = False
     self.isLogging = False
     self.s.cookies.clear()
+    with self.storageClass.updateLock:
+        self.storageClass.drop_snapshot()
     del self.chatroomList[:]
     del self.memberList[:]
     del self.mpList[:]
@@ -10,6 +10,7 @@ from .. import config, utils
 from ..returnvalues import ReturnValue
 from ..storage import templates
 from .contact import update_local_uin
+from common import media_cache
 
 logger = logging.getLogger('itchat')
 
@@ -23,25 +24,41 @@ def load_messages(core):
     core.send         = send
     core.revoke       = revoke
 
+def _download_media(core, key, url, params, headers, downloadDir):
+    ''' media is streamed into the media cache and copied to downloadDir, so the same media
+        is downloaded only once and never held in memory; the content is returned if downloadDir is None.
+        a failed ReturnValue is returned if the download fails '''
+    try:
+        with media_cache.fetch('itchat:%s' % key, lambda: media_cache.iter_response(
+                core.s.get(url, params=params, stream=True, headers=headers))) as path:
+            if downloadDir is None:
+                with open(path, 'rb') as f:
+                    return f.read()
+            media_cache.copy_to(path, downloadDir)
+    except IOError as e: # requests errors and MediaTooLarge are IOErrors too
+        logger.warning('Failed to download %s: %s' % (url, e))
+        return ReturnValue({'BaseResponse': {
+            'ErrMsg': 'Failed to download media: %s' % e,
+            'Ret': -1004, }})
+    return ReturnValue({'BaseResponse': {
+        'ErrMsg': 'Successfully downloaded',
+        'Ret': 0, }})
+
 def get_download_fn(core, url, msgId):
     def download_fn(downloadDir=None):
         params = {
             'msgid': msgId,
             'skey': core.loginInfo['skey'],}
         headers = { 'User-Agent' : config.USER_AGENT }
-        r = core.s.get(url, params=params, stream=True, headers = headers)
-        tempStorage = io.BytesIO()
-        for block in r.iter_content(1024):
-            tempStorage.write(block)
-        if downloadDir is None:
-            return tempStorage.getvalue()
-        with open(downloadDir, 'wb') as f:
-            f.write(tempStorage.getvalue())
-        tempStorage.seek(0)
+        r = _download_media(core, '%s?msgid=%s' % (url, msgId), url, params, headers, downloadDir)
+        if downloadDir is None or not r:
+            return r
+        with open(downloadDir, 'rb') as f:
+            head = f.read(20)
         return ReturnValue({'BaseResponse': {
             'ErrMsg': 'Successfully downloaded',
             'Ret': 0, },
-            'PostFix': utils.get_image_postfix(tempStorage.read(20)), })
+            'PostFix': utils.get_image_postfix(head), })
     return download_fn
 
 def produce_msg(core, msgList):
@@ -151,22 +168,8 @@ def produce_msg(core, msgList):
                         'User-Agent': config.USER_AGENT
                     }
 
-                    try:
-                        r = core.s.get(url, params=params, headers=headers, stream=True)
-                        tempStorage = io.BytesIO()
-                        for block in r.iter_content(1024):
-                            tempStorage.write(block)
-                        if videoDir is None:
-                            return tempStorage.getvalue()
-                        with open(videoDir, 'wb') as f:
-                            f.write(tempStorage.getvalue())
-                        return ReturnValue({'BaseResponse': {
-                            'ErrMsg': 'Successfully downloaded',
-                            'Ret': 0,
-                        }})
-                    except Exception as e:
-                        logger.error(f"Error downloading compressed video: {str(e)}")
-                        raise
+                    return _download_media(core, '%s?msgid=%s' % (url, msgId),
+                        url, params, headers, videoDir)
 
                 else:  # 原始视频，使用 webwxgetmedia 接口
                     cookiesList = {name: data for name, data in core.s.cookies.items()}
@@ -181,22 +184,8 @@ def produce_msg(core, msgList):
                     }
                     headers = {'User-Agent': config.USER_AGENT}
 
-                    try:
-                        r = core.s.get(url, params=params, stream=True, headers=headers)
-                        tempStorage = io.BytesIO()
-                        for block in r.iter_content(1024):
-                            tempStorage.write(block)
-                        if videoDir is None:
-                            return tempStorage.getvalue()
-                        with open(videoDir, 'wb') as f:
-                            f.write(tempStorage.getvalue())
-                        return ReturnValue({'BaseResponse': {
-                            'ErrMsg': 'Successfully downloaded',
-                            'Ret': 0,
-                        }})
-                    except Exception as e:
-                        logger.error(f"Error downloading original video: {str(e)}")
-                        raise
+                    return _download_media(core, '%s?mediaid=%s' % (url, m['MediaId']),
+                        url, params, headers, videoDir)
             msg = {
                 'Type': 'Video',
                 'FileName' : '%s.mp4' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
@@ -219,17 +208,8 @@ def produce_msg(core, msgList):
                         'pass_ticket': 'undefined',
                         'webwx_data_ticket': cookiesList['webwx_data_ticket'],}
                     headers = { 'User-Agent' : config.USER_AGENT }
-                    r = core.s.get(url, params=params, stream=True, headers=headers)
-                    tempStorage = io.BytesIO()
-                    for block in r.iter_content(1024):
-                        tempStorage.write(block)
-                    if attaDir is None:
-                        return tempStorage.getvalue()
-                    with open(attaDir, 'wb') as f:
-                        f.write(tempStorage.getvalue())
-                    return ReturnValue({'BaseResponse': {
-                        'ErrMsg': 'Successfully downloaded',
-                        'Ret': 0, }})
+                    return _download_media(core, '%s?mediaid=%s' % (url, rawMsg['MediaId']),
+                        url, params, headers, attaDir)
                 msg = {
                     'Type': 'Attachment',
                     'Text': download_atta, }
@@ -345,24 +325,32 @@ def send_msg(self, msg='Test Message', toUserName=None):
     return r
 
 def _prepare_file(fileDir, file_=None):
+    ''' files are read in blocks for md5 and uploaded chunk by chunk instead of copied into memory,
+        file_ given by the caller is left open '''
     fileDict = {}
     if file_:
-        if hasattr(file_, 'read'):
-            file_ = file_.read()
-        else:
+        if not hasattr(file_, 'read'):
             return ReturnValue({'BaseResponse': {
                 'ErrMsg': 'file_ param should be opened file',
                 'Ret': -1005, }})
+        if not (hasattr(file_, 'seekable') and file_.seekable()):
+            file_ = io.BytesIO(file_.read())
+        fileDict['closeFile'] = False
     else:
         if not utils.check_file(fileDir):
             return ReturnValue({'BaseResponse': {
                 'ErrMsg': 'No file found in specific dir',
                 'Ret': -1002, }})
-        with open(fileDir, 'rb') as f:
-            file_ = f.read()
-    fileDict['fileSize'] = len(file_)
-    fileDict['fileMd5'] = hashlib.md5(file_).hexdigest()
-    fileDict['file_'] = io.BytesIO(file_)
+        file_ = open(fileDir, 'rb')
+        fileDict['closeFile'] = True
+    start = file_.tell()
+    fileMd5 = hashlib.md5()
+    for block in iter(lambda: file_.read(media_cache.CHUNK_SIZE), b''):
+        fileMd5.update(block)
+    fileDict['fileSize'] = file_.tell() - start
+    fileDict['fileMd5'] = fileMd5.hexdigest()
+    file_.seek(start)
+    fileDict['file_'] = file_
     return fileDict
 
 def upload_file(self, fileDir, isPicture=False, isVideo=False,
@@ -391,10 +379,13 @@ def upload_file(self, fileDir, isPicture=False, isVideo=False,
         ('FileMd5', fileMd5)]
         ), separators = (',', ':'))
     r = {'BaseResponse': {'Ret': -1005, 'ErrMsg': 'Empty file detected'}}
-    for chunk in range(chunks):
-        r = upload_chunk_file(self, fileDir, fileSymbol, fileSize,
-            file_, chunk, chunks, uploadMediaRequest)
-    file_.close()
+    try:
+        for chunk in range(chunks):
+            r = upload_chunk_file(self, fileDir, fileSymbol, fileSize,
+                file_, chunk, chunks, uploadMediaRequest)
+    finally:
+        if preparedFile.get('closeFile', True):
+            file_.close()
     if isinstance(r, dict):
         return ReturnValue(r)
     return ReturnValue(rawResponse=r)
@@ -446,6 +437,8 @@ def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
             mediaId = r['MediaId']
         else:
             return r
+    elif preparedFile['closeFile']:
+        preparedFile['file_'].close()
     url = '%s/webwxsendappmsg?fun=async&f=json' % self.loginInfo['url']
     data = {
         'BaseRequest': self.loginInfo['BaseRequest'],
@@ -7,6 +7,8 @@ except ImportError:
 from ..log import set_logging
 from ..utils import test_connect
 from ..storage import templates
+from ..pipeline import ShardedWorkers, conversation_key
+from config import conf
 
 logger = logging.getLogger('itchat')
 
@@ -38,33 +40,33 @@ def auto_login(self, hotReload=False, statusStorageDir='itchat.pkl',
         self.login(enableCmdQR=enableCmdQR, picDir=picDir, qrCallback=qrCallback,
             loginCallback=loginCallback, exitCallback=exitCallback)
 
-def configured_reply(self):
+def configured_reply(self, msg=None):
     ''' determine the type of message and reply if its method is defined
         however, I use a strange way to determine whether a msg is from massive platform
         I haven't found a better solution here
         The main problem I'm worrying about is the mismatching of new friends added on phone
         If you have any good idea, pleeeease report an issue. I will be more than grateful.
+        msg is given by the dispatch workers of run, otherwise it is taken from msgList
     '''
-    try:
-        msg = self.msgList.get(timeout=1)
-    except Queue.Empty:
-        pass
-    else:
-        if isinstance(msg['User'], templates.User):
-            replyFn = self.functionDict['FriendChat'].get(msg['Type'])
-        elif isinstance(msg['User'], templates.MassivePlatform):
-            replyFn = self.functionDict['MpChat'].get(msg['Type'])
-        elif isinstance(msg['User'], templates.Chatroom):
-            replyFn = self.functionDict['GroupChat'].get(msg['Type'])
-        if replyFn is None:
-            r = None
-        else:
-            try:
-                r = replyFn(msg)
-                if r is not None:
-                    self.send(r, msg.get('FromUserName'))
-            except:
-                logger.warning(traceback.format_exc())
+    if msg is None:
+        try:
+            msg = self.msgList.get(timeout=1)
+        except Queue.Empty:
+            return
+    replyFn = None
+    if isinstance(msg['User'], templates.User):
+        replyFn = self.functionDict['FriendChat'].get(msg['Type'])
+    elif isinstance(msg['User'], templates.MassivePlatform):
+        replyFn = self.functionDict['MpChat'].get(msg['Type'])
+    elif isinstance(msg['User'], templates.Chatroom):
+        replyFn = self.functionDict['GroupChat'].get(msg['Type'])
+    if replyFn is not None:
+        try:
+            r = replyFn(msg)
+            if r is not None:
+                self.send(r, msg.get('FromUserName'))
+        except:
+            logger.warning(traceback.format_exc())
 
 def msg_register(self, msgType, isFriendChat=False, isGroupChat=False, isMpChat=False):
     ''' a decorator constructor
@@ -88,10 +90,18 @@ def run(self, debug=False, blockThread=True):
     logger.info('Start auto replying.')
     if debug:
         set_logging(loggingLevel=logging.DEBUG)
+    if self.dispatchWorkers is None:
+        self.dispatchWorkers = ShardedWorkers('dispatch', self.configured_reply,
+            conf().get('itchat_dispatch_workers', 4), conf().get('itchat_pipeline_queue', 100))
     def reply_fn():
         try:
             while self.alive:
-                self.configured_reply()
+                try:
+                    msg = self.msgList.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                # messages of a conversation are replied in order by the same worker
+                self.dispatchWorkers.put(conversation_key(self, msg), msg)
         except KeyboardInterrupt:
             if self.useHotReload:
                 self.dump_login_status()
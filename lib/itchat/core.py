@@ -15,6 +15,8 @@ class Core(object):
             receivingRetryCount is for receiving loop retry
                 - it's 5 now, but actually even 1 is enough
                 - failing is failing
+            enrichWorkers and dispatchWorkers are the stages of receiving
+                - they are created by start_receiving and run, see pipeline.py
         '''
         self.alive, self.isLogging = False, False
         self.storageClass = storage.Storage(self)
@@ -28,6 +30,7 @@ class Core(object):
         self.functionDict = {'FriendChat': {}, 'GroupChat': {}, 'MpChat': {}}
         self.useHotReload, self.hotReloadDir = False, 'itchat.pkl'
         self.receivingRetryCount = 5
+        self.enrichWorkers, self.dispatchWorkers = None, None
     def login(self, enableCmdQR=False, picDir=None, qrCallback=None,
             loginCallback=None, exitCallback=None):
         ''' log in like web wechat does
@@ -427,12 +430,13 @@ class Core(object):
                 - and modified according to your own demond
         '''
         raise NotImplementedError()
-    def configured_reply(self):
+    def configured_reply(self, msg=None):
         ''' determine the type of message and reply if its method is defined
             however, I use a strange way to determine whether a msg is from massive platform
             I haven't found a better solution here
             The main problem I'm worrying about is the mismatching of new friends added on phone
             If you have any good idea, pleeeease report an issue. I will be more than grateful.
+            msg is given by the dispatch workers of run, otherwise it is taken from msgList
         '''
         raise NotImplementedError()
     def msg_register(self, msgType,
@@ -0,0 +1,58 @@
+''' staged receiving pipeline
+
+    the long-poll thread only runs synccheck and webwxsync, messages are then produced
+    (contact lookups, formatting, chatroom updates) by a pool of enrich workers and replied
+    by a pool of dispatch workers. items of the same conversation always go to the same worker,
+    so messages of a conversation are produced and replied in order. queues are bounded,
+    when they are full the previous stage waits instead of piling up messages. '''
+import logging, threading, time, traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from common import metrics
+
+logger = logging.getLogger('itchat')
+
+LONGPOLL_SECONDS = metrics.histogram('cow_itchat_longpoll_seconds',
+    'Latency of itchat long-poll requests', ['request'])
+ENRICH_SECONDS = metrics.histogram('cow_itchat_enrich_seconds',
+    'Time spent producing received messages and contacts', ['kind'])
+QUEUE_SECONDS = metrics.histogram('cow_itchat_queue_seconds',
+    'Time items waited in the itchat pipeline queues', ['stage'])
+
+def conversation_key(core, msg):
+    ''' the other side of a message, the chatroom for group messages '''
+    user = msg.get('User')
+    if isinstance(user, dict) and user.get('UserName'):
+        return user['UserName']
+    if msg.get('FromUserName') == core.storageClass.userName:
+        return msg.get('ToUserName')
+    return msg.get('FromUserName')
+
+class ShardedWorkers(object):
+    ''' worker threads with a bounded queue each, put(key, ...) always uses the same worker
+        for the same key, so calls of a key run one by one in order '''
+    def __init__(self, name, fn, workers=1, maxsize=100):
+        self.name = name
+        self.fn = fn
+        self.queues = [queue.Queue(maxsize) for _ in range(max(1, workers))]
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+    def put(self, key, *args):
+        ''' blocks while the queue of the worker is full '''
+        self.queues[hash(key) % len(self.queues)].put((time.perf_counter(), args))
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+    def _run(self, q):
+        while True:
+            queued, args = q.get()
+            if metrics.ENABLED:
+                QUEUE_SECONDS.observe(time.perf_counter() - queued, stage=self.name)
+            try:
+                self.fn(*args)
+            except:
+                logger.warning(traceback.format_exc())
@@ -1,10 +1,15 @@
-import os, time, copy
+import os, time, pickle, logging
 from threading import Lock
 
 from .messagequeue import Queue
 from .templates import (
     ContactList, AbstractUserDict, User,
-    MassivePlatform, Chatroom, ChatroomMember)
+    MassivePlatform, Chatroom, ChatroomMember, SEARCH_KEYS)
+from .snapshot import Snapshot
+
+logger = logging.getLogger('itchat')
+
+CHATROOM_KEY = 'chatroom:'
 
 def contact_change(fn):
     def _contact_change(core, *args, **kwargs):
@@ -28,6 +33,10 @@ class Storage(object):
         self.mpList.core = core
         self.chatroomList.set_default_value(contactClass=Chatroom)
         self.chatroomList.core = core
+        self.snapshot          = None # hot reload snapshot the storage was loaded from or dumped to
+        self.pendingChatrooms  = set() # UserName of chatrooms still in the snapshot only
+        self.dirtyChatrooms    = set() # UserName of chatrooms changed since the last dump
+        self.friendsDirty      = False
     def dumps(self):
         return {
             'userName'          : self.userName,
@@ -47,71 +56,147 @@ class Storage(object):
             self.mpList.append(i)
         del self.chatroomList[:]
         for i in j.get('chatroomList', []):
-            self.chatroomList.append(i)
+            self.add_loaded_chatroom(i)
+        self.lastInputUserName = j.get('lastInputUserName', None)
+    def add_loaded_chatroom(self, chatroom):
+        self.chatroomList.append(chatroom)
+        chatroom = self.chatroomList[-1]
         # I tried to solve everything in pickle
         # but this way is easier and more storage-saving
-        for chatroom in self.chatroomList:
-            if 'MemberList' in chatroom:
-                for member in chatroom['MemberList']:
-                    member.core = chatroom.core
-                    member.chatroom = chatroom
-            if 'Self' in chatroom:
-                chatroom['Self'].core = chatroom.core
-                chatroom['Self'].chatroom = chatroom
-        self.lastInputUserName = j.get('lastInputUserName', None)
+        if 'MemberList' in chatroom:
+            for member in chatroom['MemberList']:
+                member.core = chatroom.core
+                member.chatroom = chatroom
+        if 'Self' in chatroom:
+            chatroom['Self'].core = chatroom.core
+            chatroom['Self'].chatroom = chatroom
+    def dump_snapshot(self, fileDir, status):
+        ''' only status and the contacts changed since the last dump are appended to the snapshot,
+            the snapshot is rewritten when it is another file or has grown twice its live size '''
+        with self.updateLock:
+            status = dict(status, userName=self.userName, nickName=self.nickName,
+                lastInputUserName=self.lastInputUserName)
+            records = [('status', _dumps(status))]
+            snapshot = self.snapshot
+            full = snapshot is None or not snapshot.is_current(fileDir) or \
+                (not self.pendingChatrooms and snapshot.needs_compaction())
+            if full or self.friendsDirty:
+                records.append(('memberList', _dumps(self.memberList)))
+                records.append(('mpList', _dumps(self.mpList)))
+            userNames = set()
+            for chatroom in self.chatroomList:
+                userName = chatroom.get('UserName')
+                userNames.add(userName)
+                if full or userName in self.dirtyChatrooms:
+                    records.append((CHATROOM_KEY + userName, _dumps(chatroom)))
+            if full:
+                # chatrooms not loaded yet are copied from the old snapshot and stay pending
+                records.extend((CHATROOM_KEY + u, snapshot.read(CHATROOM_KEY + u))
+                    for u in self.pendingChatrooms)
+                if snapshot is not None:
+                    snapshot.close() # the file may be replaced
+                self.snapshot = None
+                try:
+                    self.snapshot = Snapshot.write(fileDir, records)
+                finally:
+                    if self.snapshot is None:
+                        self.pendingChatrooms = set()
+            else:
+                records.extend((key, None) for key in snapshot.keys(CHATROOM_KEY)
+                    if key[len(CHATROOM_KEY):] not in userNames
+                    and key[len(CHATROOM_KEY):] not in self.pendingChatrooms)
+                snapshot.append(records)
+            self.dirtyChatrooms.clear()
+            self.friendsDirty = False
+            logger.debug('%s snapshot: %d records written.' % (
+                'Full' if full else 'Incremental', len(records)))
+    def load_snapshot(self, snapshot):
+        ''' load status, friends and mps from snapshot and return status,
+            chatrooms are loaded on first use or by load_pending_chatrooms '''
+        status = _loads(snapshot.read('status'))
+        if status is None:
+            raise ValueError('no status in snapshot %s' % snapshot.fileDir)
+        self.loads({
+            'userName'          : status.get('userName'),
+            'nickName'          : status.get('nickName'),
+            'memberList'        : _loads(snapshot.read('memberList')) or [],
+            'mpList'            : _loads(snapshot.read('mpList')) or [],
+            'lastInputUserName' : status.get('lastInputUserName'), })
+        with self.updateLock:
+            self.drop_snapshot()
+            self.snapshot = snapshot
+            self.pendingChatrooms = {k[len(CHATROOM_KEY):] for k in snapshot.keys(CHATROOM_KEY)}
+        return status
+    def drop_snapshot(self):
+        ''' forget the snapshot, the next dump rewrites it '''
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = None
+        self.pendingChatrooms = set()
+        self.dirtyChatrooms.clear()
+        self.friendsDirty = False
+    def load_pending_chatroom(self, userName, chatroom=None):
+        ''' called with updateLock held, load the chatroom if it is still in the snapshot only '''
+        if userName in self.pendingChatrooms:
+            self.pendingChatrooms.discard(userName)
+            if chatroom is None:
+                chatroom = _loads(self.snapshot.read(CHATROOM_KEY + userName))
+            # chatrooms fetched from the server meanwhile are newer than the snapshot
+            if chatroom is not None and self.chatroomList.find_user_name(userName) is None:
+                self.add_loaded_chatroom(chatroom)
+    def load_pending_chatrooms(self):
+        ''' load chatrooms that are still in the snapshot only one by one,
+            reading and unpickling are done without holding updateLock '''
+        while True:
+            with self.updateLock:
+                if not self.pendingChatrooms:
+                    return
+                userName, snapshot = next(iter(self.pendingChatrooms)), self.snapshot
+            chatroom = _loads(snapshot.read(CHATROOM_KEY + userName))
+            with self.updateLock:
+                if snapshot is self.snapshot:
+                    self.load_pending_chatroom(userName, chatroom)
     def search_friends(self, name=None, userName=None, remarkName=None, nickName=None,
             wechatAccount=None):
+        ''' search results are shallow copies, see AbstractUserDict.shallow_copy '''
         with self.updateLock:
             if (name or userName or remarkName or nickName or wechatAccount) is None:
-                return copy.deepcopy(self.memberList[0]) # my own account
+                return self.memberList[0].shallow_copy() # my own account
             elif userName: # return the only userName match
-                for m in self.memberList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self.memberList.find_user_name(userName)
+                if m is not None:
+                    return m.shallow_copy()
             else:
                 matchDict = {
                     'RemarkName' : remarkName,
                     'NickName'   : nickName,
                     'Alias'      : wechatAccount, }
-                for k in ('RemarkName', 'NickName', 'Alias'):
+                for k in SEARCH_KEYS:
                     if matchDict[k] is None:
                         del matchDict[k]
-                if name: # select based on name
-                    contact = []
-                    for m in self.memberList:
-                        if any([m.get(k) == name for k in ('RemarkName', 'NickName', 'Alias')]):
-                            contact.append(m)
-                else:
-                    contact = self.memberList[:]
-                if matchDict: # select again based on matchDict
-                    friendList = []
-                    for m in contact:
-                        if all([m.get(k) == v for k, v in matchDict.items()]):
-                            friendList.append(m)
-                    return copy.deepcopy(friendList)
-                else:
-                    return copy.deepcopy(contact)
+                return [m.shallow_copy() for m in self.memberList.search(name or None, matchDict)]
     def search_chatrooms(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.chatroomList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                self.load_pending_chatroom(userName)
+                m = self.chatroomList.find_user_name(userName)
+                if m is not None:
+                    return m.shallow_copy()
             elif name is not None:
-                matchList = []
-                for m in self.chatroomList:
-                    if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
-                return matchList
+                for u in list(self.pendingChatrooms):
+                    self.load_pending_chatroom(u)
+                return [m.shallow_copy() for m in self.chatroomList if name in m['NickName']]
     def search_mps(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.mpList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self.mpList.find_user_name(userName)
+                if m is not None:
+                    return m.shallow_copy()
             elif name is not None:
-                matchList = []
-                for m in self.mpList:
-                    if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
-                return matchList
+                return [m.shallow_copy() for m in self.mpList if name in m['NickName']]
+
+def _dumps(o):
+    return pickle.dumps(o, pickle.HIGHEST_PROTOCOL)
+
+def _loads(payload):
+    return None if payload is None else pickle.loads(payload)
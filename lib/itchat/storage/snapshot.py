@@ -0,0 +1,108 @@
+''' append-only snapshot file used by hot reload
+
+    the file starts with MAGIC and is followed by records of
+        4-byte key length, utf-8 key, 8-byte payload length, payload
+    a later record replaces an earlier one with the same key and an empty payload deletes the key,
+    so a dump only appends what changed. opening a snapshot only reads the record headers,
+    payloads are read when they are needed. '''
+import os, struct, threading
+
+MAGIC = b'ITCHAT-SNAPSHOT-1\n'
+_KEY_LEN = struct.Struct('>I')
+_PAYLOAD_LEN = struct.Struct('>Q')
+
+class Snapshot(object):
+    def __init__(self, fileDir):
+        self.fileDir = fileDir
+        self.index = {} # key -> (offset, length) of the payload
+        self.size = 0 # bytes of complete records, an interrupted append is ignored
+        self.liveSize = 0 # bytes of records that are not replaced or deleted
+        self._f = None
+        self._lock = threading.Lock()
+    @classmethod
+    def open(cls, fileDir):
+        ''' return None if the file is not a snapshot, e.g. a status dumped by old versions '''
+        f = open(fileDir, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            return None
+        snapshot = cls(fileDir)
+        snapshot._f = f
+        snapshot._scan()
+        return snapshot
+    @classmethod
+    def write(cls, fileDir, records):
+        ''' write a new snapshot containing only records, records is a list of (key, payload bytes) '''
+        tmpDir = fileDir + '.tmp'
+        with open(tmpDir, 'wb') as f:
+            f.write(MAGIC)
+            for key, payload in records:
+                if payload:
+                    f.write(_frame(key, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpDir, fileDir)
+        return cls.open(fileDir)
+    def _scan(self):
+        f, offset = self._f, len(MAGIC)
+        end = os.fstat(f.fileno()).st_size
+        while offset + _KEY_LEN.size <= end:
+            f.seek(offset)
+            keyLen = _KEY_LEN.unpack(f.read(_KEY_LEN.size))[0]
+            payloadOffset = offset + _KEY_LEN.size + keyLen + _PAYLOAD_LEN.size
+            if payloadOffset > end:
+                break
+            key = f.read(keyLen).decode('utf-8')
+            length = _PAYLOAD_LEN.unpack(f.read(_PAYLOAD_LEN.size))[0]
+            if payloadOffset + length > end:
+                break
+            self._set(key, payloadOffset, length, payloadOffset + length - offset)
+            offset = payloadOffset + length
+        self.size = offset
+    def _set(self, key, payloadOffset, length, recordSize):
+        old = self.index.pop(key, None)
+        if old is not None:
+            self.liveSize -= old[2]
+        if length:
+            self.index[key] = (payloadOffset, length, recordSize)
+            self.liveSize += recordSize
+    def keys(self, prefix=''):
+        return [k for k in self.index if k.startswith(prefix)]
+    def read(self, key):
+        ''' return payload bytes of key or None if it does not exist '''
+        with self._lock:
+            item = self.index.get(key)
+            if item is None or self._f is None:
+                return None
+            self._f.seek(item[0])
+            return self._f.read(item[1])
+    def is_current(self, fileDir):
+        ''' whether fileDir is this snapshot and nobody else wrote to it '''
+        try:
+            return self._f is not None and fileDir == self.fileDir and \
+                os.path.getsize(fileDir) >= self.size
+        except OSError:
+            return False
+    def needs_compaction(self):
+        return self.size - self.liveSize > max(self.liveSize, 1 << 20)
+    def append(self, records):
+        ''' append records, a payload of None deletes the key '''
+        with self._lock, open(self.fileDir, 'r+b') as f:
+            f.truncate(self.size) # drop an interrupted append
+            f.seek(self.size)
+            for key, payload in records:
+                frame = _frame(key, payload or b'')
+                f.write(frame)
+                self._set(key, self.size + len(frame) - len(payload or b''), len(payload or b''), len(frame))
+                self.size += len(frame)
+            f.flush()
+            os.fsync(f.fileno())
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+def _frame(key, payload):
+    key = key.encode('utf-8')
+    return _KEY_LEN.pack(len(key)) + key + _PAYLOAD_LEN.pack(len(payload)) + payload
@@ -1,4 +1,6 @@
 import logging, copy, pickle
+from collections.abc import ItemsView, KeysView, ValuesView
+from sys import intern
 from weakref import ref
 
 from ..returnvalues import ReturnValue
@@ -7,6 +9,7 @@ from ..utils import update_info_dict
 logger = logging.getLogger('itchat')
 
 class AttributeDict(dict):
+    __slots__ = ()
     def __getattr__(self, value):
         keyName = value[0].upper() + value[1:]
         try:
@@ -26,11 +29,78 @@ class UnInitializedItchat(object):
     def __getattr__(self, value):
         return self._raise_error
 
+SEARCH_KEYS = ('RemarkName', 'NickName', 'Alias')
+
+def _invalidates_index(name):
+    method = getattr(list, name)
+    def _method(self, *args, **kwargs):
+        r = method(self, *args, **kwargs)
+        self.touch()
+        return r
+    _method.__name__ = name
+    return _method
+
 class ContactList(list):
-    ''' when a dict is append, init function will be called to format that dict '''
+    ''' when a dict is append, init function will be called to format that dict
+        contacts are indexed by UserName, RemarkName, NickName and Alias;
+        the indexes are built on first search and rebuilt after the list changes,
+        call touch() after changing those values of a contact in place '''
     def __init__(self, *args, **kwargs):
         super(ContactList, self).__init__(*args, **kwargs)
         self.__setstate__(None)
+    def touch(self):
+        self._userNameIndex = None
+        self._nameIndex = None
+    def _user_name_index(self):
+        index = getattr(self, '_userNameIndex', None)
+        if index is None:
+            index = {}
+            for contact in self:
+                index.setdefault(contact.get('UserName'), contact)
+            self._userNameIndex = index
+        return index
+    def _name_index(self):
+        index = getattr(self, '_nameIndex', None)
+        if index is None:
+            index = {k: {} for k in SEARCH_KEYS}
+            for contact in self:
+                for k in SEARCH_KEYS:
+                    v = contact.get(k)
+                    if v is not None:
+                        index[k].setdefault(v, []).append(contact)
+            self._nameIndex = index
+        return index
+    def find_user_name(self, userName):
+        ''' return the contact with the given UserName or None '''
+        contact = self._user_name_index().get(userName)
+        if contact is not None and contact.get('UserName') != userName:
+            # UserName changed in place, rebuild the index
+            self.touch()
+            contact = self._user_name_index().get(userName)
+        return contact
+    def search(self, name=None, matchDict=None):
+        ''' return contacts whose RemarkName, NickName or Alias equals name
+            and all values in matchDict match, in list order '''
+        matchDict = matchDict or {}
+        if name is None and not matchDict:
+            return self[:]
+        index = self._name_index()
+        if name is not None:
+            seen, candidates = set(), []
+            for k in SEARCH_KEYS:
+                for contact in index[k].get(name, ()):
+                    if id(contact) not in seen:
+                        seen.add(id(contact))
+                        candidates.append(contact)
+            if len(candidates) > 1:
+                order = {id(c): i for i, c in enumerate(self)}
+                candidates.sort(key=lambda c: order.get(id(c), 0))
+        else:
+            # the rarest value narrows down the candidates
+            k, v = min(matchDict.items(), key=lambda item: len(index[item[0]].get(item[1], ())))
+            candidates = index[k].get(v, [])
+        return [c for c in candidates if all(c.get(k) == v for k, v in matchDict.items())
+            and (name is None or any(c.get(k) == name for k in SEARCH_KEYS))]
     @property
     def core(self):
         return getattr(self, '_core', lambda: fakeItchat)() or fakeItchat
@@ -48,6 +118,20 @@ class ContactList(list):
         if self.contactInitFn is not None:
             contact = self.contactInitFn(self, contact) or contact
         super(ContactList, self).append(contact)
+        index = getattr(self, '_userNameIndex', None)
+        if index is not None:
+            index.setdefault(contact.get('UserName'), contact)
+        self._nameIndex = None
+    extend = _invalidates_index('extend')
+    insert = _invalidates_index('insert')
+    remove = _invalidates_index('remove')
+    pop = _invalidates_index('pop')
+    clear = _invalidates_index('clear')
+    sort = _invalidates_index('sort')
+    reverse = _invalidates_index('reverse')
+    __setitem__ = _invalidates_index('__setitem__')
+    __delitem__ = _invalidates_index('__delitem__')
+    __iadd__ = _invalidates_index('__iadd__')
     def __deepcopy__(self, memo):
         r = self.__class__([copy.deepcopy(v) for v in self])
         r.contactInitFn = self.contactInitFn
@@ -59,6 +143,7 @@ class ContactList(list):
     def __setstate__(self, state):
         self.contactInitFn = None
         self.contactClass = User
+        self.touch()
     def __str__(self):
         return '[%s]' % ', '.join([repr(v) for v in self])
     def __repr__(self):
@@ -66,6 +151,7 @@ class ContactList(list):
             self.__str__())
 
 class AbstractUserDict(AttributeDict):
+    __slots__ = ()
     def __init__(self, *args, **kwargs):
         super(AbstractUserDict, self).__init__(*args, **kwargs)
     @property
@@ -130,6 +216,14 @@ class AbstractUserDict(AttributeDict):
             r[copy.deepcopy(k)] = copy.deepcopy(v)
         r.core = self.core
         return r
+    def shallow_copy(self):
+        ''' copy used as search result instead of deepcopy:
+            top-level values can be changed without touching the storage,
+            nested values such as MemberList are shared and should be treated as read-only '''
+        r = self.__class__.__new__(self.__class__)
+        dict.update(r, self)
+        r.__dict__.update(self.__dict__)
+        return r
     def __str__(self):
         return '{%s}' % ', '.join(
             ['%s: %s' % (repr(k),repr(v)) for k,v in self.items()])
@@ -192,6 +286,8 @@ class Chatroom(AbstractUserDict):
         return getattr(self, '_core', lambda: fakeItchat)() or fakeItchat
     @core.setter
     def core(self, value):
+        if getattr(self, '_core', lambda: None)() is value and self.memberList.core is value:
+            return # members were set together with the chatroom, or on appending to memberList
         self._core = ref(value)
         self.memberList.core = value
         for member in self.memberList:
@@ -216,41 +312,141 @@ class Chatroom(AbstractUserDict):
             if (name or userName or remarkName or nickName or wechatAccount) is None:
                 return None
             elif userName: # return the only userName match
-                for m in self.memberList:
-                    if m.userName == userName:
-                        return copy.deepcopy(m)
+                m = self.memberList.find_user_name(userName)
+                if m is not None:
+                    return m.shallow_copy()
             else:
                 matchDict = {
                     'RemarkName' : remarkName,
                     'NickName'   : nickName,
                     'Alias'      : wechatAccount, }
-                for k in ('RemarkName', 'NickName', 'Alias'):
+                for k in SEARCH_KEYS:
                     if matchDict[k] is None:
                         del matchDict[k]
-                if name: # select based on name
-                    contact = []
-                    for m in self.memberList:
-                        if any([m.get(k) == name for k in ('RemarkName', 'NickName', 'Alias')]):
-                            contact.append(m)
-                else:
-                    contact = self.memberList[:]
-                if matchDict: # select again based on matchDict
-                    friendList = []
-                    for m in contact:
-                        if all([m.get(k) == v for k, v in matchDict.items()]):
-                            friendList.append(m)
-                    return copy.deepcopy(friendList)
-                else:
-                    return copy.deepcopy(contact)
+                return [m.shallow_copy() for m in self.memberList.search(name or None, matchDict)]
     def __setstate__(self, state):
         super(Chatroom, self).__setstate__(state)
         if not 'MemberList' in self:
             self['MemberList'] = fakeContactList
 
+# fields of chatroom members that are rarely read, they are packed into a tuple instead of the dict
+LAZY_MEMBER_KEYS = ('AttrStatus', 'MemberStatus', 'KeyWord',
+    'PYInitial', 'PYQuanPin', 'RemarkPYInitial', 'RemarkPYQuanPin')
+_LAZY_MEMBER_INDEX = {k: i for i, k in enumerate(LAZY_MEMBER_KEYS)}
+
 class ChatroomMember(AbstractUserDict):
+    ''' a bot may keep hundreds of thousands of members, so they are stored compactly:
+        no instance __dict__, values of LAZY_MEMBER_KEYS are packed into a tuple and only
+        looked up on access, string keys and values are interned so that a user shared by
+        several chatrooms shares its strings.
+        the packed fields behave like normal items: indexing, get(), attributes, `in`, iteration,
+        keys(), items(), values(), len(), dict(member) and json.dumps(member) include them '''
+    __slots__ = ('_core', '_chatroom', '_chatroomUserName', '_packed')
     def __init__(self, *args, **kwargs):
-        super(AbstractUserDict, self).__init__(*args, **kwargs)
-        self.__setstate__(None)
+        super(AbstractUserDict, self).__init__()
+        packed = [None] * len(LAZY_MEMBER_KEYS)
+        if len(args) == 1 and isinstance(args[0], ChatroomMember):
+            args = (args[0].to_dict(),) # keep packed values of the copied member
+        for k, v in dict(*args, **kwargs).items():
+            if isinstance(v, str):
+                v = intern(v)
+            i = _LAZY_MEMBER_INDEX.get(k)
+            if i is None or v is None:
+                dict.__setitem__(self, intern(k) if isinstance(k, str) else k, v)
+            else:
+                packed[i] = v
+        self.__setstate__(None if packed.count(None) == len(packed) else tuple(packed))
+    def __getattr__(self, value):
+        if value in ChatroomMember.__slots__: # slot not set yet, e.g. while unpickling
+            raise AttributeError(value)
+        return super(ChatroomMember, self).__getattr__(value)
+    def __setitem__(self, k, v):
+        if isinstance(v, str):
+            v = intern(v)
+        i = _LAZY_MEMBER_INDEX.get(k)
+        if i is None or v is None:
+            if i is not None:
+                self._pack(i, None)
+            dict.__setitem__(self, intern(k) if isinstance(k, str) else k, v)
+        else:
+            dict.pop(self, k, None)
+            self._pack(i, v)
+    def __missing__(self, k):
+        packed = getattr(self, '_packed', None)
+        i = _LAZY_MEMBER_INDEX.get(k)
+        if i is not None and packed is not None and packed[i] is not None:
+            return packed[i]
+        elif k == 'MemberList':
+            return fakeContactList
+        raise KeyError(k)
+    def __contains__(self, k):
+        if dict.__contains__(self, k):
+            return True
+        try:
+            self.__missing__(k)
+        except KeyError:
+            return False
+        return True
+    def __iter__(self):
+        for k in dict.__iter__(self):
+            yield k
+        packed = getattr(self, '_packed', None)
+        if packed is not None:
+            for k, v in zip(LAZY_MEMBER_KEYS, packed):
+                if v is not None:
+                    yield k
+    def __len__(self):
+        packed = getattr(self, '_packed', None)
+        return dict.__len__(self) + (0 if packed is None else len(packed) - packed.count(None))
+    def keys(self):
+        return KeysView(self)
+    def items(self):
+        return ItemsView(self)
+    def values(self):
+        return ValuesView(self)
+    def __eq__(self, other):
+        if isinstance(other, ChatroomMember):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None
+    def __delitem__(self, k):
+        if dict.__contains__(self, k):
+            dict.__delitem__(self, k)
+        elif k in self and k != 'MemberList':
+            self._pack(_LAZY_MEMBER_INDEX[k], None)
+        else:
+            raise KeyError(k)
+    def _pack(self, i, v):
+        packed = getattr(self, '_packed', None)
+        if packed is None:
+            if v is None:
+                return
+            packed = (None,) * len(LAZY_MEMBER_KEYS)
+        packed = packed[:i] + (v,) + packed[i + 1:]
+        self._packed = None if packed.count(None) == len(packed) else packed
+    def to_dict(self):
+        ''' plain dict with all fields, including the packed ones '''
+        r = dict(dict.items(self))
+        packed = getattr(self, '_packed', None)
+        if packed is not None:
+            r.update((k, v) for k, v in zip(LAZY_MEMBER_KEYS, packed) if v is not None)
+        return r
+    def shallow_copy(self):
+        r = self.__class__.__new__(self.__class__)
+        dict.update(r, dict.items(self))
+        for k in self.__slots__:
+            if hasattr(self, k):
+                setattr(r, k, getattr(self, k))
+        return r
+    def __deepcopy__(self, memo):
+        r = super(ChatroomMember, self).__deepcopy__(memo)
+        r._packed = getattr(self, '_packed', None) # only immutable values are packed
+        return r
+    def __str__(self):
+        return '{%s}' % ', '.join(
+            ['%s: %s' % (repr(k),repr(v)) for k,v in self.to_dict().items()])
     @property
     def chatroom(self):
         r = getattr(self, '_chatroom', lambda: fakeChatroom)()
@@ -299,9 +495,11 @@ class ChatroomMember(AbstractUserDict):
             'Ret': -1006,
             'ErrMsg': '%s can not send message directly' % \
                 self.__class__.__name__, }, })
+    def __getstate__(self):
+        return getattr(self, '_packed', None)
     def __setstate__(self, state):
-        super(ChatroomMember, self).__setstate__(state)
-        self['MemberList'] = fakeContactList
+        # MemberList is served by __missing__, packed values are restored from pickle
+        self._packed = state if isinstance(state, tuple) else None
 
 def wrap_user_dict(d):
     userName = d.get('UserName')
@@ -114,6 +114,8 @@ def struct_friend_info(knownInfo):
 def search_dict_list(l, key, value):
     ''' Search a list of dict
         * return dict with specific value & key '''
+    if key == 'UserName' and hasattr(l, 'find_user_name'):
+        return l.find_user_name(value)
     for i in l:
         if i.get(key) == value:
             return i
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import copy
 from enum import Enum
 
 
@@ -53,3 +54,31 @@ class EventContext:
 
     def is_break(self):
         return self.action == EventAction.BREAK or self.action == EventAction.BREAK_PASS
+
+    def snapshot(self):
+        """
+        复制一份只读的事件上下文交给异步observer，context和reply会浅拷贝，
+        其中的msg等对象与原事件共用，observer不应修改
+        """
+        econtext = {}
+        for key, value in self.econtext.items():
+            if key in ("context", "reply") and value is not None:
+                value = copy.copy(value)
+                if isinstance(getattr(value, "kwargs", None), dict):
+                    value.kwargs = dict(value.kwargs)
+            econtext[key] = value
+        snapshot = ReadOnlyEventContext(self.event, econtext)
+        snapshot.action = self.action
+        return snapshot
+
+
+class ReadOnlyEventContext(EventContext):
+    """
+    异步observer收到的事件快照，修改不会影响消息处理，也不能中断事件
+    """
+
+    def __setitem__(self, key, value):
+        raise TypeError("event context is read-only for observers")
+
+    def __delitem__(self, key):
+        raise TypeError("event context is read-only for observers")
@@ -13,7 +13,8 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
-from config import conf, load_config, global_config
+from common.log import get_log_level, set_log_level
+from config import conf, load_config, global_config, set_override
 from plugins import *
 
 # 定义指令集
@@ -131,6 +132,39 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pools": {
+        "alias": ["pools", "线程池"],
+        "desc": "查看消息处理线程池状态",
+    },
+    "queues": {
+        "alias": ["queues", "消息队列"],
+        "desc": "查看消息队列状态",
+    },
+    "ptime": {
+        "alias": ["ptime", "插件耗时"],
+        "args": ["[reset]"],
+        "desc": "查看各插件处理事件的耗时，reset清空统计并恢复被暂停的插件",
+    },
+    "probe": {
+        "alias": ["probe", "健康检查"],
+        "args": ["[chat|voice_to_text|text_to_voice|translate]"],
+        "desc": "检查模型、语音、翻译等后端是否可用",
+    },
+    "rank": {
+        "alias": ["rank", "排行榜"],
+        "args": ["[群名]", "[人数]"],
+        "desc": "查看打卡总分排行榜，不填群名时统计所有群",
+    },
+    "missed": {
+        "alias": ["missed", "未打卡"],
+        "args": ["[群名]"],
+        "desc": "查看昨天起未打卡(连续打卡中断)的用户",
+    },
+    "levels": {
+        "alias": ["levels", "等级分布"],
+        "args": ["[群名]"],
+        "desc": "查看打卡等级人数分布",
+    },
 }
 
 
@@ -272,7 +306,7 @@ class Godcmd(Plugin):
                         if args[0] not in const.MODEL_LIST:
                             ok, result = False, "模型名称不存在"
                         else:
-                            conf()["model"] = self.model_mapping(args[0])
+                            set_override("model", self.model_mapping(args[0]))
                             Bridge().reset_bot()
                             model = conf().get("model") or const.GPT35
                             ok, result = True, "模型设置为: " + str(model)
@@ -346,12 +380,80 @@ class Godcmd(Plugin):
                             else:
                                 ok, result = False, "当前对话机器人不支持重置会话"
                         elif cmd == "debug":
-                            if logger.getEffectiveLevel() == logging.DEBUG:  # 判断当前日志模式是否DEBUG
-                                logger.setLevel(logging.INFO)
+                            if get_log_level() == logging.DEBUG:  # 判断当前日志模式是否DEBUG
+                                set_log_level(logging.INFO)
                                 ok, result = True, "DEBUG模式已关闭"
                             else:
-                                logger.setLevel(logging.DEBUG)
+                                set_log_level(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pools":
+                            from channel.chat_channel import handler_pools
+
+                            ok = True
+                            result = "线程池状态：\n"
+                            for pool in handler_pools.values():
+                                stats = pool.stats()
+                                result += f"{stats['name']}: 执行中{stats['active']}/{stats['max_workers']} 排队{stats['queued']} 已完成{stats['completed']} 拒绝{stats['rejected']} "
+                                result += f"平均等待{stats['avg_wait_ms']}ms 最大等待{stats['max_wait_ms']}ms\n"
+                        elif cmd == "queues":
+                            stats = channel.get_queue_stats()
+                            ok = True
+                            result = f"消息队列状态：\n会话数{stats['sessions']} 排队{stats['queued']} 已处理{stats['dispatched']}\n"
+                            result += f"丢弃最早{stats['dropped_oldest']} 丢弃最新{stats['dropped_newest']} 合并{stats['coalesced']} 繁忙{stats['busy']}\n"
+                            result += f"平均排队{stats['wait_avg']}s 最长排队{stats['wait_max']}s 当前最久{stats['oldest_age']}s\n"
+                            drops = channel.get_drop_stats()
+                            result += f"入队前丢弃：重复{drops['duplicate']} 历史{drops['history']} 自己{drops['self']} 非白名单群{drops['whitelist']} "
+                            result += f"语音关闭{drops['voice_off']} 引用{drops['reference']} 未触发{drops['trigger']}"
+                        elif cmd == "rank":
+                            from config import User_manager
+
+                            group_name = args[0] if len(args) > 0 else None
+                            limit = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+                            users = User_manager.top_users(group_name, limit)
+                            ok = True
+                            result = f"{group_name or '所有群'}打卡排行榜：\n"
+                            for i, user in enumerate(users, 1):
+                                result += f"{i}. {user['username']} {user['total_score']}分 {user['level']} 连续{user['consecutive_days']}天\n"
+                        elif cmd == "missed":
+                            from config import User_manager
+
+                            group_name = args[0] if len(args) > 0 else None
+                            users = User_manager.missed_users(group_name, limit=101)
+                            ok = True
+                            result = f"{group_name or '所有群'}昨天起未打卡的用户：\n"
+                            result += "\n".join(f"{user['username']} 最后打卡{user['last_update_date']}" for user in users[:100])
+                            if len(users) > 100:
+                                result += "\n...只显示最近中断的100人"
+                        elif cmd == "levels":
+                            from config import User_manager
+
+                            group_name = args[0] if len(args) > 0 else None
+                            histogram = User_manager.level_histogram(group_name)
+                            ok = True
+                            result = f"{group_name or '所有群'}等级分布：\n"
+                            result += "\n".join(f"{level}: {count}人" for level, count in histogram.items())
+                        elif cmd == "ptime":
+                            ok = True
+                            if len(args) > 0 and args[0] == "reset":
+                                PluginManager().reset_event_stats()
+                                result = "插件耗时统计已清空"
+                            else:
+                                stats = PluginManager().get_event_stats()
+                                result = "插件耗时：\n" if stats else "暂无插件耗时统计"
+                                for item in stats[:20]:
+                                    result += f"{item['plugin']} {item['event']}: 调用{item['count']} 平均{item['avg_ms']}ms p95 {item['p95_ms']}ms 最大{item['max_ms']}ms 超时{item['slow']}"
+                                    result += " 已暂停\n" if item["suspended"] else "\n"
+                        elif cmd == "probe":
+                            bridge = Bridge()
+                            typenames = [t for t in args if t in bridge.btype] or None
+                            ok = True
+                            result = "后端健康检查：\n"
+                            for typename, (healthy, ms, message) in bridge.probe(typenames).items():
+                                result += f"{typename}({bridge.get_bot_type(typename)}): {'正常' if healthy else '异常'} {ms}ms {message}\n"
+                            from common import resilience
+
+                            for name, (state, failures) in resilience.get_states().items():
+                                result += f"熔断器 {name}: {state} 连续失败{failures}次\n"
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
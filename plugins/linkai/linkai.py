@@ -9,7 +9,7 @@ from common.expired_dict import ExpiredDict
 from common import const
 import os
 from .utils import Util
-from config import plugin_config
+from config import plugin_config, set_override
 
 
 @plugins.register(
@@ -143,7 +143,7 @@ class LinkAI(Plugin):
             if cmd[1] == "close":
                 tips_text = "关闭"
                 is_open = False
-            conf()["use_linkai"] = is_open
+            set_override("use_linkai", is_open)
             bridge.Bridge().reset_bot()
             _set_reply_text(f"LinkAI对话功能{tips_text}", e_context, level=ReplyType.INFO)
             return
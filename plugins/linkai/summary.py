@@ -1,4 +1,4 @@
-import requests
+from common import http_client
 from config import conf
 from common.log import logger
 import os
@@ -15,7 +15,7 @@ class LinkSummary:
             "name": file_path.split("/")[-1],
         }
         url = self.base_url() + "/v1/summary/file"
-        res = requests.post(url, headers=self.headers(), files=file_body, timeout=(5, 300))
+        res = http_client.post(url, headers=self.headers(), files=file_body, timeout=(5, 300))
         return self._parse_summary_res(res)
 
     def summary_url(self, url: str):
@@ -23,14 +23,14 @@ class LinkSummary:
         body = {
             "url": url
         }
-        res = requests.post(url=self.base_url() + "/v1/summary/url", headers=self.headers(), json=body, timeout=(5, 180))
+        res = http_client.post(url=self.base_url() + "/v1/summary/url", headers=self.headers(), json=body, timeout=(5, 180))
         return self._parse_summary_res(res)
 
     def summary_chat(self, summary_id: str):
         body = {
             "summary_id": summary_id
         }
-        res = requests.post(url=self.base_url() + "/v1/summary/chat", headers=self.headers(), json=body, timeout=(5, 180))
+        res = http_client.post(url=self.base_url() + "/v1/summary/chat", headers=self.headers(), json=body, timeout=(5, 180))
         if res.status_code == 200:
             res = res.json()
             logger.debug(f"[LinkSum] chat open, res={res}")
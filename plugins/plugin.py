@@ -6,7 +6,8 @@ from common.log import logger
 
 class Plugin:
     def __init__(self):
-        self.handlers = {}
+        self.handlers = {}  # 串行执行的事件处理函数，可以修改事件上下文、中断事件
+        self.observers = {}  # 只读取事件的处理函数，在后台线程池中异步执行，收到的是事件上下文的只读快照
 
     def load_config(self) -> dict:
         """
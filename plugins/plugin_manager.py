@@ -1,11 +1,17 @@
 # encoding:utf-8
 
+import bisect
 import importlib
 import importlib.util
 import json
 import os
 import sys
+import threading
+import time
+from queue import Full
 
+from common import metrics
+from common.handler_pool import HandlerPool
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -14,15 +20,32 @@ from config import conf, write_plugin_config
 from .event import *
 
 
+def _budgets_by_plugin(config):
+    # 返回(默认耗时预算, {插件名: 耗时预算})，单位毫秒
+    return config.get("plugin_time_budget", 0), {k.upper(): v for k, v in (config.get("plugin_time_budgets") or {}).items()}
+
+
+# 插件耗时统计的分桶上限，单位毫秒
+TIMING_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
 @singleton
 class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        self.listeners = {}  # event -> [(插件名, handler)]，只包含开启的插件，按优先级排序
+        self.observers = {}  # event -> [(插件名, observer)]，异步执行的只读处理函数
+        self._observer_pool = None
+        self.suspended = frozenset()  # 因超出耗时预算被暂停的(插件名, event)，只整体替换不原地修改
+        self._listeners_lock = threading.RLock()  # 修改suspended和重建listeners时持有
+        self.event_stats = {}  # (插件名, event) -> [调用次数, 总耗时, 最大耗时, 超时次数, 连续超时次数, 各桶计数]
+        self._stats_lock = threading.Lock()
         self.instances = {}
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self._loading = None  # 后台加载插件时的完成事件
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -136,6 +159,24 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self.refresh_listeners()
+
+    def refresh_listeners(self):
+        """
+        预先生成每个事件需要调用的handler列表，关闭、暂停的插件不会出现在列表中
+        """
+        with self._listeners_lock:
+            listeners, observers = {}, {}
+            suspended = self.suspended
+            for event, names in self.listening_plugins.items():
+                active = [
+                    (name, self.instances[name])
+                    for name in names
+                    if name in self.plugins and self.plugins[name].enabled and name in self.instances and (name, event) not in suspended
+                ]
+                listeners[event] = [(name, instance.handlers[event]) for name, instance in active if event in instance.handlers]
+                observers[event] = [(name, instance.observers[event]) for name, instance in active if event in getattr(instance, "observers", {})]
+            self.listeners, self.observers = listeners, observers
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -152,10 +193,13 @@ class PluginManager:
                     failed_plugins.append(name)
                     continue
                 self.instances[name] = instance
-                for event in instance.handlers:
+                for event in list(instance.handlers) + list(getattr(instance, "observers", {})):
                     if event not in self.listening_plugins:
                         self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
+                    if name not in self.listening_plugins[event]:
+                        self.listening_plugins[event].append(name)
+                with self._listeners_lock:
+                    self.suspended = frozenset((n, e) for n, e in self.suspended if n != name)
         self.refresh_order()
         return failed_plugins
 
@@ -166,6 +210,7 @@ class PluginManager:
                 if name in self.listening_plugins[event]:
                     self.listening_plugins[event].remove(name)
             del self.instances[name]
+            self.refresh_listeners()
             self.activate_plugins()
             return True
         return False
@@ -182,18 +227,151 @@ class PluginManager:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
         self.activate_plugins()
 
+    def load_plugins_in_background(self):
+        """
+        在后台线程加载插件，不阻塞通道启动；加载完成前触发的事件在emit_event中等待
+        """
+        loading = self._loading = threading.Event()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                self.load_plugins()
+                logger.info("[PluginManager] plugins loaded in {:.0f}ms".format((time.perf_counter() - start) * 1000))
+            except Exception as e:
+                logger.exception("[PluginManager] failed to load plugins: {}".format(e))
+            finally:
+                loading.set()
+
+        threading.Thread(target=run, name="plugin_loader", daemon=True).start()
+
+    def loading(self):
+        """
+        插件是否还在后台加载，加载完成前listeners和observers还是空的
+        """
+        return self._loading is not None and not self._loading.is_set()
+
+    def wait_loaded(self, timeout=None):
+        loading = self._loading
+        if loading is not None and not loading.is_set():
+            logger.debug("[PluginManager] waiting for plugins to load")
+            return loading.wait(timeout)
+        return True
+
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        if self._loading is not None and not self._loading.is_set():
+            self.wait_loaded()
+        for name, handler in self.listeners.get(e_context.event, ()):
+            if e_context.action != EventAction.CONTINUE:
+                break
+            logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+            start = time.perf_counter()
+            handler(e_context, *args, **kwargs)
+            self._record_time(name, e_context.event, time.perf_counter() - start)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s", name, e_context.event)
+        observers = self.observers.get(e_context.event)
+        if observers:
+            self._notify_observers(observers, e_context)
         return e_context
 
+    def _notify_observers(self, observers, e_context: EventContext):
+        """
+        串行的handler都执行完后，把事件的只读快照交给observer在后台线程池中执行，不阻塞消息处理
+        """
+        if self._observer_pool is None:
+            with self._stats_lock:
+                if self._observer_pool is None:
+                    self._observer_pool = HandlerPool(
+                        "plugin_observer", conf().get("plugin_observer_workers", 2), conf().get("plugin_observer_queue", 1000)
+                    )
+        snapshot = e_context.snapshot()
+        for name, observer in observers:
+            try:
+                self._observer_pool.submit(self._run_observer, name, observer, snapshot)
+            except Full:
+                logger.warning("[PluginManager] observer pool is full, skip observer {} for {}".format(name, e_context.event.name))
+
+    def _run_observer(self, name, observer, snapshot):
+        start = time.perf_counter()
+        try:
+            observer(snapshot)
+        except Exception as e:
+            logger.warning("[PluginManager] observer {} failed on {}: {}".format(name, snapshot.event.name, e))
+        finally:
+            self._record_time(name, snapshot.event, time.perf_counter() - start)
+
+    def _record_time(self, name, event, seconds):
+        if metrics.ENABLED:
+            metrics.PLUGIN_SECONDS.observe(seconds, event=event.name, plugin=name)
+        ms = seconds * 1000
+        default_budget, budgets = conf().derive("plugin_time_budgets", _budgets_by_plugin)
+        budget = budgets.get(name, default_budget)
+        over = 0 < budget < ms
+        with self._stats_lock:
+            stats = self.event_stats.get((name, event))
+            if stats is None:
+                stats = self.event_stats[(name, event)] = [0, 0.0, 0.0, 0, 0, [0] * (len(TIMING_BUCKETS_MS) + 1)]
+            stats[0] += 1
+            stats[1] += ms
+            if ms > stats[2]:
+                stats[2] = ms
+            stats[5][bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+            if over:
+                stats[3] += 1
+                stats[4] += 1
+            else:
+                stats[4] = 0
+            strikes = stats[4]
+        if over:
+            self._on_over_budget(name, event, ms, budget, strikes)
+
+    def _on_over_budget(self, name, event, ms, budget, strikes):
+        logger.warning("[PluginManager] plugin {} took {:.0f}ms on {}, budget {}ms".format(name, ms, event.name, budget))
+        if conf().get("plugin_budget_action", "log") != "disable" or name == "GODCMD":
+            return
+        if strikes >= conf().get("plugin_budget_strikes", 3):
+            # 只暂停该插件在这个事件上的handler，重载或重新开启插件后恢复
+            with self._listeners_lock:
+                self.suspended = self.suspended | {(name, event)}
+                self.refresh_listeners()
+            logger.warning("[PluginManager] plugin {} exceeded budget {} times in a row, handler for {} suspended".format(name, strikes, event.name))
+
+    def get_event_stats(self):
+        """
+        返回各插件在各事件上的耗时统计，单位毫秒，p95按分桶上限估算
+        """
+        with self._stats_lock:
+            items = [(key, list(stats[:4]), list(stats[5])) for key, stats in self.event_stats.items()]
+        suspended = self.suspended
+        result = []
+        for (name, event), (count, total, max_ms, slow), buckets in sorted(items, key=lambda item: -item[1][1]):
+            p95, seen = max_ms, 0
+            for bound, bucket_count in zip(TIMING_BUCKETS_MS, buckets):
+                seen += bucket_count
+                if seen >= count * 0.95:
+                    p95 = min(bound, max_ms)
+                    break
+            result.append({
+                "plugin": name,
+                "event": event.name,
+                "count": count,
+                "avg_ms": round(total / count, 3) if count else 0,
+                "p95_ms": round(p95, 3),
+                "max_ms": round(max_ms, 3),
+                "slow": slow,
+                "suspended": (name, event) in suspended,
+            })
+        return result
+
+    def reset_event_stats(self):
+        with self._stats_lock:
+            self.event_stats.clear()
+        with self._listeners_lock:
+            self.suspended = frozenset()
+            self.refresh_listeners()
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -233,6 +411,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.refresh_listeners()
             return True
         return True
 
@@ -331,6 +510,7 @@ class PluginManager:
                 if name in self.listening_plugins[event]:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
+            self.refresh_listeners()
             del self.pconf["plugins"][rawname]
             self.loaded[dirname] = None
             self.save_config()
@@ -0,0 +1,100 @@
+"""
+配置读取和ChatChannel._compose_context的耗时，群白名单、黑名单等配置取较大的规模
+用法(在项目根目录): python scripts/checks/bench_compose_context.py
+"""
+import contextlib
+import io
+import logging
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import config  # noqa: E402
+from common.log import logger  # noqa: E402
+
+GROUPS = ["学习群%d" % i for i in range(200)]
+
+
+def make_message(i):
+    from bridge.context import ContextType
+    from channel.chat_message import ChatMessage
+
+    msg = ChatMessage({})
+    msg.msg_id = i
+    msg.ctype = ContextType.TEXT
+    kind = i % 10
+    msg.is_group = kind < 8
+    msg.other_user_nickname = random.choice(GROUPS)
+    msg.other_user_id = "g%d" % (i % 300)
+    msg.actual_user_nickname = "kid%d" % (i % 1000)
+    msg.actual_user_id = "u%d" % (i % 1000)
+    msg.from_user_id = msg.other_user_id
+    msg.to_user_id = "me"
+    msg.at_list = []
+    msg.is_at = kind in (0, 1)
+    if msg.is_at:
+        msg.content = "@小助手 今天的任务是什么"
+    elif kind == 2:
+        msg.content = "小助手 讲个故事"
+    else:
+        msg.content = "大家好呀今天读了吗"
+    if not msg.is_group:
+        msg.content = "小助手 你好"
+        msg.other_user_nickname = msg.from_user_nickname = "kid"
+        msg.other_user_id = "u%d" % i
+    return msg
+
+
+def main():
+    config.load_config()
+    logger.setLevel(logging.ERROR)
+    config.set_overrides(
+        {
+            "config_watch_interval": 0,
+            "group_name_white_list": GROUPS[:150],
+            "group_name_keyword_white_list": ["佩奇%d" % i for i in range(30)],
+            "group_chat_in_one_session": GROUPS[:10],
+            "group_chat_prefix": ["@小助手", "小助手", "@bot"],
+            "group_chat_keyword": ["kw%d" % i for i in range(50)],
+            "single_chat_prefix": ["小助手", "@小助手"],
+            "image_create_prefix": ["画", "看", "找"],
+            "nick_name_black_list": ["bad%d" % i for i in range(100)],
+        }
+    )
+    from channel.chat_channel import ChatChannel
+
+    n = 1000000
+    elapsed = min(timeit.repeat(lambda: config.conf().get("group_chat_prefix"), number=n, repeat=5))
+    print("conf().get: %.0f ns" % (elapsed / n * 1e9))
+
+    channel = ChatChannel()
+    channel.name = "小助手"
+    channel.user_id = "me"
+    random.seed(0)
+    messages = [make_message(i) for i in range(20000)]
+
+    def run():
+        accepted = 0
+        for msg in messages:
+            context = channel._compose_context(msg.ctype, msg.content, isgroup=msg.is_group, msg=msg)
+            accepted += context is not None
+        return accepted
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+        elapsed = 1e9
+        for _ in range(5):
+            start = time.perf_counter()
+            accepted = run()
+            elapsed = min(elapsed, time.perf_counter() - start)
+    print("_compose_context: %.1f us/msg, %d of %d messages accepted" % (elapsed / len(messages) * 1e6, accepted, len(messages)))
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,69 @@
+"""
+ExpiredDict在消息查重场景下的读写耗时，以及过期清理和max_size淘汰的检查
+用法(在项目根目录): python scripts/checks/bench_expired_dict.py [key数量，默认1000000]
+"""
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from common.expired_dict import ExpiredDict  # noqa: E402
+
+
+def bench_dedupe(ids):
+    # 与WechatChannel._check一致: 先查重再写入
+    gc.collect()
+    d = ExpiredDict(3600)
+    start = time.perf_counter()
+    for msg_id in ids:
+        if msg_id not in d:
+            d[msg_id] = True
+    t_insert = time.perf_counter() - start
+    start = time.perf_counter()
+    hits = 0
+    for msg_id in ids:
+        if msg_id in d:
+            hits += 1
+    t_hit = time.perf_counter() - start
+    start = time.perf_counter()
+    keys = len(d.keys())
+    t_keys = time.perf_counter() - start
+    assert hits == len(ids) and keys == len(ids), (hits, keys)
+    n = len(ids)
+    print("check + insert %.2fs (%.2f us/op), duplicate check %.2fs (%.2f us/op), keys() %.2fs" % (t_insert, t_insert / n * 1e6, t_hit, t_hit / n * 1e6, t_keys))
+
+
+def check_eviction(ids):
+    # 短TTL下写入时批量清理过期key，常驻的只有最近TTL内写入的key
+    half = len(ids) // 2
+    d = ExpiredDict(0.5)
+    for msg_id in ids[:half]:
+        d[msg_id] = True
+    time.sleep(0.6)
+    for msg_id in ids[half:]:
+        d[msg_id] = True
+    retained = len(d._data)
+    assert retained < len(ids), retained
+    print("ttl=0.5s: %d of %d keys resident after writing the second half" % (retained, len(ids)))
+
+    max_size = max(len(ids) // 10, 1)
+    d = ExpiredDict(3600, max_size=max_size)
+    for msg_id in ids:
+        d[msg_id] = True
+    assert len(d._data) == max_size and ids[-1] in d and ids[0] not in d
+    print("max_size=%d: %d keys resident, oldest evicted" % (max_size, len(d._data)))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ids = ["%019d" % (7000000000000000000 + i) for i in range(n)]
+    bench_dedupe(ids)
+    check_eviction(ids)
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
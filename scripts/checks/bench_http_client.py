@@ -0,0 +1,94 @@
+"""
+共享连接池的http_client与每次新建连接的requests.post的延迟对比，使用本地的TLS桩服务
+用法(在项目根目录): python scripts/checks/bench_http_client.py
+需要openssl命令生成自签名证书，找不到时改用HTTP，只能体现TCP握手的开销
+"""
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import config  # noqa: E402
+
+N = 300
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持连接，否则连接池没有意义
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok":true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_cert(workdir):
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", cert],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def run(post, url, verify):
+    latencies = []
+    for _ in range(N):
+        start = time.perf_counter()
+        post(url, json={"q": "hi"}, verify=verify, timeout=(5, 10)).json()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_http_client_")
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        cert = make_cert(workdir)
+        if cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*cert)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+            url, verify = "https://127.0.0.1:%d/v1/chat/completions" % server.server_port, cert[0]
+        else:
+            print("openssl not found, benchmarking over plain HTTP")
+            url, verify = "http://127.0.0.1:%d/v1/chat/completions" % server.server_port, True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        config.load_config()
+        import requests
+
+        from common import http_client
+
+        for name, post in (("requests.post (new connection each call)", requests.post), ("http_client.post (shared pool)", http_client.post)):
+            run(post, url, verify)  # 预热
+            latencies = sorted(run(post, url, verify))
+            print("%-42s mean %.2f ms  p50 %.2f ms  p95 %.2f ms" % (name, statistics.mean(latencies), latencies[N // 2], latencies[int(N * 0.95)]))
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
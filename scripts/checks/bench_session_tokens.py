@@ -0,0 +1,75 @@
+"""
+会话裁剪时的token计数耗时: 按消息缓存的计数 vs 每次重新计算全部消息
+用法(在项目根目录): python scripts/checks/bench_session_tokens.py
+离线且没有配置tiktoken_cache_dir时，用正则分词代替tiktoken，只比较两种方式的相对开销
+"""
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import config  # noqa: E402
+from common import tokenizer  # noqa: E402
+from common.log import logger  # noqa: E402
+
+MODELS = ["gpt-4o", "gpt-3.5-turbo"]
+MAX_TOKENS = 2500
+
+
+class RegexEncoding(object):
+    pattern = re.compile(r"\w+|[^\w\s]|\s+")
+
+    def encode(self, text, **kwargs):
+        return self.pattern.findall(text)
+
+
+def make_turns(n=50):
+    random.seed(1)
+    words = "peppa george daddy pig glasses muddy puddles 小猪 佩奇 跟读 打卡 今天 任务 english reading".split()
+    sentence = lambda lo, hi: " ".join(random.choice(words) for _ in range(random.randint(lo, hi)))
+    return [(sentence(60, 200), sentence(100, 300)) for _ in range(n)]
+
+
+def run(session_class, model, turns):
+    session = session_class("sid", system_prompt="你是佩奇小助手" * 50, model=model)
+    counts = []
+    start = time.perf_counter()
+    for query, reply in turns:
+        session.add_query(query)
+        counts.append(session.discard_exceeding(MAX_TOKENS, None))
+        session.add_reply(reply)
+        counts.append(session.discard_exceeding(MAX_TOKENS, None))
+    return time.perf_counter() - start, counts, len(session.messages)
+
+
+def main():
+    config.load_config()
+    logger.setLevel(logging.ERROR)
+    from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_from_messages
+
+    class RecountSession(ChatGPTSession):
+        # 每次都重新计算全部消息，即没有缓存时的做法
+        def calc_tokens(self):
+            return num_tokens_from_messages(self.messages, self.model)
+
+    if any(tokenizer.get_tokenizer(model) is None for model in MODELS):
+        print("tiktoken encoding unavailable, using a regex tokenizer")
+        tokenizer.register_tokenizer("gpt-", lambda model: tokenizer.Tokenizer(RegexEncoding()))
+
+    turns = make_turns()
+    for model in MODELS:
+        run(ChatGPTSession, model, turns)  # 预热编码器
+        t_old, old_counts, old_len = run(RecountSession, model, turns)
+        t_new, new_counts, new_len = run(ChatGPTSession, model, turns)
+        assert old_counts == new_counts and old_len == new_len, model
+        print("%-14s recount %7.1f ms  cached %6.1f ms  speedup %5.1fx, same counts" % (model, t_old * 1e3, t_new * 1e3, t_old / t_new))
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,69 @@
+"""
+PrefixMatcher/KeywordMatcher与逐个比较的循环写法的一致性检查和耗时对比
+用法(在项目根目录): python scripts/checks/bench_trigger_matcher.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from common.trigger_matcher import KeywordMatcher, PrefixMatcher  # noqa: E402
+
+
+# 预编译之前ChatChannel使用的写法，作为对照
+def check_prefix(content, prefix_list):
+    if not prefix_list:
+        return None
+    for prefix in prefix_list:
+        if content.startswith(prefix):
+            return prefix
+    return None
+
+
+def check_contain(content, keyword_list):
+    if not keyword_list:
+        return None
+    for ky in keyword_list:
+        if content.find(ky) != -1:
+            return True
+    return None
+
+
+def check_equivalence(rounds=3000):
+    # 随机列表中包含正则元字符和空前缀
+    random.seed(1)
+    alphabet = "小助手画看找佩奇ab@ .*+?[]()|\\"
+    rand_text = lambda n: "".join(random.choice(alphabet) for _ in range(random.randint(0, n)))
+    for _ in range(rounds):
+        words = [rand_text(3) for _ in range(random.randint(0, 6))]
+        text = rand_text(8)
+        assert PrefixMatcher(words).match(text) == check_prefix(text, words), (words, text)
+        assert KeywordMatcher(words).match(text) == check_contain(text, words), (words, text)
+    print("equivalence: %d random lists ok" % rounds)
+
+
+def bench():
+    texts = ["大家好呀今天读了吗，小猪佩奇第三集真好看", "@小助手 今天的任务是什么", "小助手 讲个故事"]
+    per_call = lambda fn: min(timeit.repeat(fn, number=3000, repeat=5)) / 3000 / len(texts) * 1e6
+    for n in (3, 50, 500):
+        words = ["关键词%d" % i for i in range(n)]
+        prefix_matcher, keyword_matcher = PrefixMatcher(words), KeywordMatcher(words)
+        print(
+            "n=%3d prefix: loop %.2f us compiled %.2f us | keyword: loop %.2f us compiled %.2f us"
+            % (
+                n,
+                per_call(lambda: [check_prefix(t, words) for t in texts]),
+                per_call(lambda: [prefix_matcher.match(t) for t in texts]),
+                per_call(lambda: [check_contain(t, words) for t in texts]),
+                per_call(lambda: [keyword_matcher.match(t) for t in texts]),
+            )
+        )
+
+
+if __name__ == "__main__":
+    check_equivalence()
+    bench()
+    sys.stdout.flush()
+    os._exit(0)
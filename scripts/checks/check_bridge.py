@@ -0,0 +1,105 @@
+"""
+Bridge的健康检查和bot创建检查，使用本地的桩服务，不访问真实后端
+用法(在项目根目录): python scripts/checks/check_bridge.py
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import config  # noqa: E402
+
+GOOD_KEY = "sk-stub-good"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # 模拟OpenAI的/v1/models接口，只接受GOOD_KEY
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            self.send_error(404)
+            return
+        if self.headers.get("Authorization") != "Bearer " + GOOD_KEY:
+            self.send_error(401)
+            return
+        body = json.dumps({"object": "list", "data": []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check_probe(bridge, port):
+    config.set_overrides({"open_ai_api_base": "http://127.0.0.1:{}/v1".format(port), "open_ai_api_key": GOOD_KEY})
+    ok, ms, message = bridge.probe(["chat"])["chat"]
+    assert ok, message
+    config.set_override("open_ai_api_key", "sk-stub-bad")
+    ok, ms, message = bridge.probe(["chat"])["chat"]
+    assert not ok and "401" in message, message
+    config.set_override("open_ai_api_base", "http://127.0.0.1:1/v1")
+    ok, ms, message = bridge.probe(["chat"])["chat"]
+    assert not ok, message
+    print("probe: ok / 401 / connection refused reported correctly")
+
+
+def check_reset_race(bridge_module, bridge):
+    # reset_bot在另一个线程创建bot期间切换了类型，最终留下的必须是新类型的bot
+    created = threading.Event()
+    release = threading.Event()
+
+    def slow_translator(bot_type):
+        if bot_type == "old":
+            created.set()
+            release.wait()
+        return bot_type
+
+    bridge_module.create_translator = slow_translator
+    bridge.btype["translate"] = "old"
+    bridge.bots.pop("translate", None)
+    result = []
+    t = threading.Thread(target=lambda: result.append(bridge.get_bot("translate")))
+    t.start()
+    created.wait()
+    with bridge._lock:
+        btype = dict(bridge.btype, translate="new")
+        bridge.btype, bridge.bots = btype, {}
+    release.set()
+    t.join()
+    assert result == ["new"] and bridge.get_bot("translate") == "new", (result, bridge.bots)
+
+    # 一种bot创建很慢时不影响其他bot的首次创建
+    bridge_module.create_voice = lambda bot_type: time.sleep(1) or bot_type
+    bridge.bots.pop("voice_to_text", None)
+    bridge.bots.pop("translate", None)
+    threading.Thread(target=bridge.get_bot, args=("voice_to_text",), daemon=True).start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    bridge.get_bot("translate")
+    assert time.monotonic() - start < 0.5
+    print("bot creation: reset during creation and per-type locks ok")
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.load_config()
+    config.set_overrides({"bot_type": "chatGPT", "config_watch_interval": 0})
+    from bridge import bridge as bridge_module
+
+    bridge = bridge_module.Bridge()
+    check_probe(bridge, server.server_address[1])
+    check_reset_race(bridge_module, bridge)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,88 @@
+"""
+学员积分的并发检查和读写耗时，使用临时目录里的数据库，不影响user_data
+用法(在项目根目录): python scripts/checks/check_user_scores.py
+"""
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from common.log import logger  # noqa: E402
+from video_task.user_data import UserManager  # noqa: E402
+
+THREADS = 8
+UPDATES_PER_THREAD = 20
+
+
+def check_concurrency(workdir, rounds=50):
+    # 8个处理线程同时给同一个学员打分，最终积分必须等于当天最高分，不能丢更新
+    for r in range(rounds):
+        manager = UserManager(os.path.join(workdir, "concurrency_%d" % r))
+        user_id = "u1"
+        # 避开5分，5分会触发奖励逻辑，改变总分
+        scores = [random.randint(1, 4) for _ in range(THREADS * UPDATES_PER_THREAD)]
+        barrier = threading.Barrier(THREADS)
+        errors = []
+
+        def worker(k):
+            barrier.wait()
+            for score in scores[k::THREADS]:
+                try:
+                    manager.update_user_score(user_id, "peppa", score)
+                    manager.load_user(user_id)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, errors[:3]
+        final = manager.load_user(user_id, fresh=True)
+        assert final["current_day_score"] == max(scores), (r, final["current_day_score"], max(scores))
+        assert final["total_score"] == max(scores), (r, final["total_score"], max(scores))
+    print("concurrency: %d threads x %d updates x %d rounds, no lost updates" % (THREADS, UPDATES_PER_THREAD, rounds))
+
+
+def bench_speed(workdir, n=2000):
+    manager = UserManager(os.path.join(workdir, "speed"))
+    for i in range(n):
+        manager.load_user("u%d" % i)
+    start = time.perf_counter()
+    for i in range(n):
+        # 与处理一条跟读视频消息时的调用顺序一致
+        user_id = "u%d" % i
+        manager.load_user(user_id)
+        manager.update_user_score(user_id, "peppa", 3)
+        manager.load_user(user_id)
+        manager.load_user(user_id)
+        manager.get_active_achievements(user_id)
+    print("video message path (load + update + 2 loads + achievements): %.0f us/msg" % ((time.perf_counter() - start) / n * 1e6))
+    start = time.perf_counter()
+    for i in range(n):
+        manager.load_user("u%d" % i)
+    print("load_user (cached): %.1f us" % ((time.perf_counter() - start) / n * 1e6))
+
+
+def main():
+    logger.setLevel(logging.ERROR)
+    random.seed(1)
+    workdir = tempfile.mkdtemp(prefix="check_user_scores_")
+    try:
+        check_concurrency(workdir)
+        bench_speed(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
+    sys.stdout.flush()
+    os._exit(0)
@@ -1,8 +1,15 @@
+import glob
 import json
 import os
+import sqlite3
+import sys
+import threading
 from datetime import datetime, timedelta
 import hashlib
 
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
 
 def generate_user_id(group_name, user_nickname):
     # Combine group name and user nickname
@@ -19,21 +26,107 @@ def generate_user_id(group_name, user_nickname):
 
 
 class UserManager:
-    def __init__(self, file_path="user_data"):
+    """
+    用户打卡数据保存在file_path目录下的SQLite数据库(WAL模式)中，读取时优先使用进程内缓存
+    update_user_score在一个事务内完成读取、计分和写回，多个线程或进程同时处理同一用户时不会丢失更新；
+    缓存只在本进程内失效，多个进程共用数据库时load_user需要传fresh=True才能读到其他进程写入的数据
+    总分、等级、连续天数、最后打卡日期和所在群冗余存成带索引的列，用于排行榜等查询
+    """
+
+    DB_NAME = "users.db"
+    # 冗余存储的索引列，值取自用户数据中的同名字段
+    INDEX_COLUMNS = [
+        ("username", "TEXT"),
+        ("total_score", "INTEGER"),
+        ("level", "TEXT"),
+        ("consecutive_days", "INTEGER"),
+        ("last_update_date", "TEXT"),
+    ]
+
+    def __init__(self, file_path="user_data", cache_seconds=3600, cache_size=10000):
         self.file_path = file_path
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
-
-    def load_user(self, user_id):
-        file_path = f"{self.file_path}/{user_id}.json"
-        if not os.path.exists(file_path):
-            # Create a new user file with initial data
-            initial_data = self.create_initial_user_data(user_id)
-            self.save_user(initial_data)
-            return initial_data
-
-        with open(file_path, "r", encoding='utf-8') as f:
-            return json.load(f)
+        self.db_path = os.path.join(file_path, self.DB_NAME)
+        self._lock = threading.RLock()
+        self._cache = ExpiredDict(cache_seconds, max_size=cache_size)  # user_id -> json字符串
+        self._conn = None  # 第一次读写时才打开数据库，import config不会创建目录和数据库文件
+        self._no_group = set()  # 读取时所在群为空的user_id，之后带群名读取时补上
+
+    def _connect(self):
+        with self._lock:
+            if self._conn is None:
+                if not os.path.exists(self.file_path):
+                    os.makedirs(self.file_path)
+                self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+                self._migrate_index_columns()
+                if self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None and glob.glob(os.path.join(self.file_path, "*.json")):
+                    # 首次使用数据库时自动导入旧版的json文件
+                    self.import_json_dir(self.file_path)
+            return self._conn
+
+    def _migrate_index_columns(self):
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(users)")]
+        added = False
+        for name, column_type in self.INDEX_COLUMNS + [("group_name", "TEXT")]:
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE users ADD COLUMN {name} {column_type}")
+                added = True
+        if added:
+            # 旧数据从json中回填索引列，所在群无法从user_id反推，等该用户下次在群里读取或打卡时补上
+            self._conn.execute(
+                "UPDATE users SET " + ", ".join(f"{name} = json_extract(data, '$.{name}')" for name, _ in self.INDEX_COLUMNS)
+            )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_group_score ON users (group_name, total_score DESC)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_score ON users (total_score DESC)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_group_date ON users (group_name, last_update_date)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_date ON users (last_update_date)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_group_level ON users (group_name, level)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_level ON users (level)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_group_streak ON users (group_name, consecutive_days DESC)")
+
+    def _write_user(self, user_data, group_name=None, replace=True):
+        # 调用方需持有self._lock，group_name为None时保留原来的所在群
+        data = json.dumps(user_data, ensure_ascii=False)
+        names = [name for name, _ in self.INDEX_COLUMNS]
+        sql = "INSERT INTO users (user_id, data, group_name, {}) VALUES (?, ?, ?, {}) ON CONFLICT(user_id) DO ".format(
+            ", ".join(names), ", ".join("?" * len(names))
+        )
+        if replace:
+            sql += "UPDATE SET data = excluded.data, group_name = COALESCE(excluded.group_name, users.group_name), " + ", ".join(
+                f"{name} = excluded.{name}" for name in names
+            )
+        else:
+            sql += "NOTHING"
+        self._conn.execute(sql, [user_data["user_id"], data, group_name] + [user_data.get(name) for name in names])
+        return data
+
+    def load_user(self, user_id, group_name=None, fresh=False):
+        # fresh为True时跳过缓存直接读数据库，用于需要最新分数的场景(如评分)
+        data = None if fresh else self._cache.get(user_id)
+        if data is None:
+            with self._lock:
+                self._connect()
+                row = self._conn.execute("SELECT data, group_name FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                if row is None:
+                    # Create a new user with initial data，其他进程已创建时以已有数据为准
+                    self._write_user(self.create_initial_user_data(user_id), group_name, replace=False)
+                    row = self._conn.execute("SELECT data, group_name FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                data = row[0]
+                self._cache[user_id] = data
+                if row[1] is None:
+                    self._no_group.add(user_id)
+        if group_name is not None and user_id in self._no_group:
+            self._fill_group_name(user_id, group_name)
+        # 每次返回新的dict，调用方修改不会影响缓存
+        return json.loads(data)
+
+    def _fill_group_name(self, user_id, group_name):
+        # 旧数据迁移时无法得知所在群，在该用户第一次带群名读取时补上
+        with self._lock:
+            self._connect().execute("UPDATE users SET group_name = ? WHERE user_id = ? AND group_name IS NULL", (group_name, user_id))
+            self._no_group.discard(user_id)
 
     def create_initial_user_data(self, user_id):
         today = datetime.now().strftime("%Y-%m-%d")
@@ -58,16 +151,32 @@ class UserManager:
             }
         }
 
-    def save_user(self, user_data):
-        with open(f"{self.file_path}/{user_data['user_id']}.json", "w", encoding='utf-8') as f:
-            json.dump(user_data, f, indent=2)
+    def save_user(self, user_data, group_name=None):
+        with self._lock:
+            self._connect()
+            self._cache[user_data['user_id']] = self._write_user(user_data, group_name)
 
-    def update_user_score(self, user_id, user_name, score):
+    def update_user_score(self, user_id, user_name, score, group_name=None):
         score = int(score)
-        user_data = self.load_user(user_id)
+        with self._lock:
+            self._connect()
+            # BEGIN IMMEDIATE先拿到写锁，同一数据库的其他进程也无法在读取和写回之间插入更新
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                user_data = json.loads(row[0]) if row else self.create_initial_user_data(user_id)
+                self._apply_score(user_data, user_name, score)
+                data = self._write_user(user_data, group_name)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                self._cache.pop(user_id, None)
+                raise
+            self._cache[user_id] = data
+        return user_data
+
+    def _apply_score(self, user_data, user_name, score):
         user_data['username'] = user_name
-        if not user_data:
-            return None
 
         today = datetime.now().strftime("%Y-%m-%d")
         is_new_day = user_data['last_update_date'] != today
@@ -92,8 +201,68 @@ class UserManager:
         # Update level
         self.update_level(user_data)
 
-        self.save_user(user_data)
-        return user_data
+    def import_json_dir(self, json_dir):
+        """
+        导入旧版每个用户一个json文件的数据，已存在的用户会被覆盖，返回导入的用户数
+        """
+        users = []
+        for path in glob.glob(os.path.join(json_dir, "*.json")):
+            try:
+                with open(path, "r", encoding='utf-8') as f:
+                    users.append(json.load(f))
+            except Exception as e:
+                logger.warning("[UserManager] skip {}: {}".format(path, e))
+        with self._lock:
+            self._connect()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for user_data in users:
+                    self._write_user(user_data)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._cache.clear()
+        logger.info("[UserManager] imported {} users from {}".format(len(users), json_dir))
+        return len(users)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            cursor = self._connect().execute(sql, params)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def top_users(self, group_name=None, limit=10):
+        """
+        总分排行榜，group_name为None时统计所有群
+        """
+        where, params = ("WHERE group_name = ?", [group_name]) if group_name is not None else ("", [])
+        return self._query(
+            "SELECT user_id, username, total_score, level, consecutive_days, last_update_date FROM users "
+            f"{where} ORDER BY total_score DESC LIMIT ?",
+            params + [limit],
+        )
+
+    def missed_users(self, group_name=None, date=None, limit=-1):
+        """
+        date(默认昨天)及之后都没有打卡的用户，即连续打卡已经中断的用户，按中断时间由近到远排列，limit为-1时不限制人数
+        """
+        if date is None:
+            date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        where, params = ("group_name = ? AND ", [group_name]) if group_name is not None else ("", [])
+        return self._query(
+            "SELECT user_id, username, total_score, level, consecutive_days, last_update_date FROM users "
+            f"WHERE {where}last_update_date < ? ORDER BY last_update_date DESC LIMIT ?",
+            params + [date, limit],
+        )
+
+    def level_histogram(self, group_name=None):
+        """
+        各等级的人数
+        """
+        where, params = ("WHERE group_name = ?", [group_name]) if group_name is not None else ("", [])
+        rows = self._query(f"SELECT level, COUNT(*) AS count FROM users {where} GROUP BY level", params)
+        return {row["level"]: row["count"] for row in rows}
 
     def handle_new_day(self, user_data, score, today):
         # 计算上次打卡到今天的间隔天数
@@ -247,3 +416,11 @@ class UserManager:
                 user_data['level'] = level
                 break
 
+
+if __name__ == "__main__":
+    # 迁移旧数据: python -m video_task.user_data <json目录> [数据库目录]
+    if len(sys.argv) < 2:
+        print("usage: python -m video_task.user_data <json_dir> [db_dir]")
+        sys.exit(1)
+    count = UserManager(sys.argv[2] if len(sys.argv) > 2 else "user_data").import_json_dir(sys.argv[1])
+    print("imported {} users".format(count))
@@ -1,11 +1,11 @@
 from common.log import logger
 import requests
+from common import http_client
 import os
 import time
 from typing import Optional
 from config import conf
-from moviepy.editor import VideoFileClip
-import azure.cognitiveservices.speech as speechsdk
+# moviepy(会连带导入IPython)和azure语音sdk导入耗时约0.5秒，只在处理视频时才导入
 
 
 def get_response_from_gpt(openai_apikey, model, messages, temperature=0, max_tokens=4000, response_format=None):
@@ -33,7 +33,7 @@ def get_response_from_gpt(openai_apikey, model, messages, temperature=0, max_tok
         proxy = ""
         proxies = {"http": proxy, "https": proxy} if proxy else None
 
-        response = requests.post(base_url, headers=headers, json=data, proxies=proxies, timeout=30)
+        response = http_client.post(base_url, headers=headers, json=data, proxies=proxies, timeout=30)
 
         if response.status_code == 200:
             return response.json()
@@ -212,6 +212,9 @@ json格式输出COT,score,response:
 
 class AudioProcessor:
     def __init__(self):
+        import azure.cognitiveservices.speech as speechsdk
+
+        self.speechsdk = speechsdk
         self.api_key = conf().get("azure_voice_api_key")
         self.api_region = conf().get("azure_voice_region")
         self.speech_config = speechsdk.SpeechConfig(
@@ -222,6 +225,7 @@ class AudioProcessor:
 
     def transcribe_audio(self, audio_path: str) -> str:
         """转录长音频文件"""
+        speechsdk = self.speechsdk
         try:
             audio_input = speechsdk.AudioConfig(filename=audio_path)
             speech_recognizer = speechsdk.SpeechRecognizer(
@@ -299,6 +303,8 @@ def process_video(context):
         audio_path = os.path.splitext(video_path)[0] + ".wav"
 
         # 提取音频
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+
         video = VideoFileClip(video_path)
         video.audio.write_audiofile(audio_path)
         logger.info(f"Audio extracted from {video_path} to {audio_path}")
@@ -337,7 +343,7 @@ def get_tts_file_url(user_id: str, voice_provider: str, voice_name: str, text: s
     }
 
     try:
-        response = requests.post(conf().get("TTS_URL"), json=payload, timeout=30)
+        response = http_client.post(conf().get("TTS_URL"), json=payload, timeout=30)
         response.raise_for_status()  # 如果状态码不是200，会抛出HTTPError异常
 
         result = response.json()